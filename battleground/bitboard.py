@@ -0,0 +1,309 @@
+from collections import namedtuple
+try:
+    import sunfish
+except ImportError:
+    # imported as part of the battleground package
+    from battleground import sunfish
+
+###############################################################################
+# A bitboard backed alternative to sunfish.Position.
+# The position keeps one 64 bit mask per piece type plus one mask per color,
+# but it speaks the same language as sunfish: moves are (i, j) pairs of
+# indexes in the 120 char board, the board is always seen from the side to
+# move and the score is the sunfish pst evaluation. That way Searcher and the
+# helpers in tools.py can work with either representation.
+###############################################################################
+
+# Square s of the bitboard is row s // 8 (0 is the 8th rank) and column s % 8
+# (0 is the a file). Rotating the board, as sunfish does after every move,
+# maps s to 63 - s, so it is simply a reversal of the bits in each mask.
+SQ120 = tuple(sunfish.A8 + 10 * (s // 8) + s % 8 for s in range(64))
+SQ64 = tuple(SQ120.index(i) if i in SQ120 else -1 for i in range(120))
+
+FULL = (1 << 64) - 1
+FILE_A = sum(1 << s for s in range(0, 64, 8))
+FILE_H = FILE_A << 7
+ROWS = tuple(0xff << (8 * r) for r in range(8))
+
+PIECES = 'PNBRQK'
+A1, H1 = SQ64[sunfish.A1], SQ64[sunfish.H1]
+
+N, E, S, W = sunfish.N, sunfish.E, sunfish.S, sunfish.W
+
+###############################################################################
+# Attack tables
+###############################################################################
+
+
+def _steps(s, d, slide):
+    ''' Squares reached from s by stepping in the 120 board direction d '''
+    i = SQ120[s] + d
+    while SQ64[i] != -1:
+        yield SQ64[i]
+        if not slide:
+            break
+        i += d
+
+
+def _mask(squares):
+    return sum(1 << s for s in squares)
+
+
+KNIGHT_ATTACKS = tuple(
+    _mask(t for d in sunfish.directions['N'] for t in _steps(s, d, False))
+    for s in range(64))
+KING_ATTACKS = tuple(
+    _mask(t for d in sunfish.directions['K'] for t in _steps(s, d, False))
+    for s in range(64))
+
+# For sliders we keep the full ray in every direction. The directions in which
+# the square index grows find their first blocker with the lowest set bit,
+# the others with the highest one.
+RAYS = {d: tuple(_mask(_steps(s, d, True)) for s in range(64))
+        for d in sunfish.directions['Q']}
+ROOK_DIRECTIONS = ((E, True), (S, True), (N, False), (W, False))
+BISHOP_DIRECTIONS = (
+    (S + E, True), (S + W, True), (N + E, False), (N + W, False))
+
+# Reverses the bits of every byte, used to rotate the masks
+_REVERSED_BYTES = bytes(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+
+
+def _flip(mask):
+    return int.from_bytes(
+        mask.to_bytes(8, 'big').translate(_REVERSED_BYTES), 'little')
+
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _slide(s, occupied, directions):
+    attacks = 0
+    for d, increasing in directions:
+        ray = RAYS[d][s]
+        blockers = ray & occupied
+        if blockers:
+            if increasing:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= RAYS[d][blocker]
+        attacks |= ray
+    return attacks
+
+###############################################################################
+# Chess logic
+###############################################################################
+
+
+class BitboardPosition(namedtuple(
+        'BitboardPosition', 'pieces us them score wc bc ep kp black hash')):
+    """ A state of a chess game, see sunfish.Position
+    pieces -- the masks of the pawns, knights, bishops, rooks, queens, kings
+    us -- the mask of the pieces of the side to move
+    them -- the mask of the opponent pieces
+    score, wc, bc, ep, kp -- the same as in sunfish.Position
+    black -- True if the board is seen from the black player
+    hash -- the zobrist key, the same as in sunfish.Position
+    """
+
+    @classmethod
+    def from_position(cls, pos):
+        pieces, us, them = [0] * 6, 0, 0
+        for s, i in enumerate(SQ120):
+            p = pos.board[i]
+            if p.isupper():
+                us |= 1 << s
+            elif p.islower():
+                them |= 1 << s
+            else:
+                continue
+            pieces[PIECES.index(p.upper())] |= 1 << s
+        black = pos.board.startswith('\n')
+        return cls(tuple(pieces), us, them, pos.score,
+                   pos.wc, pos.bc, pos.ep, pos.kp, black, pos.hash)
+
+    def to_position(self):
+        return sunfish.Position(
+            self.board, self.score, self.wc, self.bc, self.ep, self.kp,
+            self.hash)
+
+    @property
+    def board(self):
+        ''' The 120 char board of the equivalent sunfish.Position '''
+        board = [' '] * 120
+        board[0 if self.black else 9::10] = ['\n'] * 12
+        for s, i in enumerate(SQ120):
+            board[i] = self.squares[s]
+        return ''.join(board)
+
+    def __getattr__(self, name):
+        # The pieces by square, using the letters of sunfish, are only computed
+        # once the position is evaluated, and then looked up by value()
+        if name != 'squares':
+            raise AttributeError(name)
+        squares = ['.'] * 64
+        for p, mask in zip(PIECES, self.pieces):
+            for s in _bits(mask & self.us):
+                squares[s] = p
+            for s in _bits(mask & self.them):
+                squares[s] = p.lower()
+        self.squares = ''.join(squares)
+        return self.squares
+
+    def gen_moves(self):
+        us, them = self.us, self.them
+        empty = FULL & ~(us | them)
+        pawns, knights, bishops, rooks, queens, kings = \
+            (mask & us for mask in self.pieces)
+        # Pawn pushes, double pushes from the first two ranks, and captures,
+        # which are also allowed into the en passant and king passant squares
+        one = pawns >> 8 & empty
+        for t in _bits(one):
+            yield SQ120[t + 8], SQ120[t]
+        for t in _bits((one & (ROWS[5] | ROWS[6])) >> 8 & empty):
+            yield SQ120[t + 16], SQ120[t]
+        targets = them
+        for i in (self.ep, self.kp):
+            if i:
+                targets |= 1 << SQ64[i] & empty
+        for t in _bits((pawns & ~FILE_A) >> 9 & targets):
+            yield SQ120[t + 9], SQ120[t]
+        for t in _bits((pawns & ~FILE_H) >> 7 & targets):
+            yield SQ120[t + 7], SQ120[t]
+        # Crawlers
+        for s in _bits(knights):
+            for t in _bits(KNIGHT_ATTACKS[s] & ~us):
+                yield SQ120[s], SQ120[t]
+        for s in _bits(kings):
+            for t in _bits(KING_ATTACKS[s] & ~us):
+                yield SQ120[s], SQ120[t]
+        # Sliders
+        occupied = us | them
+        for mask, directions in (
+                (bishops | queens, BISHOP_DIRECTIONS),
+                (rooks | queens, ROOK_DIRECTIONS)):
+            for s in _bits(mask):
+                attacks = _slide(s, occupied, directions) & ~us
+                for t in _bits(attacks):
+                    yield SQ120[s], SQ120[t]
+                # Castling, by sliding the rook next to the king
+                if s == A1 and self.wc[0]:
+                    side = E
+                elif s == H1 and self.wc[1]:
+                    side = W
+                else:
+                    continue
+                for t in _bits(attacks & empty):
+                    k = SQ64[SQ120[t] + side]
+                    if k != -1 and kings >> k & 1:
+                        yield SQ120[t] + side, SQ120[t] - side
+
+    def rotate(self):
+        ''' Rotates the board, preserving enpassant '''
+        return BitboardPosition(
+            tuple(_flip(mask) for mask in self.pieces),
+            _flip(self.them), _flip(self.us), -self.score, self.bc, self.wc,
+            119-self.ep if self.ep else 0,
+            119-self.kp if self.kp else 0,
+            not self.black, self.hash ^ sunfish.ZOBRIST_BLACK)
+
+    def nullmove(self):
+        ''' Like rotate, but clears ep and kp '''
+        keys = sunfish.ZOBRIST_VIEW[self.black]
+        h = self.hash ^ keys['ep'][self.ep] ^ keys['kp'][self.kp]
+        h ^= sunfish.ZOBRIST_BLACK
+        return self.rotate()._replace(ep=0, kp=0, hash=h)
+
+    def move(self, move):
+        i, j = move
+        s, t = SQ64[i], SQ64[j]
+        p, q = self.squares[s], self.squares[t]
+        pieces = list(self.pieces)
+        keys = sunfish.ZOBRIST_VIEW[self.black]
+
+        def put(sq, piece):
+            # Clears the square and places our piece (if any) on it
+            nonlocal us, them, h
+            bit = 1 << sq
+            for k in range(6):
+                if pieces[k] & bit:
+                    old = PIECES[k] if us & bit else PIECES[k].lower()
+                    h ^= keys[old][SQ120[sq]]
+                    pieces[k] ^= bit
+            us &= ~bit
+            them &= ~bit
+            if piece != '.':
+                h ^= keys[piece][SQ120[sq]]
+                pieces[PIECES.index(piece)] |= bit
+                us |= bit
+        # Copy variables and reset ep and kp
+        us, them = self.us, self.them
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        h = self.hash ^ keys['castling'][sunfish.castling_index(wc, bc)]
+        h ^= keys['ep'][self.ep] ^ keys['kp'][self.kp]
+        score = self.score + self.value(move)
+        # Actual move
+        if q != '.':
+            pieces[PIECES.index(q.upper())] ^= 1 << t
+            them ^= 1 << t
+        pieces[PIECES.index(p)] ^= 1 << s | 1 << t
+        us ^= 1 << s | 1 << t
+        h ^= keys[p][i] ^ keys[p][j] ^ keys[q][j]
+        # Castling rights, we move the rook or capture the opponent's
+        if i == sunfish.A1:
+            wc = (False, wc[1])
+        if i == sunfish.H1:
+            wc = (wc[0], False)
+        if j == sunfish.A8:
+            bc = (bc[0], False)
+        if j == sunfish.H8:
+            bc = (False, bc[1])
+        # Castling
+        if p == 'K':
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                put(A1 if j < i else H1, '.')
+                put(SQ64[kp], 'R')
+        # Pawn promotion, double move and en passant capture
+        if p == 'P':
+            if sunfish.A8 <= j <= sunfish.H8:
+                put(t, 'Q')
+            if j - i == 2*N:
+                ep = i + N
+            if j - i in (N+W, N+E) and q == '.':
+                put(SQ64[j+S], '.')
+        h ^= keys['castling'][sunfish.castling_index(wc, bc)]
+        h ^= keys['ep'][ep] ^ keys['kp'][kp]
+        # We rotate the returned position, so it's ready for the next player
+        return BitboardPosition(tuple(pieces), us, them, score,
+                                wc, bc, ep, kp, self.black, h).rotate()
+
+    def value(self, move):
+        i, j = move
+        p, q = self.squares[SQ64[i]], self.squares[SQ64[j]]
+        pst = sunfish.pst
+        # Actual move
+        score = pst[p][j] - pst[p][i]
+        # Capture
+        if q.islower():
+            score += pst[q.upper()][119-j]
+        # Castling check detection
+        if abs(j-self.kp) < 2:
+            score += pst['K'][119-j]
+        # Castling
+        if p == 'K' and abs(i-j) == 2:
+            score += pst['R'][(i+j)//2]
+            score -= pst['R'][sunfish.A1 if j < i else sunfish.H1]
+        # Special pawn stuff
+        if p == 'P':
+            if sunfish.A8 <= j <= sunfish.H8:
+                score += pst['Q'][j] - pst['P'][j]
+            if j == self.ep:
+                score += pst['P'][119-(j+S)]
+        return score
@@ -0,0 +1,199 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.orm import sessionmaker, undefer
+
+import battleground.entity as entity
+
+###############################################################################
+# Measures the lookups of the services on databases of growing size. With
+# the indexes of the entities the time of a lookup stays about the same as
+# the tables grow, without them it grows with the tables.
+# With --sources it measures the time and the memory of loading all bots,
+# with their sources deferred as in the services and undeferred.
+#   python -m battleground.dbbench
+#   python -m battleground.dbbench --sizes 1000 100000 --no-indexes --plan
+#   python -m battleground.dbbench --sizes 10000 --sources 16
+###############################################################################
+
+SIZES = (1000, 10000, 100000)
+LOOKUPS = 200
+# bots per user and fighters per bot of the generated databases
+BOTS_PER_USER = 10
+FIGHTERS_PER_BOT = 4
+GAMES = 10
+# kilobytes of the source of every bot when the sources are measured
+SOURCE_KB = 16
+
+
+def fill(engine, size, source_kb=0):
+    """
+    Stores size bots with their users, games and fighters
+    source_kb -- the size of the source of every bot
+    """
+    source = "#" * (source_kb * 1024) if source_kb else None
+    users = size // BOTS_PER_USER
+    engine.execute(entity.User.__table__.insert(), [
+        {"id": i + 1, "name": "user%d" % i, "rights": "USER"}
+        for i in range(users)])
+    engine.execute(entity.Game.__table__.insert(), [
+        {"id": i + 1, "name": "game%d" % i} for i in range(GAMES)])
+    engine.execute(entity.Bot.__table__.insert(), [
+        {"id": i + 1, "name": "bot%d" % (i % BOTS_PER_USER),
+         "author_id": i // BOTS_PER_USER + 1, "game_id": i % GAMES + 1,
+         "rating": 1000 + i % 1000, "version": 1, "source": source}
+        for i in range(size)])
+    engine.execute(entity.Fighter.__table__.insert(), [
+        {"bot_id": i // FIGHTERS_PER_BOT + 1,
+         "battle_id": i // 2 + 1, "battle_place": i % 2}
+        for i in range(size * FIGHTERS_PER_BOT)])
+
+
+def lookups(size):
+    """
+    The lookups of the services, as (name, query function) pairs
+    """
+    users = size // BOTS_PER_USER
+
+    def user(session):
+        return session.query(entity.User).\
+            filter_by(name="user%d" % random.randrange(users)).first()
+
+    def game(session):
+        return session.query(entity.Game).\
+            filter_by(name="game%d" % random.randrange(GAMES)).first()
+
+    def bot(session):
+        return session.query(entity.Bot).filter_by(
+            name="bot%d" % random.randrange(BOTS_PER_USER),
+            author_id=random.randrange(users) + 1).first()
+
+    def fighters(session):
+        return session.query(entity.Fighter).\
+            filter_by(bot_id=random.randrange(size) + 1).all()
+
+    return (("user by name", user), ("game by name", game),
+            ("bot by author and name", bot), ("fighters of bot", fighters))
+
+
+def explain(engine, query):
+    """
+    The SQLite query plan of a query
+    """
+    statement = query.statement.compile(
+        engine, compile_kwargs={"literal_binds": True})
+    rows = engine.execute("EXPLAIN QUERY PLAN " + str(statement))
+    return "; ".join(row[-1] for row in rows)
+
+
+def load_all(session, sources):
+    """
+    The time in microseconds and the peak of the memory in bytes of loading
+    all bots, with or without their sources
+    """
+    query = session.query(entity.Bot)
+    if sources:
+        query = query.options(undefer("source"))
+    tracemalloc.start()
+    start = time.perf_counter()
+    bots = query.all()
+    micros = (time.perf_counter() - start) * 1e6
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del bots
+    session.expunge_all()
+    return micros, peak
+
+
+def run_sources(sizes=SIZES, source_kb=SOURCE_KB, out=sys.stdout):
+    """
+    Measures loading all bots of a new database of every size, with
+    sources of source_kb kilobytes
+    Returns the microseconds and the peak bytes, by size and by whether the
+    sources were loaded.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            path = os.path.join(temp_dir, "sources%d.db" % size)
+            engine = entity.create_db_engine("sqlite:///" + path)
+            entity.Base.metadata.create_all(engine)
+            fill(engine, size, source_kb)
+            session = sessionmaker(bind=engine)()
+            results[size] = {}
+            for sources in (False, True):
+                micros, peak = load_all(session, sources)
+                results[size][sources] = (micros, peak)
+                print("%8d  %-24s %10.1f ms %10.1f MB" % (
+                    size, "all bots with sources" if sources else "all bots",
+                    micros / 1000, peak / 2 ** 20), file=out)
+            session.close()
+            engine.dispose()
+    return results
+
+
+def run(sizes=SIZES, count=LOOKUPS, indexes=True, plan=False,
+        out=sys.stdout):
+    """
+    Times count lookups of every kind on a new database of every size
+    Returns the microseconds per lookup, by size and lookup name.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            path = os.path.join(temp_dir, "bench%d.db" % size)
+            engine = entity.create_db_engine("sqlite:///" + path)
+            entity.Base.metadata.create_all(engine)
+            if not indexes:
+                for table in entity.Base.metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.drop(engine)
+            fill(engine, size)
+            session = sessionmaker(bind=engine)()
+            results[size] = {}
+            for name, lookup in lookups(size):
+                start = time.perf_counter()
+                for _ in range(count):
+                    lookup(session)
+                    session.expunge_all()
+                micros = (time.perf_counter() - start) * 1e6 / count
+                results[size][name] = micros
+                print("%8d  %-24s %10.1f us" % (size, name, micros),
+                      file=out)
+            if plan:
+                print(explain(engine, session.query(
+                    entity.Bot).filter_by(name="bot1", author_id=1)),
+                    file=out)
+            session.close()
+            engine.dispose()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measures the lookups on databases of growing size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='the numbers of bots')
+    parser.add_argument('--lookups', type=int, default=LOOKUPS)
+    parser.add_argument('--no-indexes', action='store_true',
+                        help='drop the indexes to compare')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the query plan of the bot lookup')
+    parser.add_argument('--sources', type=int, metavar='KB',
+                        help='measure loading all bots with sources of KB '
+                        'kilobytes instead')
+    args = parser.parse_args(argv)
+    if args.sources is not None:
+        run_sources(args.sizes, args.sources)
+    else:
+        run(args.sizes, args.lookups, not args.no_indexes, args.plan)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,12 @@
-from sqlalchemy import create_engine, UnicodeText, Table
+import contextlib
+from sqlalchemy import create_engine, event, UnicodeText, Table
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, VARCHAR, Sequence, ForeignKey
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Index
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
-
-db_engine = create_engine('sqlite:///test1.db')
+from sqlalchemy.orm import deferred
+from sqlalchemy.engine.url import make_url
+from battleground import config
 
 Base = declarative_base()
 
@@ -21,15 +24,78 @@ class Fighter(Base):
     battle_id = Column(Integer, ForeignKey('battles.id'))
     battle = relationship("Battle", back_populates="fighters")
 
+    __table_args__ = (
+        Index('ix_fighters_bot_id', 'bot_id'),
+        Index('ix_fighters_battle_id', 'battle_id'),
+    )
+
 
 class Battle(Base):
     __tablename__ = "battles"
 
     id = Column(Integer, Sequence('battle_id_seq'), primary_key=True)
     state = Column(String)
+    # whether the battle changed the ratings and when it concluded,
+    # the order in which the ratings are replayed
+    ranked = Column(Boolean)
+    concluded_at = Column(DateTime)
+    # the record of the moves of the battle in the move log, if the game
+    # listed its moves
+    log_offset = Column(BigInteger)
+    log_size = Column(Integer)
 
     fighters = relationship("Fighter", back_populates="battle")
 
+    # the tournament and its round, for the battles of tournaments
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'))
+    tournament = relationship("Tournament", back_populates="battles")
+    round = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_battles_state_concluded_at', 'state', 'concluded_at'),
+        Index('ix_battles_tournament_id_round', 'tournament_id', 'round'),
+    )
+
+
+# the resources a battle used, measured by the sandbox worker
+class BattleStats(Base):
+    __tablename__ = "battle_stats"
+
+    battle_id = Column(Integer, ForeignKey('battles.id'), primary_key=True)
+    # seconds of the battle and of the CPU, the peak memory of the worker,
+    # the CPU time and the memory are NULL for the battles run by codejail
+    wall_time = Column(Float)
+    cpu_time = Column(Float)
+    peak_rss_mb = Column(Float)
+
+    def __repr__(self):
+        return "<BattleStats(battle=[%s], wall=[%s], cpu=[%s], rss=[%s])>" \
+            % (self.battle_id, self.wall_time, self.cpu_time,
+               self.peak_rss_mb)
+
+
+# the get_move calls of a bot in a battle
+class MoveStats(Base):
+    __tablename__ = "move_stats"
+
+    battle_id = Column(Integer, ForeignKey('battles.id'), primary_key=True)
+    bot_id = Column(Integer, ForeignKey('bots.id'), primary_key=True)
+    moves = Column(Integer)
+    # seconds of all calls and of the slowest one
+    total_time = Column(Float)
+    max_time = Column(Float)
+    # the numbers of calls in the buckets of MOVE_BUCKETS_MS of the sandbox
+    # worker, separated by commas
+    histogram = Column(String)
+
+    __table_args__ = (
+        Index('ix_move_stats_bot_id', 'bot_id'),
+    )
+
+    def __repr__(self):
+        return "<MoveStats(battle=[%s], bot=[%s], moves=[%s])>" % \
+            (self.battle_id, self.bot_id, self.moves)
+
 
 class Bot(Base):
     __tablename__ = "bots"
@@ -39,7 +105,10 @@ class Bot(Base):
     version = Column(Integer)
     name = Column(String)
     rating = Column(Integer)
-    source = Column(UnicodeText())
+    # the sources are loaded when they are used, or undeferred by the query
+    source = deferred(Column(UnicodeText()))
+    # the number of concluded battles
+    battles = Column(Integer, default=0)
 
     game_id = Column(Integer, ForeignKey('games.id'))
     game = relationship("Game", back_populates="bots")
@@ -50,27 +119,37 @@ class Bot(Base):
 
     fighters = relationship("Fighter", back_populates="bot")
 
-    def to_fighter(self, battle):
-        return Fighter(
-            bot_version=self.version,
-            battle_place=-1,
-            bot=self,
-            battle=battle)
+    __table_args__ = (
+        Index('ix_bots_author_id_name', 'author_id', 'name', unique=True),
+        Index('ix_bots_game_id_rating', 'game_id', 'rating'),
+    )
 
     def __eq__(self, other):
         return self.name == other.name and self.author_id == other.author_id
 
     def __repr__(self):
-        return "<Bot(name=[%s], author=[%s], source=[%s], version=[%s]"\
-            ", rating=[%s])>" % \
-            (self.name, self.author, self.source, self.version, self.rating)
+        return "<Bot(name=[%s], author=[%s], version=[%s], rating=[%s])>" % \
+            (self.name, self.author, self.version, self.rating)
+
+
+# the number of concluded battles between two bots, bot_id1 < bot_id2
+class HeadToHead(Base):
+    __tablename__ = "head_to_head"
+
+    bot_id1 = Column(Integer, ForeignKey('bots.id'), primary_key=True)
+    bot_id2 = Column(Integer, ForeignKey('bots.id'), primary_key=True)
+    battles = Column(Integer)
+
+    def __repr__(self):
+        return "<HeadToHead(bots=[%s, %s], battles=[%s])>" % \
+            (self.bot_id1, self.bot_id2, self.battles)
 
 
 class Game(Base):
     __tablename__ = "games"
 
     id = Column(Integer, Sequence('game_id_seq'), primary_key=True)
-    source = Column(UnicodeText())
+    source = deferred(Column(UnicodeText()))
     name = Column(String)
     author_id = Column(Integer, ForeignKey('users.id'))
     author = relationship("User", back_populates="games")
@@ -78,12 +157,15 @@ class Game(Base):
 
     bots = relationship("Bot", order_by=Bot.rating)
 
+    __table_args__ = (
+        Index('ix_games_name', 'name', unique=True),
+    )
+
     def __eq__(self, other):
         return self.name == other.name
 
     def __repr__(self):
-        return "<Game(name=[%s], author=[%s], source=[%s])>" % \
-            (self.name, self.author, self.source)
+        return "<Game(name=[%s], author=[%s])>" % (self.name, self.author)
 
 
 class User(Base):
@@ -96,6 +178,10 @@ class User(Base):
     games = relationship("Game", order_by=Game.id)
     bots = relationship("Bot", order_by=Bot.rating)
 
+    __table_args__ = (
+        Index('ix_users_name', 'name', unique=True),
+    )
+
     def __eq__(self, other):
         return self.name == other.name
 
@@ -103,8 +189,136 @@ class User(Base):
         return "<User(id='%s', name=[%s], password=[********])>" % \
             (self.id, self.name)
 
-Base.metadata.bind = db_engine
-Base.metadata.create_all()
 
-session_factory = sessionmaker(bind=db_engine)
+class TournamentEntry(Base):
+    __tablename__ = "tournament_entries"
+
+    id = Column(Integer, Sequence('tournament_entry_id_seq'), primary_key=True)
+    seed = Column(Integer)
+    points = Column(Float)
+    played = Column(Integer)
+    byes = Column(Integer)
+
+    tournament_id = Column(Integer, ForeignKey('tournaments.id'))
+    tournament = relationship("Tournament", back_populates="entries")
+
+    bot_id = Column(Integer, ForeignKey('bots.id'))
+    bot = relationship("Bot")
+
+    __table_args__ = (
+        Index('ix_tournament_entries_tournament_id', 'tournament_id'),
+    )
+
+    def __repr__(self):
+        return "<TournamentEntry(bot=[%s], seed=[%s], points=[%s])>" % \
+            (self.bot_id, self.seed, self.points)
+
+
+class Tournament(Base):
+    __tablename__ = "tournaments"
+
+    id = Column(Integer, Sequence('tournament_id_seq'), primary_key=True)
+    name = Column(String)
+    kind = Column(String)
+    state = Column(String)
+    ranked = Column(Boolean)
+    rounds = Column(Integer)
+    # the number of finished rounds
+    current_round = Column(Integer)
+
+    game_id = Column(Integer, ForeignKey('games.id'))
+    game = relationship("Game")
+    author_id = Column(Integer, ForeignKey('users.id'))
+    author = relationship("User")
+
+    entries = relationship("TournamentEntry", back_populates="tournament",
+                           order_by=TournamentEntry.seed)
+    battles = relationship("Battle", back_populates="tournament")
+
+    __table_args__ = (
+        Index('ix_tournaments_name', 'name', unique=True),
+    )
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __repr__(self):
+        return "<Tournament(name=[%s], kind=[%s], state=[%s], round=[%s])>" % \
+            (self.name, self.kind, self.state, self.current_round)
+
+
+def _set_sqlite_pragmas(connection, connection_record):
+    # readers don't wait for the writer and the writer doesn't sync
+    # every commit, the battle workers wait for each other's writes
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % config.SQLITE_BUSY_TIMEOUT)
+    cursor.close()
+
+
+def create_db_engine(url=None):
+    """
+    Creates the engine of the database at url, the configured one by
+    default, with the pool or the SQLite settings from the config
+    """
+    url = make_url(url or config.DATABASE_URL)
+    if url.get_backend_name() == 'sqlite':
+        engine = create_engine(url, echo=config.SQL_ECHO)
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+    else:
+        engine = create_engine(
+            url,
+            echo=config.SQL_ECHO,
+            pool_size=config.POOL_SIZE,
+            max_overflow=config.MAX_OVERFLOW,
+            pool_timeout=config.POOL_TIMEOUT,
+            pool_recycle=config.POOL_RECYCLE)
+    return engine
+
+
+def configure(url=None):
+    """
+    Binds the sessions to the database at url, the configured one by
+    default
+    Connections are opened when the sessions need them.
+    """
+    global db_engine
+    session.remove()
+    if db_engine is not None:
+        db_engine.dispose()
+    db_engine = create_db_engine(url)
+    Base.metadata.bind = db_engine
+    session_factory.configure(bind=db_engine)
+    return db_engine
+
+
+@contextlib.contextmanager
+def session_scope():
+    """
+    A new session for a unit of work, committed when it ends or rolled
+    back if it raises
+    """
+    new_session = session_factory()
+    try:
+        yield new_session
+        new_session.commit()
+    except BaseException:
+        new_session.rollback()
+        raise
+    finally:
+        new_session.close()
+
+
+def init_db():
+    """
+    Creates the tables which the database does not have yet, see
+    battleground.migrate for the changes of the existing tables
+    """
+    Base.metadata.create_all(db_engine)
+
+
+db_engine = None
+session_factory = sessionmaker()
 session = scoped_session(session_factory)
+configure()
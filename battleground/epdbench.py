@@ -0,0 +1,163 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+try:
+    import sunfish
+    import tools
+except ImportError:
+    # imported as part of the battleground package
+    from battleground import sunfish, tools
+
+###############################################################################
+# Solves the positions of an EPD test suite, e.g. WAC or the Bratko-Kopec
+# test, and reports how many of them the engine gets right, how soon and at
+# what speed. Running the same suite on two versions of the engine compares
+# their strength per CPU.
+#   python -m battleground.epdbench suite.epd --secs 1 --report report.json
+#   python -m battleground.epdbench suite.epd --depth 6 --processes 4
+###############################################################################
+
+SECS = 1
+REPORT = 'epdbench.json'
+
+
+def parse_operations(operations):
+    ''' The opcodes of an EPD line with their operands, as a dict '''
+    result = {}
+    for operation in operations:
+        parts = operation.split(maxsplit=1)
+        if parts:
+            result[parts[0]] = parts[1] if len(parts) > 1 else ''
+    return result
+
+
+def load_epd(path):
+    ''' Yields the fen and the operations of every position in an EPD file '''
+    with open(path) as epd_file:
+        for line in epd_file:
+            if line.strip() and not line.startswith('#'):
+                fen, operations = tools.parseEPD(line)
+                yield fen, parse_operations(operations)
+
+
+def parse_moves(pos, operand):
+    ''' The moves in an operand of bm or am, skipping unknown ones '''
+    moves = set()
+    for msan in operand.split():
+        try:
+            moves.add(tools.parseSAN(pos, msan))
+        except AssertionError:
+            pass
+    return moves
+
+
+def solve(task):
+    """
+    Searches a position until secs seconds or depth plies are reached.
+    A move counts as found from the iteration after which the engine stays
+    with good moves, so the time to solution is None for a failed position.
+    """
+    fen, operations, secs, depth, table_mb = task
+    pos = tools.parseFEN(fen)
+    best = parse_moves(pos, operations.get('bm', ''))
+    avoid = parse_moves(pos, operations.get('am', ''))
+    searcher = sunfish.Searcher(table_mb=table_mb)
+    found = None
+    start = time.time()
+    for _ in searcher._search(pos):
+        elapsed = time.time() - start
+        move = searcher.probe_move(pos)
+        good = move is not None and move not in avoid and (
+            not best or move in best)
+        if not good:
+            found = None
+        elif found is None:
+            found = elapsed
+        if depth:
+            if searcher.depth >= depth:
+                break
+        elif elapsed > secs and searcher.depth >= 2:
+            break
+    elapsed = max(time.time() - start, 1e-6)
+    return {
+        'id': operations.get('id', fen),
+        'fen': fen,
+        'bm': operations.get('bm'),
+        'am': operations.get('am'),
+        'move': tools.mrender(pos, move) if move else None,
+        'solved': found is not None,
+        'time_to_solution': found,
+        'depth': searcher.depth,
+        'nodes': searcher.nodes,
+        'secs': elapsed,
+        'nps': searcher.nodes / elapsed,
+    }
+
+
+def run(path, secs=SECS, depth=None, processes=1, table_mb=sunfish.TABLE_MB,
+        out=sys.stdout):
+    """
+    Solves every position of the EPD file at path, printing a line for
+    each one. Returns the report with the results and their summary.
+    """
+    tasks = [(fen, operations, secs, depth, table_mb)
+             for fen, operations in load_epd(path)]
+    print('%-24s %-6s %-6s %5s %8s %8s %10s' % (
+        'id', 'move', 'solved', 'depth', 'secs', 'found', 'nodes/s'),
+        file=out)
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(solve, tasks):
+            results.append(result)
+            found = result['time_to_solution']
+            print('%-24s %-6s %-6s %5d %8.2f %8s %10d' % (
+                result['id'][:24], result['move'], result['solved'],
+                result['depth'], result['secs'],
+                '-' if found is None else '%.2f' % found, result['nps']),
+                file=out)
+    solved = sum(result['solved'] for result in results)
+    nodes = sum(result['nodes'] for result in results)
+    cpu_secs = sum(result['secs'] for result in results)
+    summary = {
+        'suite': path,
+        'secs': None if depth else secs,
+        'depth': depth,
+        'positions': len(results),
+        'solved': solved,
+        'solve_rate': solved / len(results) if results else 0,
+        'nodes': nodes,
+        'nps': nodes / max(cpu_secs, 1e-6),
+    }
+    print('solved %d of %d (%.1f%%), %d nodes/s' % (
+        solved, len(results), 100 * summary['solve_rate'], summary['nps']),
+        file=out)
+    return {'summary': summary, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Solves the positions of an EPD test suite')
+    parser.add_argument('path', help='the EPD file')
+    parser.add_argument('--secs', type=float, default=SECS,
+                        help='seconds per position')
+    parser.add_argument('--depth', type=int,
+                        help='search every position to this depth instead')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--table-mb', type=int, default=sunfish.TABLE_MB,
+                        help='transposition table size of every search')
+    parser.add_argument('--report', default=REPORT,
+                        help='where to save the JSON report')
+    args = parser.parse_args(argv)
+
+    report = run(args.path, args.secs, args.depth, args.processes,
+                 args.table_mb)
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
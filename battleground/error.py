@@ -53,3 +53,27 @@ class NotReadyBotError(BattleGroundError):
 
 class InvalidBotError(BattleGroundError):
     pass
+
+
+class SandboxError(BattleGroundError):
+    pass
+
+
+class BattleQueueFullError(BattleGroundError):
+    pass
+
+
+class BattleNotExistsError(BattleGroundError):
+    pass
+
+
+class TournamentExistsError(BattleGroundError):
+    pass
+
+
+class TournamentNotExistsError(BattleGroundError):
+    pass
+
+
+class TournamentRoundError(BattleGroundError):
+    pass
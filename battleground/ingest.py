@@ -0,0 +1,116 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+###############################################################################
+# Writes the results of the battles in batches.
+# The battle workers put the conclusions of their battles in a queue and a
+# single thread takes them out in batches, which it writes to the database
+# in one transaction. A batch is written once it has BATCH_SIZE conclusions
+# or FLUSH_INTERVAL seconds after its first one, so under load the database
+# sees one writer and one commit per batch instead of one per battle.
+###############################################################################
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.05
+
+# The result of a battle: the final order of its fighters, whether it is
+# ranked, the moves listed by the game, when it concluded and the resources
+# it used
+Conclusion = collections.namedtuple(
+    'Conclusion', 'battle_id final_order ranked moves concluded_at stats')
+
+
+class IngestionPipeline:
+    """
+    IngestionPipeline passes batches of the put records to flush in a
+    thread of its own and returns a concurrent.futures.Future for every
+    record, which is done once its batch is written.
+    If flush fails for a batch, its records are flushed one by one, so only
+    the futures of the failing records get the error.
+    """
+
+    def __init__(self, flush, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._shutdown = False
+        self._thread = threading.Thread(
+            target=self._work, name="battle-ingestion", daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        """
+        Queues the record and returns the future of its flush
+        """
+        if self._shutdown:
+            raise RuntimeError("Ingestion pipeline is shut down")
+        future = concurrent.futures.Future()
+        self._queue.put((future, record))
+        return future
+
+    def pending(self):
+        """
+        The number of records waiting in the queue
+        """
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the pipeline once it flushes the queued records
+        """
+        if not self._shutdown:
+            self._shutdown = True
+            self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _work(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch):
+        batch = [(future, record) for future, record in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            self._flush([record for _, record in batch])
+        except BaseException as error:
+            if len(batch) == 1:
+                batch[0][0].set_exception(error)
+                return
+            for item in batch:
+                self._flush_batch_item(item)
+        else:
+            for future, _ in batch:
+                future.set_result(None)
+
+    def _flush_batch_item(self, item):
+        future, record = item
+        try:
+            self._flush([record])
+        except BaseException as error:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
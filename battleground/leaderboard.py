@@ -0,0 +1,92 @@
+import bisect
+import collections
+import threading
+
+###############################################################################
+# An in memory leaderboard of the bots of every game.
+# The bots of a game are kept sorted from the highest rating, so the rank of
+# a bot is found by a binary search and the top bots or a page of them are a
+# slice of the list. Bots with the same rating share a rank, the next rank
+# counts all bots before it (1, 2, 2, 4).
+###############################################################################
+
+# Bots on a page of the leaderboard
+PAGE_SIZE = 20
+
+# A row of the leaderboard
+Ranking = collections.namedtuple('Ranking', 'rank bot_id rating')
+
+
+class Leaderboard:
+    """
+    Leaderboard keeps (-rating, bot_id) pairs per game in sorted lists
+    It is safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._games = collections.defaultdict(list)
+        self._bots = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bots)
+
+    def __contains__(self, bot_id):
+        return bot_id in self._bots
+
+    def update(self, bot_id, game_id, rating):
+        """
+        Adds a bot or moves it to its new rating
+        """
+        with self._lock:
+            self._remove(bot_id)
+            bisect.insort(self._games[game_id], (-rating, bot_id))
+            self._bots[bot_id] = (game_id, rating)
+
+    def remove(self, bot_id):
+        with self._lock:
+            self._remove(bot_id)
+
+    def count(self, game_id):
+        """
+        The number of bots of the game
+        """
+        with self._lock:
+            return len(self._games.get(game_id, ()))
+
+    def rank(self, bot_id):
+        """
+        The Ranking of the bot, or None if it is not on the leaderboard
+        """
+        with self._lock:
+            if bot_id not in self._bots:
+                return None
+            game_id, rating = self._bots[bot_id]
+            return Ranking(self._rank(self._games[game_id], rating),
+                           bot_id, rating)
+
+    def top(self, game_id, count):
+        """
+        The Rankings of the count bots of the game with the highest rating
+        """
+        return self.page(game_id, 0, count)
+
+    def page(self, game_id, page, size=PAGE_SIZE):
+        """
+        The Rankings on a page of the leaderboard of the game, counting the
+        pages from 0
+        """
+        with self._lock:
+            bots = self._games.get(game_id, [])
+            return [Ranking(self._rank(bots, -rating), bot_id, -rating)
+                    for rating, bot_id in bots[page * size:(page + 1) * size]]
+
+    def _rank(self, bots, rating):
+        # the bots with a higher rating go first
+        return bisect.bisect_left(bots, (-rating, -1)) + 1
+
+    def _remove(self, bot_id):
+        if bot_id in self._bots:
+            game_id, rating = self._bots.pop(bot_id)
+            bots = self._games[game_id]
+            del bots[bisect.bisect_left(bots, (-rating, bot_id))]
@@ -0,0 +1,97 @@
+import bisect
+import collections
+import threading
+
+###############################################################################
+# An in memory index of the bots ready for matchmaking.
+# The bots of every game are kept sorted by rating, so the nearest opponent
+# is found by a binary search instead of a scan of all bots. The index also
+# remembers the last opponents of every bot, to avoid pairing them again.
+###############################################################################
+
+# How many of the last opponents of a bot are not paired with it again
+RECENT_OPPONENTS = 3
+
+
+class MatchmakingIndex:
+    """
+    MatchmakingIndex keeps (rating, bot_id) pairs per game in sorted lists
+    It is safe to use from several threads.
+    """
+
+    def __init__(self, recent_opponents=RECENT_OPPONENTS):
+        self.recent_opponents = recent_opponents
+        self._games = collections.defaultdict(list)
+        self._bots = {}
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bots)
+
+    def __contains__(self, bot_id):
+        return bot_id in self._bots
+
+    def update(self, bot_id, game_id, rating, ready=True):
+        """
+        Adds a bot or moves it to its new rating, or removes it when it
+        is not ready for matchmaking any more
+        """
+        with self._lock:
+            self._remove(bot_id)
+            if ready:
+                bisect.insort(self._games[game_id], (rating, bot_id))
+                self._bots[bot_id] = (game_id, rating)
+
+    def remove(self, bot_id):
+        with self._lock:
+            self._remove(bot_id)
+            self._recent.pop(bot_id, None)
+
+    def played(self, bot_id, opponent_id):
+        """
+        Records a battle between two bots
+        """
+        with self._lock:
+            for bot, opponent in ((bot_id, opponent_id),
+                                  (opponent_id, bot_id)):
+                recent = self._recent.setdefault(
+                    bot, collections.deque(maxlen=self.recent_opponents))
+                recent.append(opponent)
+
+    def nearest(self, game_id, rating, max_rating_diff, bot_id=None,
+                exclude=()):
+        """
+        Returns the id of the bot of the game with the rating nearest to
+        rating, at most max_rating_diff away, or None if there is none
+        The bot_id, its recent opponents and the bots in exclude are skipped.
+        """
+        with self._lock:
+            skip = set(exclude)
+            skip.add(bot_id)
+            skip.update(self._recent.get(bot_id, ()))
+            bots = self._games.get(game_id, [])
+            # walk away from the rating in both directions at once
+            high = bisect.bisect_left(bots, (rating, -1))
+            low = high - 1
+            while True:
+                below = rating - bots[low][0] if low >= 0 else None
+                above = bots[high][0] - rating if high < len(bots) else None
+                if below is None and above is None:
+                    return None
+                if above is None or (below is not None and below <= above):
+                    diff, (_, opponent_id) = below, bots[low]
+                    low -= 1
+                else:
+                    diff, (_, opponent_id) = above, bots[high]
+                    high += 1
+                if diff > max_rating_diff:
+                    return None
+                if opponent_id not in skip:
+                    return opponent_id
+
+    def _remove(self, bot_id):
+        if bot_id in self._bots:
+            game_id, rating = self._bots.pop(bot_id)
+            bots = self._games[game_id]
+            del bots[bisect.bisect_left(bots, (rating, bot_id))]
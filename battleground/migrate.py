@@ -0,0 +1,85 @@
+import argparse
+import sys
+import warnings
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.schema import CreateIndex
+
+###############################################################################
+# Brings the schema of an existing database up to date with the entities.
+# create_all only creates the missing tables, so the columns and indexes
+# added to the existing tables later are added here. The new columns are
+# nullable and the code treats NULL as their old default.
+#   python -m battleground.migrate
+###############################################################################
+
+
+def missing_columns(inspector, table):
+    """
+    The columns of the table which the database does not have
+    """
+    existing = {column['name'] for column in inspector.get_columns(
+        table.name)}
+    return [column for column in table.columns
+            if column.name not in existing]
+
+
+def missing_indexes(inspector, table):
+    """
+    The indexes of the table which the database does not have
+    """
+    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+    return [index for index in table.indexes if index.name not in existing]
+
+
+def upgrade(engine, metadata):
+    """
+    Creates the missing tables and adds the missing columns and indexes of
+    the existing ones
+    Unique indexes which the stored rows violate are skipped with a warning.
+    Returns the names of the added columns and indexes.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        for column in missing_columns(inspector, table):
+            column_type = column.type.compile(dialect=engine.dialect)
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name, column_type))
+            added.append('%s.%s' % (table.name, column.name))
+        for index in missing_indexes(inspector, table):
+            try:
+                engine.execute(CreateIndex(index))
+            except (IntegrityError, OperationalError) as error:
+                warnings.warn("Index [%s] was not created: %s" % (
+                    index.name, error.orig))
+                continue
+            added.append(index.name)
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Upgrades the schema of the database')
+    parser.parse_args(argv)
+
+    import battleground.entity as entity
+    from battleground.service import ServiceFactory
+
+    added = upgrade(entity.db_engine, entity.Base.metadata)
+    for name in added:
+        print("added %s" % name)
+    if 'bots.battles' in added:
+        # the counters of the fair factor start from the stored battles
+        ServiceFactory.get_battle_service().count_battles()
+        print("counted the battles of the bots")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+###############################################################################
+# A directory of the modules used by the battles, e.g. the bot sources.
+# Every set of modules is kept in a directory named by the hash of their
+# names and sources, together with its bytecode, so a bot version is written
+# and compiled once and the battles only add the directory to their path.
+# The directories are read only and never change once they are created.
+# Others have no access. The group, e.g. of a sandbox user, can read the
+# directories whose names it knows but can't list the root, so a battle
+# reaches the directories of its own bots only. The hashes of the other
+# bots can't be guessed without their sources.
+###############################################################################
+
+READ_ONLY_FILE = stat.S_IRUSR | stat.S_IRGRP
+READ_ONLY_DIR = READ_ONLY_FILE | stat.S_IXUSR | stat.S_IXGRP
+ROOT_DIR = stat.S_IRWXU | stat.S_IXGRP
+
+
+class ModuleStore:
+    """
+    ModuleStore keeps modules under root, compiled by the python interpreter
+    which executes the battles
+    """
+
+    def __init__(self, root, python=sys.executable):
+        self.root = root
+        self.python = python
+        os.makedirs(root, mode=ROOT_DIR, exist_ok=True)
+        # the modules of other users could be imported by the battles
+        if os.lstat(root).st_uid != os.getuid():
+            raise PermissionError(
+                "Module store [%s] is not owned by this user" % root)
+        os.chmod(root, ROOT_DIR)
+
+    @staticmethod
+    def key(modules):
+        """
+        The hash of a dict of module names and sources
+        """
+        digest = hashlib.sha256()
+        for name, source in sorted(modules.items()):
+            for part in (name, source):
+                data = part.encode('utf-8')
+                digest.update(b'%d:' % len(data) + data)
+        return digest.hexdigest()
+
+    def add(self, modules):
+        """
+        Stores a dict of module names and sources, unless it is stored
+        already, and returns the directory to put on the python path
+        """
+        path = os.path.join(self.root, self.key(modules))
+        if os.path.isdir(path):
+            return path
+        # the modules are prepared next to their place and moved there at
+        # once, so nobody sees them half written
+        temp_dir = tempfile.mkdtemp(prefix='.new-', dir=self.root)
+        try:
+            for name, source in modules.items():
+                file_name = os.path.join(temp_dir, name + '.py')
+                with open(file_name, 'w', encoding='utf-8') as module_file:
+                    module_file.write(source)
+            # modules with syntax errors fail when the battle imports them
+            subprocess.call(
+                [self.python, '-m', 'compileall', '-q', temp_dir],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            os.rename(temp_dir, path)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            # the same modules were stored by another battle meanwhile
+            if os.path.isdir(path):
+                return path
+            raise
+        self._make_read_only(path)
+        return path
+
+    def _make_read_only(self, path):
+        for directory, _, files in os.walk(path, topdown=False):
+            for file_name in files:
+                os.chmod(os.path.join(directory, file_name), READ_ONLY_FILE)
+            os.chmod(directory, READ_ONLY_DIR)
@@ -0,0 +1,112 @@
+import fcntl
+import os
+import struct
+import threading
+import zlib
+
+###############################################################################
+# An append only log of the moves of the battles.
+# A game lists its moves as numbers below 2 ** 16, e.g. the chess moves of
+# tools.mencode, and every battle is stored as one record of 2 bytes per
+# move compressed by zlib. The battle keeps the offset and the size of its
+# record, so a battle is read with one seek from the log of all battles.
+# The records start with the id of their battle, which is checked on read
+# and lets the offsets be found again by reading the log from the start.
+###############################################################################
+
+MAGIC = b'BGML'
+# magic, battle id, size of the compressed moves
+RECORD = struct.Struct('<4sQI')
+MOVE = struct.Struct('<H')
+
+COMPRESS_LEVEL = 6
+
+
+class MoveLogError(Exception):
+    pass
+
+
+def pack(moves):
+    """
+    The compressed 2 byte encoding of a list of moves
+    """
+    try:
+        data = struct.pack('<%dH' % len(moves), *moves)
+    except struct.error:
+        raise MoveLogError("Moves must be numbers from 0 to 65535")
+    return zlib.compress(data, COMPRESS_LEVEL)
+
+
+def unpack(data):
+    """
+    The list of moves of data from pack
+    """
+    data = zlib.decompress(data)
+    return [move for move, in MOVE.iter_unpack(data)]
+
+
+class MoveLog:
+    """
+    MoveLog appends the moves of battles to the file at path and reads
+    them back by offset
+    Appends are serialized by a lock on the file, so several processes can
+    share a log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def append(self, battle_id, moves):
+        """
+        Adds the moves of a battle to the end of the log
+        Returns the offset and the size of the record.
+        """
+        data = pack(moves)
+        record = RECORD.pack(MAGIC, battle_id, len(data)) + data
+        with self._lock, open(self.path, 'ab') as log_file:
+            fcntl.flock(log_file, fcntl.LOCK_EX)
+            try:
+                offset = log_file.seek(0, os.SEEK_END)
+                log_file.write(record)
+                log_file.flush()
+            finally:
+                fcntl.flock(log_file, fcntl.LOCK_UN)
+        return offset, len(record)
+
+    def read(self, battle_id, offset, size):
+        """
+        The moves of the battle from the record at offset
+        """
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(offset)
+            record = log_file.read(size)
+        if len(record) != size or size < RECORD.size:
+            raise MoveLogError("Record of battle [%s] is cut short" %
+                               battle_id)
+        magic, record_battle, data_size = RECORD.unpack_from(record)
+        if magic != MAGIC or record_battle != battle_id or \
+                data_size != size - RECORD.size:
+            raise MoveLogError("No record of battle [%s] at [%s]" %
+                               (battle_id, offset))
+        return unpack(record[RECORD.size:])
+
+    def scan(self):
+        """
+        Yields the battle id, the offset and the size of every record, in
+        the order they were appended, e.g. to find the offsets again
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as log_file:
+            offset = 0
+            while True:
+                header = log_file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                magic, battle_id, data_size = RECORD.unpack(header)
+                if magic != MAGIC:
+                    raise MoveLogError("No record at [%s]" % offset)
+                yield battle_id, offset, RECORD.size + data_size
+                offset = log_file.seek(data_size, os.SEEK_CUR)
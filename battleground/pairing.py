@@ -0,0 +1,95 @@
+import math
+
+###############################################################################
+# Pairings of the tournament rounds.
+# The players are any hashable keys, e.g. the ids of the tournament entries,
+# listed by seed or by standing. A pair (a, b) puts a first in the battle.
+###############################################################################
+
+# Steps of the Swiss pairing search before it allows rematches
+SWISS_SEARCH_STEPS = 10000
+
+
+def round_robin_rounds(count, double=False):
+    """
+    The number of rounds of a round robin of count players
+    """
+    rounds = count - 1 if count % 2 == 0 else count
+    return 2 * rounds if double else rounds
+
+
+def swiss_rounds(count):
+    """
+    The usual number of Swiss rounds, enough to find a single winner
+    """
+    return max(1, math.ceil(math.log2(max(count, 2))))
+
+
+def round_robin(players, round):
+    """
+    Pairs the players in round (counting from 0) of a round robin, by the
+    circle method: the first player stays in place and the others rotate.
+    The rounds after the first cycle repeat it with swapped sides.
+    Returns the pairs and the player with a bye, if the count is odd.
+    """
+    players = list(players)
+    if len(players) % 2:
+        players.append(None)
+    count = len(players)
+    cycle = count - 1
+    r = round % cycle
+    others = players[1:]
+    circle = [players[0]] + others[cycle - r:] + others[:cycle - r]
+    pairs, bye = [], None
+    for i in range(count // 2):
+        a, b = circle[i], circle[count - 1 - i]
+        # the fixed player changes side every round
+        if i == 0 and r % 2:
+            a, b = b, a
+        if round >= cycle:
+            a, b = b, a
+        if a is None or b is None:
+            bye = a if b is None else b
+        else:
+            pairs.append((a, b))
+    return pairs, bye
+
+
+def swiss(standings, played=(), byes=()):
+    """
+    Pairs a Swiss round: the players ordered by their standing meet the
+    next players in the order they haven't met yet. With an odd count the
+    lowest player without a bye sits out.
+    played -- the pairs that met already, as frozensets
+    byes -- the players that had a bye already
+    Returns the pairs and the player with a bye.
+    """
+    players = list(standings)
+    played = set(played)
+    bye = None
+    if len(players) % 2:
+        without_bye = [p for p in players if p not in byes]
+        bye = without_bye[-1] if without_bye else players[-1]
+        players.remove(bye)
+    steps = [SWISS_SEARCH_STEPS]
+
+    def pair(rest):
+        if not rest:
+            return []
+        first, others = rest[0], rest[1:]
+        for i, second in enumerate(others):
+            steps[0] -= 1
+            if steps[0] < 0:
+                return None
+            if frozenset((first, second)) in played:
+                continue
+            pairs = pair(others[:i] + others[i + 1:])
+            if pairs is not None:
+                return [(first, second)] + pairs
+        return None
+
+    pairs = pair(players)
+    if pairs is None:
+        # no pairing without rematches was found, pair by the standings
+        pairs = list(zip(players[::2], players[1::2]))
+    return pairs, bye
@@ -0,0 +1,231 @@
+import argparse
+import multiprocessing
+import sys
+import time
+try:
+    import sunfish
+    import tools
+except ImportError:
+    # imported as part of the battleground package
+    from battleground import sunfish, tools
+
+###############################################################################
+# Perft counts the legal move sequences of a given length, which checks
+# the move generation against known counts and measures its speed.
+#   python -m battleground.perft
+#   python -m battleground.perft --fen FEN --depth 3 --divide
+# perft() walks the tree of tools.expand_position and serves as reference,
+# bulk_perft() gives the same counts fast enough for deeper checks.
+###############################################################################
+
+# name, fen and the node counts for depth 1, 2, ...
+# Sunfish only promotes to queens, so where underpromotions are possible the
+# counts are the published ones without them (position 4: 48 promotions at
+# depth 2, 36 of them underpromotions; position 5: 3 at depth 1).
+PERFT_POSITIONS = (
+    ('initial', tools.FEN_INITIAL, (20, 400, 8902, 197281)),
+    ('kiwipete',
+     'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     (48, 2039, 97862)),
+    ('position 3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     (14, 191, 2812, 43238)),
+    ('position 4',
+     'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     (6, 228)),
+    ('position 5',
+     'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     (41,)),
+    ('position 6',
+     'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 '
+     'w - - 0 10',
+     (46, 2079, 89890)),
+)
+
+
+def perft(pos, depth):
+    ''' The number of legal move sequences of length depth from pos '''
+    tree = tools.expand_position(pos)
+    return sum(1 for _ in tools.collect_tree_depth(tree, depth))
+
+
+def divide(pos, depth, count=perft):
+    ''' Yields every legal move with the perft of depth-1 after it '''
+    for move, pos1 in tools.gen_legal_moves(pos):
+        yield tools.mrender(pos, move), count(pos1, depth - 1)
+
+
+###############################################################################
+# Bulk counting
+###############################################################################
+
+N, E, S, W = sunfish.N, sunfish.E, sunfish.S, sunfish.W
+
+
+def _reached(at, k):
+    '''
+    Whether the opponent has a move onto square k of the board at(), which
+    is what makes the previous move illegal in sunfish: capturing our king,
+    or reaching any of the squares next to the king passant square.
+    '''
+    q = at(k)
+    if q.isupper():
+        if at(k+N+W) == 'p' or at(k+N+E) == 'p':
+            return True
+    elif q == '.':
+        if at(k+N) == 'p':
+            return True
+        # Double moves start from the second rank of the opponent
+        if k+2*N <= sunfish.H8+10 and at(k+2*N) == 'p' and at(k+N) == '.':
+            return True
+    else:
+        return False
+    for d in sunfish.directions['N']:
+        if at(k+d) == 'n':
+            return True
+    for d in sunfish.directions['K']:
+        if at(k+d) == 'k':
+            return True
+    for d, sliders in ((N, 'rq'), (E, 'rq'), (S, 'rq'), (W, 'rq'),
+                       (N+E, 'bq'), (S+E, 'bq'), (S+W, 'bq'), (N+W, 'bq')):
+        x = k+d
+        while at(x) == '.':
+            x += d
+        if at(x) in sliders:
+            return True
+    return False
+
+
+def _is_legal(board, king, move):
+    ''' The legality check of tools.gen_legal_moves without moving '''
+    i, j = move
+    p = board[i]
+    # The squares changed by the move, like in Position.move
+    changes = {j: p, i: '.'}
+    zone = ()
+    if p == 'K':
+        king = j
+        if abs(j-i) == 2:
+            kp = (i+j)//2
+            changes[sunfish.A1 if j < i else sunfish.H1] = '.'
+            changes[kp] = 'R'
+            zone = (kp-1, kp, kp+1)
+    elif p == 'P' and j-i in (N+W, N+E) and board[j] == '.':
+        changes[j+S] = '.'
+
+    def at(k):
+        return changes.get(k, board[k])
+    if king != -1 and _reached(at, king):
+        return False
+    return not any(_reached(at, k) for k in zone)
+
+
+def count_legal_moves(pos):
+    ''' The number of tools.gen_legal_moves(pos), without making them '''
+    board = pos.board
+    king = board.find('K')
+    return sum(1 for move in pos.gen_moves() if _is_legal(board, king, move))
+
+
+def bulk_perft(pos, depth, table=None, processes=1):
+    '''
+    perft(pos, depth), counting the legal moves at the last ply instead of
+    making them. The counts of the subtrees are kept in table, keyed by the
+    position hash and depth. With processes > 1 the moves at the root are
+    counted by a pool of processes.
+    '''
+    if depth == 0:
+        return 1
+    if depth == 1:
+        return count_legal_moves(pos)
+    if table is None:
+        table = {}
+    key = (pos.hash, depth)
+    if key not in table:
+        moves = [pos1 for _, pos1 in tools.gen_legal_moves(pos)]
+        if processes > 1:
+            with multiprocessing.Pool(processes) as pool:
+                counts = pool.map(_count_subtree, [
+                    (pos1, depth-1) for pos1 in moves])
+        else:
+            counts = [bulk_perft(pos1, depth-1, table) for pos1 in moves]
+        table[key] = sum(counts)
+    return table[key]
+
+
+# Every process of the pool keeps its own table
+_process_table = {}
+
+
+def _count_subtree(args):
+    pos, depth = args
+    return bulk_perft(pos, depth, _process_table)
+
+
+def timed(count, *args):
+    ''' Returns the result of count(*args) and the seconds it took '''
+    start = time.time()
+    result = count(*args)
+    return result, max(time.time() - start, 1e-6)
+
+
+def run_suite(max_depth=3, bitboard=False, count=perft, out=sys.stdout):
+    '''
+    Runs perft on the PERFT_POSITIONS up to max_depth and prints the node
+    counts and the nodes per second. Returns the number of wrong counts.
+    '''
+    failures = 0
+    print('%-12s %5s %10s %10s %8s %10s' % (
+        'position', 'depth', 'nodes', 'expected', 'secs', 'nodes/s'),
+        file=out)
+    for name, fen, counts in PERFT_POSITIONS:
+        pos = tools.parseFEN(fen, bitboard=bitboard)
+        for depth, expected in enumerate(counts[:max_depth], 1):
+            nodes, secs = timed(count, pos, depth)
+            if nodes != expected:
+                failures += 1
+            print('%-12s %5d %10d %10d %8.2f %10d%s' % (
+                name, depth, nodes, expected, secs, nodes / secs,
+                '' if nodes == expected else '  WRONG'), file=out)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Checks and measures the sunfish move generation')
+    parser.add_argument('--fen', help='run perft on this position only')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--divide', action='store_true',
+                        help='print the count after every move')
+    parser.add_argument('--bitboard', action='store_true',
+                        help='use bitboard.BitboardPosition')
+    parser.add_argument('--tree', action='store_true',
+                        help='count with the reference perft()')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='count the root moves in parallel')
+    args = parser.parse_args(argv)
+
+    if args.tree:
+        count = perft
+    else:
+        def count(pos, depth):
+            return bulk_perft(pos, depth, processes=args.processes)
+
+    if args.fen is None:
+        return 1 if run_suite(args.depth, args.bitboard, count) else 0
+
+    pos = tools.parseFEN(args.fen, bitboard=args.bitboard)
+    start = time.time()
+    if args.divide:
+        nodes = 0
+        for move, moves in divide(pos, args.depth, count):
+            print(move, moves)
+            nodes += moves
+    else:
+        nodes = count(pos, args.depth)
+    secs = max(time.time() - start, 1e-6)
+    print('nodes %d, %.2f secs, %d nodes/s' % (nodes, secs, nodes / secs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
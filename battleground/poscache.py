@@ -0,0 +1,152 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+try:
+    import sunfish
+except ImportError:
+    # imported as part of the battleground package
+    from battleground import sunfish
+
+###############################################################################
+# A table of searched positions kept in a memory mapped file, so that it
+# survives the battles and every process playing chess can share it.
+# The file is a header followed by the entries of a sunfish
+# TranspositionTable, which checks every entry against its key, so the
+# readers never need a lock even while a merge writes into the file.
+# The merged tables are written by the games, so the entries which a search
+# could not have stored are dropped and the searchers check the moves of
+# the cache before they play them.
+###############################################################################
+
+MAGIC = b'BGTT'
+VERSION = 1
+# magic, version, number of entries
+HEADER = struct.Struct('<4sIQ')
+
+CACHE_MB = 256
+
+
+class PositionCacheError(Exception):
+    pass
+
+
+def on_board(square):
+    ''' Whether square is on the 8x8 board of a sunfish position '''
+    return sunfish.A8 <= square <= sunfish.H1 and 1 <= square % 10 <= 8
+
+
+def valid_entry(packed):
+    ''' Whether the packed data of a TranspositionTable entry could be
+        stored by a search: the bounds of a score or a move between two
+        squares of the board '''
+    lower = (packed & 0x3ffff) - sunfish.MATE_UPPER
+    upper = (packed >> 18 & 0x3ffff) - sunfish.MATE_UPPER
+    move = packed >> 46 & 0x3fff
+    if move:
+        return lower == upper == -sunfish.MATE_UPPER and \
+            all(on_board(square) for square in divmod(move, 120))
+    return all(-sunfish.MATE_UPPER <= bound <= sunfish.MATE_UPPER
+               for bound in (lower, upper))
+
+
+class PositionCache(sunfish.TranspositionTable):
+    """
+    A TranspositionTable mapped from a file
+    Open it read only and pass it as the cache of a sunfish.Searcher, or open
+    it writable to merge the tables of finished searches into it.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        mode = 'r+b' if writable else 'rb'
+        with open(path, mode) as cache_file:
+            header = cache_file.read(HEADER.size)
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.mmap = mmap.mmap(cache_file.fileno(), 0, access=access)
+        try:
+            magic, version, entries = HEADER.unpack(header)
+        except struct.error:
+            magic, version, entries = None, None, 0
+        size = HEADER.size + entries * self.ENTRY_SIZE
+        if magic != MAGIC or version != VERSION or len(self.mmap) != size:
+            self.mmap.close()
+            error = "[%s] is not a position cache" % path
+            raise PositionCacheError(error)
+        self.view = memoryview(self.mmap)[HEADER.size:]
+        super().__init__(buffer=self.view)
+
+    @classmethod
+    def create(cls, path, size_mb=CACHE_MB, replace=True):
+        """
+        Creates an empty cache file, replacing any file at path, or keeping
+        it if not replace
+        The file is written next to path and moved there at once, so the
+        processes which mapped the old file keep using it.
+        """
+        entries = cls.capacity(size_mb)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(prefix='.new-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(HEADER.pack(MAGIC, VERSION, entries))
+                cache_file.truncate(HEADER.size + entries * cls.ENTRY_SIZE)
+            if replace:
+                os.replace(temp_path, path)
+            else:
+                try:
+                    # fails instead of replacing a file created meanwhile
+                    os.link(temp_path, path)
+                except FileExistsError:
+                    pass
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        return cls(path)
+
+    @classmethod
+    def dump(cls, table, path):
+        """
+        Saves a table, e.g. the tp_score of a Searcher, as a cache file
+        """
+        with open(path, 'wb') as cache_file:
+            cache_file.write(HEADER.pack(MAGIC, VERSION, table.size))
+            cache_file.write(table.data)
+
+    @classmethod
+    def merge_file(cls, path, table_path):
+        """
+        Folds the entries of the cache file at table_path into the cache
+        at path, creating it if needed. Merges are serialized by a lock on
+        the file, while readers keep using it.
+        """
+        if not os.path.exists(path):
+            cls.create(path, replace=False).close()
+        with cls(table_path) as table:
+            with open(path, 'rb') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # the cache is checked once the lock is held
+                    with cls(path, writable=True) as cache:
+                        cache.merge(table)
+                        cache.mmap.flush()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def merge(self, other):
+        ''' Stores the valid entries of another table, deeper entries win '''
+        for k, packed in other.items():
+            if valid_entry(packed):
+                self._put(k, packed)
+
+    def close(self):
+        self.data.release()
+        self.view.release()
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,139 @@
+import collections
+
+import numpy
+
+###############################################################################
+# Elo ratings of multiplayer battles.
+# Every fighter plays a game against every other fighter of the battle,
+# scoring 1 for a better place, 0.5 for the same place and 0 for a worse
+# one, expecting 1 / (1 + 10^(diff/400)). The change of a fighter is
+# K = 32 / (n - 1) times the sum of the differences, scaled by the fair factor
+# of the battle. The games of a battle are computed as one n x n matrix and
+# battles of the same size as one stack of matrices.
+###############################################################################
+
+K_FACTOR = 32
+# The rating points moved from the stronger to the weaker fighter of a draw
+# for every DRAW_DIVISOR points between them
+DRAW_DIVISOR = 50
+# Bots with fewer battles don't lower the fair factor
+FAIR_MIN_BATTLES = 3
+
+
+def places(final_order):
+    """
+    The place of every fighter, counting from 1, from the final order of a
+    battle, which lists the fighter indexes from the winner to the loser
+    """
+    result = numpy.empty(len(final_order), dtype=int)
+    result[numpy.asarray(final_order, dtype=int)] = numpy.arange(
+        1, len(final_order) + 1)
+    return result
+
+
+def elo_changes(ratings, places, fair_factors=1.0):
+    """
+    The rating changes of the fighters of battles of the same size
+    ratings, places -- arrays of the battles x fighters, or of the fighters
+    of a single battle
+    fair_factors -- the fair factor of every battle
+    """
+    ratings = numpy.asarray(ratings, dtype=float)
+    places = numpy.asarray(places)
+    count = ratings.shape[-1]
+    # S and EA of every fighter (rows) against every opponent (columns),
+    # on the diagonal they are both 0.5 and cancel out
+    better = places[..., :, None] < places[..., None, :]
+    same = places[..., :, None] == places[..., None, :]
+    score = numpy.where(better, 1.0, numpy.where(same, 0.5, 0.0))
+    diff = ratings[..., None, :] - ratings[..., :, None]
+    expected = 1 / (1.0 + numpy.power(10.0, diff / 400.0))
+    changes = K_FACTOR / (count - 1) * (score - expected).sum(axis=-1)
+    fair_factors = numpy.asarray(fair_factors, dtype=float)[..., None]
+    return numpy.round(changes * fair_factors).astype(int)
+
+
+def draw_changes(ratings):
+    """
+    The rating changes of the fighters of a draw: the strongest and the
+    weakest fighter, then the second strongest and second weakest and so on,
+    get closer by 1/DRAW_DIVISOR of their difference
+    """
+    ratings = numpy.asarray(ratings)
+    order = numpy.argsort(ratings, kind='stable')
+    changes = numpy.zeros(len(ratings), dtype=int)
+    for i in range(len(ratings) // 2):
+        stronger, weaker = order[-i - 1], order[i]
+        diff = round((ratings[stronger] - ratings[weaker]) / DRAW_DIVISOR)
+        changes[stronger] -= diff
+        changes[weaker] += diff
+    return changes
+
+
+def fair_factor(battles, shared, count=None):
+    """
+    The fair factor of a battle, lower when its bots played a bigger part
+    of their battles against one another
+    battles -- the battles of every bot of the battle, by bot id
+    shared -- the battles of pairs of the bots with one another, by
+    (bot_id1, bot_id2) with bot_id1 < bot_id2
+    count -- the number of fighters, if a bot fights more than once
+    """
+    count = count or len(battles)
+    result = 0
+    for bot_id1, battles1 in battles.items():
+        if battles1 < FAIR_MIN_BATTLES:
+            result += 1
+            continue
+        factor = 0
+        for bot_id2, battles2 in battles.items():
+            if bot_id1 != bot_id2:
+                if battles2 < FAIR_MIN_BATTLES:
+                    factor += 1
+                    continue
+                pair = (min(bot_id1, bot_id2), max(bot_id1, bot_id2))
+                unique = battles1 - shared.get(pair, 0) + 1
+                factor += unique / battles1
+        result += factor / (count - 1)
+    return result / count
+
+
+def replay(ratings, battles):
+    """
+    Applies the battles in their order to the ratings
+    ratings -- a dict of bot ids and ratings, which is updated
+    battles -- (bot_ids, final_order, fair_factor) of every battle, where
+    final_order is None for a draw
+    The battles are rated in waves of battles without common bots, every
+    wave at once, so the result is the same as rating them one by one.
+    """
+    wave, wave_bots = [], set()
+    for battle in battles:
+        bot_ids = battle[0]
+        if not wave_bots.isdisjoint(bot_ids):
+            _rate_wave(ratings, wave)
+            wave, wave_bots = [], set()
+        wave.append(battle)
+        wave_bots.update(bot_ids)
+    _rate_wave(ratings, wave)
+    return ratings
+
+
+def _rate_wave(ratings, battles):
+    by_size = collections.defaultdict(list)
+    for bot_ids, final_order, fair_factor in battles:
+        if final_order is None:
+            changes = draw_changes([ratings[bot_id] for bot_id in bot_ids])
+            for bot_id, change in zip(bot_ids, changes):
+                ratings[bot_id] += int(change)
+        else:
+            by_size[len(bot_ids)].append((bot_ids, final_order, fair_factor))
+    for same_size in by_size.values():
+        bot_ids = [battle[0] for battle in same_size]
+        changes = elo_changes(
+            [[ratings[bot_id] for bot_id in ids] for ids in bot_ids],
+            [places(battle[1]) for battle in same_size],
+            [battle[2] for battle in same_size])
+        for ids, battle_changes in zip(bot_ids, changes):
+            for bot_id, change in zip(ids, battle_changes):
+                ratings[bot_id] += int(change)
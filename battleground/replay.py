@@ -0,0 +1,146 @@
+import argparse
+import collections
+import csv
+import itertools
+import sys
+
+import battleground.entity as entity
+from battleground import rating
+from battleground.service import BattleState, BotService, LeaderboardService
+
+###############################################################################
+# Rebuilds the ratings of all bots from the history of their battles, e.g.
+# after a change of the rating formula. The concluded battles are streamed
+# from the database in the order they concluded, so the memory used depends
+# on the number of bots and not on the number of battles. Every bot starts
+# from the starting rating and the ranked battles are rated again, with the
+# fair factor of the battles counted up to then.
+# Ranked tournament rounds are rated as their battles conclude and not at
+# the end of the round. Run it while no battles are played.
+#   python -m battleground.replay
+#   python -m battleground.replay --snapshots ratings.csv --every 1000
+###############################################################################
+
+# Rows fetched from the database and battles rated at once
+BATCH_SIZE = 1000
+# Ranked battles between two snapshots of the ratings
+SNAPSHOT_EVERY = 1000
+
+
+def stream_battles(session, batch_size=BATCH_SIZE):
+    """
+    Yields the id, whether it is ranked, the bot ids and the places of the
+    fighters of every concluded battle, in the order they concluded
+    The battles stored before battles.ranked existed are unranked, like
+    the battles of battle_bots were by default, but count for the fair
+    factor of the later battles.
+    """
+    battle = entity.Battle
+    fighter = entity.Fighter
+    rows = session.query(
+        fighter.battle_id, battle.ranked,
+        fighter.bot_id, fighter.battle_place).\
+        join(battle, fighter.battle_id == battle.id).\
+        filter(battle.state == BattleState.CONCLUDED).\
+        order_by(
+            # the battles from before concluded_at go first
+            battle.concluded_at.is_(None).desc(),
+            battle.concluded_at, battle.id, fighter.id).\
+        yield_per(batch_size)
+    for battle_id, fighters in itertools.groupby(rows, key=lambda row: row[0]):
+        fighters = list(fighters)
+        yield (battle_id, bool(fighters[0][1]),
+               [row[2] for row in fighters], [row[3] for row in fighters])
+
+
+def replay(session, snapshots=None, every=SNAPSHOT_EVERY,
+           batch_size=BATCH_SIZE):
+    """
+    Rates the ranked battles again and stores the new ratings of the bots
+    snapshots -- a file for the ratings of the bots which changed, written
+    every every ranked battles as csv rows of battles, battle_id, bot_id
+    and rating
+    Returns the number of ranked battles.
+    """
+    ratings = {bot_id: BotService.STARTING_BOT_RATING
+               for bot_id, in session.query(entity.Bot.id)}
+    battles = collections.Counter()
+    shared = collections.Counter()
+    writer = csv.writer(snapshots) if snapshots is not None else None
+    if writer is not None:
+        writer.writerow(["battles", "battle_id", "bot_id", "rating"])
+    pending, changed, rated = [], set(), 0
+
+    for battle_id, ranked, bot_ids, places in stream_battles(
+            session, batch_size):
+        distinct = sorted(set(bot_ids))
+        pairs = list(itertools.combinations(distinct, 2))
+        battles.update(distinct)
+        shared.update(pairs)
+        if not ranked:
+            continue
+
+        # the fighters of removed bots still take part in the battle
+        for bot_id in distinct:
+            ratings.setdefault(bot_id, BotService.STARTING_BOT_RATING)
+        if all(place == -1 for place in places):
+            final_order, fair_factor = None, None
+        else:
+            final_order = sorted(range(len(places)), key=places.__getitem__)
+            fair_factor = rating.fair_factor(
+                {bot_id: battles[bot_id] for bot_id in distinct},
+                {pair: shared[pair] for pair in pairs}, len(bot_ids))
+        pending.append((bot_ids, final_order, fair_factor))
+        changed.update(distinct)
+        rated += 1
+
+        if len(pending) >= batch_size:
+            rating.replay(ratings, pending)
+            pending = []
+        if writer is not None and rated % every == 0:
+            rating.replay(ratings, pending)
+            pending = []
+            writer.writerows([rated, battle_id, bot_id, ratings[bot_id]]
+                             for bot_id in sorted(changed))
+            changed = set()
+    rating.replay(ratings, pending)
+    if writer is not None and changed:
+        writer.writerows([rated, battle_id, bot_id, ratings[bot_id]]
+                         for bot_id in sorted(changed))
+
+    bot_ids = [bot_id for bot_id, in session.query(entity.Bot.id)]
+    for start in range(0, len(bot_ids), batch_size):
+        session.bulk_update_mappings(entity.Bot, [
+            {"id": bot_id, "rating": ratings[bot_id]}
+            for bot_id in bot_ids[start:start + batch_size]])
+    session.commit()
+    LeaderboardService.invalidate()
+    return rated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Rates all ranked battles again')
+    parser.add_argument('--snapshots',
+                        help='a csv file for the ratings over time')
+    parser.add_argument('--every', type=int, default=SNAPSHOT_EVERY,
+                        help='ranked battles between two snapshots')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    session = entity.session()
+    try:
+        if args.snapshots:
+            with open(args.snapshots, 'w', newline='') as snapshots:
+                rated = replay(session, snapshots, args.every,
+                               args.batch_size)
+        else:
+            rated = replay(session, batch_size=args.batch_size)
+    finally:
+        entity.session.remove()
+    print("%d ranked battles replayed" % rated)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
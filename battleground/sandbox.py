@@ -0,0 +1,248 @@
+import json
+import os
+import select
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+
+import battleground.error as err
+
+###############################################################################
+# A pool of sandbox processes which execute the games.
+# Starting the sandbox interpreter and importing the chess modules for every
+# battle costs more than a short game, so the workers are started in advance
+# and take one battle after another over a pipe. They run the interpreter of
+# the sandbox environment, so its confinement applies to them as it does to
+# codejail. Every battle runs in a process forked by the worker with the
+# resource limits of the pool, so nothing a battle changes is seen by the
+# next one, and the memory of a battle is freed with its process. A worker
+# is replaced after a number of battles.
+###############################################################################
+
+POOL_SIZE = 2
+MAX_BATTLES = 50
+# Seconds a worker gets to start and to finish a battle
+START_TIMEOUT = 30
+BATTLE_TIMEOUT = 600
+# Seconds the pool waits for a worker after the battle timed out, the worker
+# kills the process of the battle itself
+KILL_TIMEOUT = 10
+# Limits of the process of a battle, like those of codejail, by the names of
+# the resource.RLIMIT_ constants: CPU seconds, bytes of memory and of a
+# written file and processes of the user. None keeps the limit of the worker.
+LIMITS = {
+    'CPU': BATTLE_TIMEOUT,
+    'AS': 1024 * 2 ** 20,
+    'FSIZE': 64 * 2 ** 20,
+    'NPROC': 15,
+}
+WORKER_SCRIPT = 'sandbox_worker.py'
+
+
+class SandboxWorker:
+    """
+    A running sandbox_worker.py process
+    """
+
+    def __init__(self, python, directory, preload=()):
+        self.process = subprocess.Popen(
+            [python, '-u', WORKER_SCRIPT, directory] + list(preload),
+            cwd=directory,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            # the processes of the battles are killed with the worker
+            start_new_session=True)
+        self.battles = 0
+        self._receive(START_TIMEOUT)
+
+    def request(self, message, timeout):
+        """
+        Sends a message and waits for the reply
+        If the worker dies or times out it is killed and a SandboxError is
+        raised.
+        """
+        try:
+            self.process.stdin.write(json.dumps(message).encode() + b'\n')
+            self.process.stdin.flush()
+        except OSError:
+            self.kill()
+            raise err.SandboxError("Sandbox worker is not running")
+        return self._receive(timeout)
+
+    def _receive(self, timeout):
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        line = self.process.stdout.readline() if ready else b''
+        if not line:
+            self.kill()
+            if ready:
+                raise err.SandboxError("Sandbox worker died")
+            raise err.SandboxError(
+                "Sandbox worker did not answer in %s seconds" % timeout)
+        return json.loads(line.decode())
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                # a request written to the dead worker is never sent
+                pass
+
+
+class SandboxPool:
+    """
+    SandboxPool keeps up to size workers of the sandbox interpreter python
+    with the given modules copied to their directory and imported in advance.
+    run() can be called from several threads, each battle takes a worker.
+    """
+
+    def __init__(self, python, modules=(), size=POOL_SIZE,
+                 max_battles=MAX_BATTLES, timeout=BATTLE_TIMEOUT,
+                 limits=None):
+        self.python = python
+        self.size = size
+        self.max_battles = max_battles
+        self.timeout = timeout
+        self.limits = dict(LIMITS if limits is None else limits)
+        self.directory = tempfile.mkdtemp(prefix="sandbox-")
+        shutil.copy(os.path.join(os.path.dirname(__file__), WORKER_SCRIPT),
+                    self.directory)
+        for module in modules:
+            shutil.copy(module, self.directory)
+        self.preload = [os.path.splitext(os.path.basename(module))[0]
+                        for module in modules]
+        self.closed = False
+        self._idle = []
+        self._workers = 0
+        self._condition = threading.Condition()
+
+    def start(self):
+        """
+        Starts the missing workers, so the first battles don't wait for them
+        """
+        with self._condition:
+            missing = self.size - self._workers
+            self._workers += missing
+        for _ in range(missing):
+            self._release(self._start_worker())
+
+    def run(self, source, globals_dict, python_path=()):
+        """
+        Executes source in a worker like codejail's safe_exec. The JSON
+        compatible values of globals_dict are passed to the worker and it is
+        updated with the JSON compatible globals after the execution.
+        Returns the stats of the execution measured by the worker, see
+        sandbox_worker.py.
+        """
+        worker = self._acquire()
+        try:
+            reply = worker.request({
+                'source': source,
+                'globals': json.loads(json.dumps(globals_dict)),
+                'python_path': list(python_path),
+                'limits': self.limits,
+                'timeout': self.timeout}, self.timeout + KILL_TIMEOUT)
+        except err.SandboxError:
+            self._discard(worker)
+            raise
+        worker.battles += 1
+        self._release(worker)
+        if 'error' in reply:
+            error = "Couldn't execute jailed code: %s" % reply['error']
+            raise err.SandboxError(error)
+        globals_dict.update(reply['globals'])
+        return reply.get('stats')
+
+    def check(self):
+        """
+        Health check: pings the idle workers, replaces those which don't
+        answer and returns the number of workers
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            try:
+                worker.request({'ping': True}, START_TIMEOUT)
+            except err.SandboxError:
+                self._discard(worker)
+                with self._condition:
+                    self._workers += 1
+                try:
+                    worker = self._start_worker()
+                except (OSError, err.SandboxError):
+                    continue
+            self._release(worker)
+        with self._condition:
+            return self._workers
+
+    def close(self):
+        """
+        Stops the workers and removes their directory
+        """
+        with self._condition:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for worker in idle:
+            worker.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _start_worker(self):
+        try:
+            return SandboxWorker(self.python, self.directory, self.preload)
+        except (OSError, err.SandboxError):
+            with self._condition:
+                self._workers -= 1
+                self._condition.notify()
+            raise
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._workers >= self.size:
+                if self.closed:
+                    raise err.SandboxError("Sandbox pool is closed")
+                self._condition.wait()
+            if self.closed:
+                raise err.SandboxError("Sandbox pool is closed")
+            if self._idle:
+                return self._idle.pop()
+            self._workers += 1
+        return self._start_worker()
+
+    def _release(self, worker):
+        """
+        Returns a worker to the pool, or replaces it when it is worn out
+        """
+        if worker.battles >= self.max_battles:
+            worker.kill()
+            try:
+                worker = self._start_worker()
+            except (OSError, err.SandboxError):
+                # the next battle starts a worker again
+                return
+        with self._condition:
+            closed = self.closed
+            if closed:
+                self._workers -= 1
+            else:
+                self._idle.append(worker)
+            self._condition.notify()
+        if closed:
+            worker.kill()
+
+    def _discard(self, worker):
+        worker.kill()
+        with self._condition:
+            self._workers -= 1
+            self._condition.notify()
@@ -0,0 +1,254 @@
+import functools
+import importlib
+import inspect
+import json
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+
+###############################################################################
+# A sandbox worker of battleground.sandbox.SandboxPool.
+# It is started by the sandbox interpreter with the pool directory and the
+# modules to import in advance, then executes one job per line of stdin and
+# answers with one line of JSON. The code of the jobs writes to stderr, the
+# replies go to the original stdout.
+#   python sandbox_worker.py DIRECTORY [MODULE ...]
+# The worker never executes the code of a job itself. It forks a process
+# for every job, which starts from the modules imported in advance, gets
+# the resource limits of the job and closes the pipes of the worker before
+# it executes the code, and is gone with everything the code changed once
+# the job ends. The worker measures the wall and CPU seconds and the peak
+# memory of that process for the stats of the reply. The times of the
+# get_move calls of the bots come from the process and are only checked.
+###############################################################################
+
+# Upper bounds in milliseconds of the buckets of the move latencies, the
+# last bucket counts the slower moves
+MOVE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def set_limits(limits):
+    ''' Sets the limits of the process, by the names of the resource.RLIMIT_
+        constants, leaving those which are None '''
+    for name, value in limits.items():
+        if value is None:
+            continue
+        limit = getattr(resource, 'RLIMIT_' + name)
+        # the CPU limit sends SIGXCPU first and kills a second later
+        hard = value + 1 if name == 'CPU' else value
+        resource.setrlimit(limit, (value, hard))
+
+
+def json_safe(namespace):
+    ''' The values of namespace that survive a trip through JSON '''
+    result = {}
+    for name, value in namespace.items():
+        if name.startswith('__'):
+            continue
+        try:
+            result[name] = json.loads(json.dumps(value))
+        except (TypeError, ValueError):
+            pass
+    return result
+
+
+class MoveTimer:
+    ''' Times the get_move calls of the bots of a job '''
+
+    def __init__(self):
+        self.moves = {}
+
+    def time_bot(self, name):
+        ''' Imports the bot module and times its get_move functions and
+            the get_move methods of its classes. The game gets the timed
+            module when it imports the bot. '''
+        try:
+            module = importlib.import_module(name)
+        except Exception:
+            # the game gets the error when it imports the bot
+            return
+        if callable(getattr(module, 'get_move', None)):
+            module.get_move = self._timed(name, module.get_move)
+        for value in list(vars(module).values()):
+            if inspect.isclass(value) and \
+                    value.__module__ == module.__name__ and \
+                    inspect.isfunction(vars(value).get('get_move')):
+                value.get_move = self._timed(name, value.get_move)
+
+    def record(self, name, seconds):
+        stats = self.moves.setdefault(name, {
+            'moves': 0, 'total_time': 0.0, 'max_time': 0.0,
+            'histogram': [0] * (len(MOVE_BUCKETS_MS) + 1)})
+        stats['moves'] += 1
+        stats['total_time'] += seconds
+        stats['max_time'] = max(stats['max_time'], seconds)
+        millis = seconds * 1000
+        bucket = next((i for i, bound in enumerate(MOVE_BUCKETS_MS)
+                       if millis <= bound), len(MOVE_BUCKETS_MS))
+        stats['histogram'][bucket] += 1
+
+    def _timed(self, name, get_move):
+        @functools.wraps(get_move)
+        def timed_get_move(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return get_move(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return timed_get_move
+
+
+def run_job(job):
+    ''' Executes the source of the job in its globals, in the process of
+        the job '''
+    sys.path[:0] = [os.path.abspath(path) for path in job['python_path']]
+    namespace = job['globals']
+    timer = MoveTimer()
+    try:
+        for bot in namespace.get('bots') or ():
+            if isinstance(bot, str):
+                timer.time_bot(bot)
+        exec(compile(job['source'], 'jailed_code', 'exec'), namespace)
+        reply = {'globals': json_safe(namespace)}
+    except BaseException:
+        reply = {'error': traceback.format_exc()}
+    reply['moves'] = timer.moves
+    return reply
+
+
+def checked_moves(moves, bots, wall_time):
+    ''' The move stats of the bots of the job which add up and fit in the
+        time of the job '''
+    result = {}
+    if not isinstance(moves, dict):
+        return result
+    for bot in bots:
+        stats = moves.get(bot)
+        try:
+            count = stats['moves']
+            histogram = stats['histogram']
+            total_time = float(stats['total_time'])
+            max_time = float(stats['max_time'])
+            valid = isinstance(count, int) and count >= 0 and \
+                len(histogram) == len(MOVE_BUCKETS_MS) + 1 and \
+                all(isinstance(n, int) and n >= 0 for n in histogram) and \
+                sum(histogram) == count and \
+                0 <= max_time <= total_time <= wall_time
+        except (KeyError, TypeError, ValueError):
+            continue
+        if valid:
+            result[bot] = {'moves': count, 'total_time': total_time,
+                           'max_time': max_time, 'histogram': histogram}
+    return result
+
+
+def read_reply(fd, deadline):
+    ''' Reads the reply of the process of a job until it closes the pipe
+        Returns None if the deadline, if any, passes first. '''
+    chunks = []
+    while True:
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if ready:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def execute(job, worker_fds=()):
+    ''' Executes the job in a process of its own and returns the reply '''
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        # the process of the job
+        try:
+            os.close(read_fd)
+            for fd in worker_fds:
+                os.close(fd)
+            set_limits(job.get('limits') or {})
+            data = json.dumps(run_job(job)).encode()
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except Exception:
+                    pass
+            os._exit(0)
+
+    os.close(write_fd)
+    try:
+        timeout = job.get('timeout')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        data = read_reply(read_fd, deadline)
+    finally:
+        os.close(read_fd)
+    if data is None:
+        os.kill(pid, signal.SIGKILL)
+    _, status, usage = os.wait4(pid, 0)
+    wall_time = time.perf_counter() - start
+
+    child = {}
+    if data is None:
+        reply = {'error': "Battle did not finish in %s seconds" % timeout}
+    else:
+        try:
+            child = json.loads(data.decode())
+        except ValueError:
+            pass
+        if not isinstance(child, dict):
+            child = {}
+        if isinstance(child.get('globals'), dict):
+            reply = {'globals': child['globals']}
+        elif isinstance(child.get('error'), str):
+            reply = {'error': child['error']}
+        elif os.WIFSIGNALED(status):
+            reply = {'error': "Battle was killed by signal %d" %
+                     os.WTERMSIG(status)}
+        else:
+            reply = {'error': "Battle exited without a result"}
+    bots = [bot for bot in job['globals'].get('bots') or ()
+            if isinstance(bot, str)]
+    reply['stats'] = {
+        'wall_time': wall_time,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'moves': checked_moves(child.get('moves'), bots, wall_time)}
+    return reply
+
+
+def main(directory, *modules):
+    requests = os.fdopen(os.dup(0), 'r')
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+
+    def send(reply):
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+    sys.path.insert(0, directory)
+    for module in modules:
+        importlib.import_module(module)
+    send({'ready': os.getpid()})
+    for line in requests:
+        job = json.loads(line)
+        if job.get('ping'):
+            send({'pong': True})
+        else:
+            send(execute(job, (requests.fileno(), replies.fileno())))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,110 @@
+import concurrent.futures
+import queue
+import threading
+
+import battleground.error as err
+
+###############################################################################
+# Runs the battles in the background.
+# A fixed number of threads takes the battles from a bounded queue, so a
+# burst of battles waits in the queue instead of starting all at once, and
+# once the queue is full the callers are held back.
+###############################################################################
+
+WORKERS = 2
+QUEUE_SIZE = 64
+
+
+class BattleScheduler:
+    """
+    BattleScheduler executes jobs in worker threads and returns a
+    concurrent.futures.Future for every job, which can be waited on or
+    cancelled while the job is still in the queue.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._shutdown = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name="battle-worker-%d" % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, timeout=None):
+        """
+        Queues fn(*args) and returns the future of its result
+        Waits up to timeout seconds for a place in the queue (forever if
+        timeout is None) and raises BattleQueueFullError if there is none.
+        """
+        if self._shutdown:
+            raise RuntimeError("Battle scheduler is shut down")
+        future = concurrent.futures.Future()
+        try:
+            self._queue.put((future, fn, args), timeout=timeout)
+        except queue.Full:
+            error = "%d battles are waiting already" % self._queue.maxsize
+            raise err.BattleQueueFullError(error)
+        return future
+
+    def pending(self):
+        """
+        The number of jobs waiting in the queue
+        """
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stops the workers once they finish the queued jobs, or only the
+        running ones with cancel_pending, which cancels the queued jobs
+        It doesn't wait for a place in a full queue.
+        Returns the futures of the cancelled jobs.
+        """
+        self._shutdown = True
+        cancelled = []
+        if cancel_pending:
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None and job[0].cancel():
+                    cancelled.append(job[0])
+                self._queue.task_done()
+        self._wake()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        return cancelled
+
+    def _wake(self):
+        # a worker which stops wakes the next one, so a single free place
+        # in the queue is enough, and with a full queue the workers see
+        # the shutdown once they emptied it
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _work(self):
+        while True:
+            if self._shutdown and self._queue.empty():
+                self._wake()
+                return
+            job = self._queue.get()
+            try:
+                if job is None:
+                    self._wake()
+                    return
+                future, fn, args = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args)
+                except BaseException as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
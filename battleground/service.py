@@ -1,80 +1,207 @@
 import battleground
 import battleground.entity as entity
 import battleground.error as err
+from battleground.poscache import PositionCache
+from battleground import config
+from battleground import sandbox
+from battleground import pairing
+from battleground import rating
+from battleground.matchmaking import MatchmakingIndex
+from battleground.leaderboard import Leaderboard, PAGE_SIZE
+from battleground import scheduler
+from battleground import ingest
+from battleground.modulestore import ModuleStore
+from battleground.movelog import MoveLog, MoveLogError
+from battleground.sandbox_worker import MOVE_BUCKETS_MS
 
 import codejail.jail_code
 from codejail.languages import python3
 from codejail.safe_exec import safe_exec, not_safe_exec
+from codejail.exceptions import SafeExecException
+from sqlalchemy import and_, bindparam, event, func
+from sqlalchemy.orm import undefer
 
 
+import atexit
+import collections
 import contextlib
+import datetime
+import functools
+import itertools
 import os
 import shutil
 import tempfile
-import math
+import threading
+import time
+import concurrent.futures
+import traceback
 
-import _thread
+# Keys of the session info: the callbacks waiting for the commit and
+# whether the session has changes in a transaction
+AFTER_COMMIT = "battleground.after_commit"
+IN_TRANSACTION = "battleground.in_transaction"
+
+
+@event.listens_for(entity.session_factory, "after_begin")
+def _transaction_began(session, transaction, connection):
+    session.info[IN_TRANSACTION] = True
+
+
+@event.listens_for(entity.session_factory, "after_commit")
+def _transaction_committed(session):
+    session.info[IN_TRANSACTION] = False
+    for callback in session.info.pop(AFTER_COMMIT, ()):
+        callback()
+
+
+@event.listens_for(entity.session_factory, "after_rollback")
+def _transaction_rolled_back(session):
+    session.info[IN_TRANSACTION] = False
+    session.info.pop(AFTER_COMMIT, None)
+
+
+class Context:
+    """
+    Context of the operations of the services: the session they work in
+    and the logged user
+    The services of a context share them and get the other services they
+    use from it. The default context of ServiceFactory works in the thread
+    local entity.session and commits every change. Context.scope() makes
+    a unit of work with a session of its own, which flushes the changes as
+    they happen and commits them once, at its end.
+    """
+
+    def __init__(self, session=None, user=None, autocommit=None):
+        self.session = entity.session if session is None else session
+        self.user = user
+        if autocommit is None:
+            autocommit = session is None
+        self.autocommit = autocommit
+        self._services = {}
+
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls, user_id=None):
+        """
+        A unit of work of the user with user_id, or of nobody logged
+        The operations in it are committed together when it ends, or
+        rolled back if it raises. The operations which start battles
+        commit the changes before them, so the battles see them.
+        """
+        with entity.session_scope() as session:
+            user = None
+            if user_id is not None:
+                user = session.query(entity.User).get(user_id)
+            yield cls(session, user)
+
+    def get_service(self, cls):
+        """
+        Returns the service of the class working in the context
+        """
+        service = self._services.get(cls)
+        if service is None:
+            service = self._services.setdefault(cls, cls(self))
+        return service
+
+    def commit(self):
+        """
+        Commits the changes, or only flushes them in a unit of work
+        """
+        if self.autocommit:
+            self.session.commit()
+        else:
+            self.session.flush()
+
+    def after_commit(self, callback, *args):
+        """
+        Calls callback with args once the changes of the session are
+        committed, at once if it has none, and drops it if they are rolled
+        back. Call it before the changes are committed.
+        The caches shared by the contexts are updated by such callbacks,
+        so they never have changes which were not committed.
+        """
+        session = self.session
+        if session.info.get(IN_TRANSACTION) or session.new or \
+                session.dirty or session.deleted:
+            session.info.setdefault(AFTER_COMMIT, []).append(
+                functools.partial(callback, *args))
+        else:
+            callback(*args)
 
 
 class ServiceFactory:
     """
-    ServiceFactory class keeps the services' instances
-    and only one instance of a service is created
+    ServiceFactory class keeps the services' instances of the default
+    context and only one instance of a service is created
     """
+    @classmethod
+    def get_context(cls):
+        if not hasattr(cls, "_ServiceFactory__context"):
+            cls.__context = Context()
+        return cls.__context
+
     @classmethod
     def get_user_service(cls):
-        if not hasattr(cls, "_ServiceFactory__user_service"):
-            cls.__user_service = UserService()
-        return cls.__user_service
+        return cls.get_context().get_service(UserService)
 
     @classmethod
     def get_game_service(cls):
-        if not hasattr(cls, "_ServiceFactory__game_service"):
-            cls.__game_service = GameService()
-        return cls.__game_service
+        return cls.get_context().get_service(GameService)
 
     @classmethod
     def get_bot_service(cls):
-        if not hasattr(cls, "_ServiceFactory__bot_service"):
-            cls.__bot_service = BotService()
-        return cls.__bot_service
+        return cls.get_context().get_service(BotService)
 
     @classmethod
     def get_battle_service(cls):
-        if not hasattr(cls, "_ServiceFactory__battle_service"):
-            cls.__battle_service = BattleService()
-        return cls.__battle_service
+        return cls.get_context().get_service(BattleService)
+
+    @classmethod
+    def get_tournament_service(cls):
+        return cls.get_context().get_service(TournamentService)
 
     @classmethod
     def get_matchmaking_service(cls):
-        if not hasattr(cls, "_ServiceFactory__matchmaking_service"):
-            cls.__matchmaking_service = MatchMakingService()
-        return cls.__matchmaking_service
+        return cls.get_context().get_service(MatchMakingService)
+
+    @classmethod
+    def get_leaderboard_service(cls):
+        return cls.get_context().get_service(LeaderboardService)
+
+    @classmethod
+    def get_stats_service(cls):
+        return cls.get_context().get_service(StatsService)
 
 
 class Service:
-    def __init__(self):
-        pass
+    def __init__(self, context=None):
+        if context is None:
+            context = ServiceFactory.get_context()
+        self.context = context
+
+    @property
+    def session(self):
+        return self.context.session
 
     def update_entity(self, item):
-        entity.session.add(item)
-        entity.session.commit()
+        self.session.add(item)
+        self.context.commit()
 
     def _remove(self, query, arg):
         if query.first():
             query.delete()
-            entity.session.commit()
+            self.context.commit()
         else:
             self._raise_not_found(arg)
 
     def _get_query(self):
-        return entity.session.query(self._get_entity_cls())
+        return self.session.query(self._get_entity_cls())
 
     def _get_filtered_query(self, **keywords):
         return self._get_query().filter_by(**keywords)
 
     def get_logged_user(self):
-        user = ServiceFactory.get_user_service().current_user
+        user = self.context.user
         if user is None:
             raise err.LogInRequiredError("You need to be logged in "
                                          "to perform this operation")
@@ -83,7 +210,7 @@ class Service:
     def get_by_id(self, id):
         result = self._get_filtered_query(id=id).first()
         if result is None:
-            self._raise_not_found(name)
+            self._raise_not_found(id)
         return result
 
     def get_by_name(self, name):
@@ -93,7 +220,7 @@ class Service:
         return result
 
     def get_all(self):
-        return entity.session.query(self._get_entity_cls()).all()
+        return self.session.query(self._get_entity_cls()).all()
 
 
 class GameService(Service):
@@ -111,6 +238,16 @@ class GameService(Service):
         The final_order variable should be sorted
         staring with the winner and finishing with the loser
         If the game is a draw final_order is set to None
+        The game can append its moves, as numbers below 2 ** 16, to the
+        global list moves, which is kept in the move log
+        When BattleService.POSITION_CACHE is set, a chess game gets the
+        path of the shared PositionCache in the global position_cache, to
+        open read only and pass as the cache of its sunfish.Searcher, and
+        a path in the global searched_positions, where it can dump the
+        table of its searcher with PositionCache.dump. The dumped table is
+        merged into the cache after the battle, without the entries a
+        search could not have stored, and the moves of the cache are only
+        played when they are legal in the searched position.
         """
         try:
             game = self.get_by_name(name.strip())
@@ -152,6 +289,16 @@ class GameService(Service):
             self.update_entity(game)
             return game
 
+    def get_game_id(self, game_name):
+        """
+        Returns the id of the game without loading it
+        """
+        game_id = self.session.query(entity.Game.id).filter_by(
+            name=game_name.strip()).scalar()
+        if game_id is None:
+            self._raise_not_found(game_name)
+        return game_id
+
     def _raise_not_found(self, name):
         error = "Game with name [%s] does not exist" % name
         raise err.GameNotExistsError(error)
@@ -167,9 +314,13 @@ class UserService(Service):
     UserService class provides base operations to manage users
     """
 
-    def __init__(self):
-        super().__init__()
-        self.current_user = None
+    @property
+    def current_user(self):
+        return self.context.user
+
+    @current_user.setter
+    def current_user(self, user):
+        self.context.user = user
 
     def add_user(self, name, password, rights=UserRights.USER):
         """
@@ -290,7 +441,7 @@ class BotService(Service):
             error = "Bot with name [%s] already exists" % bot_name
             raise err.BotExistsError(error)
         except err.BotNotExistsError:
-            game = ServiceFactory.get_game_service().get_by_name(game_name)
+            game = self.context.get_service(GameService).get_by_name(game_name)
             bot = entity.Bot(
                 rating=BotService.STARTING_BOT_RATING,
                 game_id=game.id,
@@ -299,12 +450,18 @@ class BotService(Service):
                 name=bot_name,
                 version=1,
                 ready_state=BotReadyState.NOT_READY)
-            self.update_entity(bot)
+            self.session.add(bot)
+            self.session.flush()
+            self.context.get_service(LeaderboardService).bot_changed(
+                bot.id, bot.game_id, bot.rating, bot.name, user.name)
+            self.context.commit()
             return bot
 
     def update_ready_state(self, bot_name, ready_state):
         bot = self.get_by_name(bot_name)
         bot.ready_state = ready_state
+        self.context.get_service(MatchMakingService).bot_changed(
+            bot.id, bot.game_id, bot.rating, bot.ready_state)
         self.update_entity(bot)
         return bot
 
@@ -316,6 +473,8 @@ class BotService(Service):
         bot = self.get_by_name(bot_name)
         bot.source = source
         bot.version += 1
+        self.context.get_service(MatchMakingService).bot_changed(
+            bot.id, bot.game_id, bot.rating, bot.ready_state)
         self.update_entity(bot)
         return bot
 
@@ -324,6 +483,11 @@ class BotService(Service):
         bot_query = self._get_filtered_query(
             name=name,
             author=self.get_logged_user())
+        bot_ids = [bot_id for bot_id, in
+                   bot_query.with_entities(entity.Bot.id)]
+        for bot_id in bot_ids:
+            self.context.get_service(MatchMakingService).bot_removed(bot_id)
+            self.context.get_service(LeaderboardService).bot_removed(bot_id)
         self._remove(bot_query, name)
 
     def get_by_name(self, name):
@@ -339,7 +503,7 @@ class BotService(Service):
         This operation requires ADMIN rights and can retrieve a bot
         by user_name and bot_name
         """
-        user = ServiceFactory.get_user_service().get_by_name(user_name)
+        user = self.context.get_service(UserService).get_by_name(user_name)
         bot = self._get_filtered_query(name=bot_name, author=user).first()
         if bot is None:
             self._raise_not_found(user_name)
@@ -356,6 +520,8 @@ class BattleState:
     PREPARED = "PREPARED"
     RUNNING = "THE FIGHT IS ON"
     CONCLUDED = "CONCLUDED"
+    CANCELLED = "CANCELLED"
+    FAILED = "FAILED"
 
 
 class BattleService(Service):
@@ -365,126 +531,545 @@ class BattleService(Service):
 
     ENV_PATH = '/home/denis/university/python/sandbox_virtualenv/bin/python'
 
-    def battle_bots(self, *bots, ranked=False):
+    CHESS_PATH = '/home/denis/university/python/BattleGround/battleground/'
+    CHESS_MODULES = ('tools.py', 'sunfish.py', 'bitboard.py', 'poscache.py')
+
+    # Battles are executed by a pool of sandbox workers which have already
+    # imported the chess modules. A pool size of 0 starts a new codejail
+    # sandbox for every battle instead.
+    SANDBOX_POOL_SIZE = sandbox.POOL_SIZE
+    SANDBOX_MAX_BATTLES = sandbox.MAX_BATTLES
+    SANDBOX_TIMEOUT = sandbox.BATTLE_TIMEOUT
+    SANDBOX_LIMITS = sandbox.LIMITS
+    _sandbox_pool = None
+    _start_lock = threading.Lock()
+
+    # Battles wait in a queue for one of the BATTLE_WORKERS threads.
+    # battle_bots waits up to BATTLE_QUEUE_TIMEOUT seconds for a place in
+    # the queue (None waits as long as it takes).
+    BATTLE_WORKERS = scheduler.WORKERS
+    BATTLE_QUEUE_SIZE = scheduler.QUEUE_SIZE
+    BATTLE_QUEUE_TIMEOUT = None
+    _scheduler = None
+
+    # The results of the battles are written in batches of up to
+    # CONCLUDE_BATCH_SIZE battles, CONCLUDE_FLUSH_INTERVAL seconds after the
+    # first battle of the batch concluded.
+    CONCLUDE_BATCH_SIZE = ingest.BATCH_SIZE
+    CONCLUDE_FLUSH_INTERVAL = ingest.FLUSH_INTERVAL
+    _ingestion = None
+
+    # Directory of the bot modules and their bytecode, kept between battles
+    MODULE_STORE = config.MODULE_STORE
+    _module_store = None
+
+    # Path of the PositionCache shared by the chess battles, None disables it
+    POSITION_CACHE = None
+
+    # Path of the log of the moves of the battles, None disables it
+    MOVE_LOG = config.MOVE_LOG or None
+    _move_log = None
+
+    @classmethod
+    def get_sandbox_pool(cls):
+        """
+        Returns the pool of sandbox workers, starting it on first use
+        """
+        with cls._start_lock:
+            if cls._sandbox_pool is None:
+                modules = [os.path.join(cls.CHESS_PATH, module)
+                           for module in cls.CHESS_MODULES]
+                pool = sandbox.SandboxPool(
+                    cls.ENV_PATH,
+                    modules,
+                    size=cls.SANDBOX_POOL_SIZE,
+                    max_battles=cls.SANDBOX_MAX_BATTLES,
+                    timeout=cls.SANDBOX_TIMEOUT,
+                    limits=cls.SANDBOX_LIMITS)
+                pool.start()
+                atexit.register(pool.close)
+                cls._sandbox_pool = pool
+            return cls._sandbox_pool
+
+    @classmethod
+    def check_sandbox_pool(cls):
+        """
+        Health check of the sandbox workers, replacing the broken ones
+        Returns the number of running workers.
+        """
+        return cls.get_sandbox_pool().check()
+
+    @classmethod
+    def get_scheduler(cls):
+        """
+        Returns the scheduler running the battles, starting it on first use
+        """
+        with cls._start_lock:
+            if cls._scheduler is None:
+                cls._scheduler = scheduler.BattleScheduler(
+                    cls.BATTLE_WORKERS, cls.BATTLE_QUEUE_SIZE)
+                atexit.register(cls._scheduler.shutdown)
+            return cls._scheduler
+
+    @classmethod
+    def shutdown_scheduler(cls, wait=True, cancel_pending=False):
+        """
+        Stops the scheduler, see BattleScheduler.shutdown, and stores the
+        battles it cancelled as cancelled, like cancel_battle does
+        The next battle starts a new scheduler.
+        """
+        with cls._start_lock:
+            battle_scheduler, cls._scheduler = cls._scheduler, None
+        if battle_scheduler is None:
+            return
+        battle_ids = [future.battle_id for future in
+                      battle_scheduler.shutdown(wait, cancel_pending)]
+        if battle_ids:
+            with entity.session_scope() as session:
+                session.query(entity.Battle).\
+                    filter(entity.Battle.id.in_(battle_ids)).\
+                    update({entity.Battle.state: BattleState.CANCELLED},
+                           synchronize_session=False)
+
+    @classmethod
+    def get_ingestion(cls):
+        """
+        Returns the pipeline writing the results of the battles, starting
+        it on first use
+        """
+        with cls._start_lock:
+            if cls._ingestion is None:
+                cls._ingestion = ingest.IngestionPipeline(
+                    cls._conclude_batch, cls.CONCLUDE_BATCH_SIZE,
+                    cls.CONCLUDE_FLUSH_INTERVAL)
+                atexit.register(cls._ingestion.shutdown)
+            return cls._ingestion
+
+    @classmethod
+    def _conclude_batch(cls, conclusions):
+        """
+        Writes a batch of ingest.Conclusions in one transaction
+        """
+        with Context.scope() as context:
+            service = context.get_service(BattleService)
+            for ranked in (False, True):
+                batch = [conclusion for conclusion in conclusions
+                         if bool(conclusion.ranked) == ranked]
+                if not batch:
+                    continue
+                service.conclude_battles(
+                    {conclusion.battle_id: conclusion.final_order
+                     for conclusion in batch},
+                    ranked, commit=False,
+                    moves={conclusion.battle_id: conclusion.moves
+                           for conclusion in batch},
+                    concluded_at={conclusion.battle_id:
+                                  conclusion.concluded_at
+                                  for conclusion in batch},
+                    stats={conclusion.battle_id: conclusion.stats
+                           for conclusion in batch})
+
+    def battle_bots(self, *bots, ranked=False, keep_order=False):
         """
         Battles multiple bots which play the same game
-        This is only one battle.
+        This is only one battle. It is queued and runs in the background,
+        the returned future has the battle_id and gives the final order
+        of the battle or raises its error.
+        The game gets the bots from the weakest to the strongest, or in the
+        given order with keep_order, e.g. for the sides of a pairing.
         """
         game = bots[0].game
         for bot in bots:
             if bot.game_id != game.id:
                 error = "Not all bots play the same game"
                 raise err.IncompatibleBotsError(error)
-        battle = self.__create_battle(bots)
-        self.__start_battle(battle, game, bots, ranked)
-
-    def __create_battle(self, bots):
+        # the ids are read before the battle is stored, reading them after
+        # the commit would load the bots before the battle changes them
+        bot_ids = [bot.id for bot in bots]
+        battle_id, = self.create_battles([bots], commit=False)
+        # committed even in a unit of work, the battle thread loads it
+        self.session.commit()
+        return self.__start_battle(battle_id, game.id, bot_ids, ranked,
+                                   keep_order)
+
+    def start_battle(self, battle_id, ranked=False, keep_order=False):
+        """
+        Queues a battle stored in prepared state, e.g. by a tournament
+        With keep_order the game gets the bots in the order they were
+        stored.
+        Returns a future like battle_bots.
+        """
+        fighters = self.session.query(
+            entity.Fighter.bot_id, entity.Bot.game_id).\
+            join(entity.Bot, entity.Fighter.bot).\
+            filter(entity.Fighter.battle_id == battle_id).\
+            order_by(entity.Fighter.id).all()
+        if not fighters:
+            self._raise_not_found(battle_id)
+        bot_ids = [bot_id for bot_id, _ in fighters]
+        return self.__start_battle(battle_id, fighters[0][1], bot_ids, ranked,
+                                   keep_order)
+
+    def cancel_battle(self, future):
         """
-        Stores a battle in prepared state and returns it
+        Cancels a battle which has not started yet
+        Returns False if the battle is already running or finished.
         """
-        battle = entity.Battle(state=BattleState.PREPARED)
-        entity.session.add(battle)
-        [entity.session.add(bot.to_fighter(battle)) for bot in bots]
-        entity.session.commit()
-        return battle
+        if not future.cancel():
+            return False
+        battle = self.get_by_id(future.battle_id)
+        battle.state = BattleState.CANCELLED
+        self.update_entity(battle)
+        return True
+
+    def wait_battles(self, futures, timeout=None,
+                     return_when=concurrent.futures.ALL_COMPLETED):
+        """
+        Waits for the battles of the futures returned by battle_bots
+        Returns the sets of done and not done futures.
+        """
+        return concurrent.futures.wait(futures, timeout, return_when)
 
-    def __start_battle(self, battle, game, bots, ranked):
+    def create_battles(self, pairings, tournament_id=None, round=None,
+                       commit=True):
         """
-        Starts an async thred that executes the battle
-        The battle changes its state from running to concluded and
-        when it finishes it updates the fighters final positions
-        and then updated the bot rating based on the elo system
+        Stores a battle in prepared state for every list of bots in
+        pairings, all at once
+        The battles of a tournament round, which has no battles yet, are
+        inserted by a single executemany and their ids are selected by the
+        round. Other battles are inserted one by one, to get their ids. The
+        fighters are inserted by a single executemany.
+        Returns the ids of the battles.
+        """
+        battles = [{"state": BattleState.PREPARED,
+                    "tournament_id": tournament_id,
+                    "round": round} for _ in pairings]
+        if tournament_id is not None and battles:
+            self.session.execute(entity.Battle.__table__.insert(), battles)
+            battle_ids = [battle_id for battle_id, in self.session.query(
+                entity.Battle.id).
+                filter_by(tournament_id=tournament_id, round=round).
+                order_by(entity.Battle.id)]
+        else:
+            self.session.bulk_insert_mappings(
+                entity.Battle, battles, return_defaults=True)
+            battle_ids = [battle["id"] for battle in battles]
+        self.session.bulk_insert_mappings(entity.Fighter, [
+            {"battle_id": battle_id,
+             "bot_id": bot.id,
+             "bot_version": bot.version,
+             "battle_place": -1}
+            for battle_id, bots in zip(battle_ids, pairings) for bot in bots])
+        if commit:
+            self.context.commit()
+        return battle_ids
+
+    def conclude_battles(self, results, ranked=False, commit=True,
+                         moves=None, concluded_at=None, stats=None):
+        """
+        Concludes battles with their final orders, by battle id
+        A final order lists the indexes of the fighters, in the order they
+        were stored, from the winner to the loser, or is None for a draw.
+        The states, the places of the fighters and the battle counters are
+        written by a few batched statements. Ranked battles are rated in
+        the order of results.
+        moves -- the moves listed by the games, by battle id, which are
+        appended to the move log once the battles are committed
+        concluded_at -- when the battles concluded, by battle id, now for
+        the battles it does not have
+        stats -- the resources used by the battles, by battle id, as
+        returned by SandboxPool.run with the moves by bot id
         """
+        battle_ids = list(results)
+        fighters = self.session.query(
+            entity.Fighter.id, entity.Fighter.battle_id,
+            entity.Fighter.bot_id).\
+            filter(entity.Fighter.battle_id.in_(battle_ids)).\
+            order_by(entity.Fighter.battle_id, entity.Fighter.id)
+        places = []
+        battle_bots = []
+        for battle_id, battle_fighters in itertools.groupby(
+                fighters, key=lambda fighter: fighter.battle_id):
+            battle_fighters = list(battle_fighters)
+            final_order = results[battle_id]
+            if final_order is not None:
+                places.extend(
+                    {"id": fighter.id, "battle_place": final_order.index(i)}
+                    for i, fighter in enumerate(battle_fighters))
+            battle_bots.append([fighter.bot_id
+                                for fighter in battle_fighters])
+
+        now = datetime.datetime.utcnow()
+        concluded_at = concluded_at or {}
+        battles = {battle_id: {"id": battle_id,
+                               "state": BattleState.CONCLUDED,
+                               "ranked": ranked,
+                               "concluded_at": concluded_at.get(
+                                   battle_id, now)}
+                   for battle_id in battle_ids}
+        if moves and BattleService.MOVE_LOG:
+            # the log gets no records of battles which are rolled back,
+            # e.g. with a batch which is written again
+            self.context.after_commit(self.__log_moves, {
+                battle_id: battle_moves
+                for battle_id, battle_moves in moves.items()
+                if battle_moves and battle_id in battles})
+        self.session.bulk_update_mappings(
+            entity.Battle, [battles[battle_id] for battle_id in battle_ids])
+        if stats:
+            self.__store_stats({battle_id: battle_stats for battle_id,
+                                battle_stats in stats.items()
+                                if battle_stats and battle_id in battles})
+        self.session.bulk_update_mappings(entity.Fighter, places)
+        self.__count_battles(battle_bots)
+        if ranked:
+            self.rate_battles(battle_ids, commit=False)
+        if commit:
+            self.context.commit()
 
-        def execute_battle(bots, game, battle):
-            # update battle state to RUNNING
-            battle.state = BattleState.RUNNING
-            self.update_entity(battle)
+    @classmethod
+    def __log_moves(cls, moves):
+        """
+        Appends the moves of committed battles to the move log and stores
+        the offsets of their records
+        The battles whose moves can't be logged have none, they stay
+        concluded.
+        """
+        move_log = cls.get_move_log()
+        records = []
+        for battle_id, battle_moves in moves.items():
+            try:
+                offset, size = move_log.append(battle_id, battle_moves)
+            except (OSError, MoveLogError):
+                traceback.print_exc()
+                continue
+            records.append({"id": battle_id, "log_offset": offset,
+                            "log_size": size})
+        if not records:
+            return
+        try:
+            with entity.session_scope() as session:
+                session.bulk_update_mappings(entity.Battle, records)
+        except Exception:
+            traceback.print_exc()
 
-            # configure codejail
-            codejail.jail_code.configure(
-                'python',
-                BattleService.ENV_PATH,
-                lang=python3)
+    def __store_stats(self, stats):
+        """
+        Stores the resources used by the battles and the times of the moves
+        of their bots
+        """
+        self.session.bulk_insert_mappings(entity.BattleStats, [
+            {"battle_id": battle_id,
+             "wall_time": battle_stats.get("wall_time"),
+             "cpu_time": battle_stats.get("cpu_time"),
+             "peak_rss_mb": battle_stats.get("peak_rss_mb")}
+            for battle_id, battle_stats in stats.items()])
+        self.session.bulk_insert_mappings(entity.MoveStats, [
+            {"battle_id": battle_id,
+             "bot_id": bot_id,
+             "moves": moves["moves"],
+             "total_time": moves["total_time"],
+             "max_time": moves["max_time"],
+             "histogram": ",".join(map(str, moves["histogram"]))}
+            for battle_id, battle_stats in stats.items()
+            for bot_id, moves in (battle_stats.get("moves") or {}).items()])
+
+    def __start_battle(self, battle_id, game_id, bot_ids, ranked,
+                       keep_order):
+        """
+        Queues the battle in the scheduler which executes it in a thread
+        """
 
-            # sort bots by rating so the weakest start first
-            bots = sorted(bots, key=lambda bot: bot.rating)
+        def run_battle(bot_ids, game_id, battle_id):
+            # the battle has a session and a context of its own in the
+            # thread, so the entities are loaded again
+            session = entity.session_factory()
+            try:
+                context = Context(session, autocommit=True)
+                # the sources are deferred, the battle loads them at once
+                bots = {bot.id: bot for bot in session.query(entity.Bot).
+                        options(undefer("source")).
+                        filter(entity.Bot.id.in_(bot_ids))}
+                bots = [bots[bot_id] for bot_id in bot_ids]
+                game = session.query(entity.Game).\
+                    options(undefer("source")).get(game_id)
+                battle = session.query(entity.Battle).get(battle_id)
+                try:
+                    return context.get_service(BattleService).\
+                        __execute_battle(bots, game, battle, ranked,
+                                         keep_order)
+                except BaseException:
+                    session.rollback()
+                    battle.state = BattleState.FAILED
+                    session.commit()
+                    raise
+            finally:
+                session.close()
 
-            # work with a temporary directory where
-            # the sources are stored as modules
-            with self.__temp_directory() as temp_dir:
-                # create .py files with the bots source code
-                modules = self.__create_fighter_files(bots, temp_dir)
+        # start the battle in another thread
+        try:
+            future = self.get_scheduler().submit(
+                run_battle, bot_ids, game_id, battle_id,
+                timeout=BattleService.BATTLE_QUEUE_TIMEOUT)
+        except err.BattleQueueFullError:
+            battle = self.get_by_id(battle_id)
+            battle.state = BattleState.CANCELLED
+            self.update_entity(battle)
+            raise
+        future.battle_id = battle_id
+        return future
 
+    def __execute_battle(self, bots, game, battle, ranked, keep_order):
+        """
+        The battle changes its state from running to concluded and
+        when it finishes it updates the fighters final positions
+        and then updated the bot rating based on the elo system
+        """
+        # update battle state to RUNNING
+        battle.state = BattleState.RUNNING
+        self.update_entity(battle)
+
+        # sort bots by rating so the weakest start first, unless the
+        # order is given
+        fighter_indexes = list(range(len(bots)))
+        if not keep_order:
+            fighter_indexes.sort(key=lambda i: bots[i].rating)
+        bots = [bots[i] for i in fighter_indexes]
+
+        # the bot sources are modules in the module store
+        modules, python_path = self.__store_fighter_modules(bots)
+
+        # creating the namespace of the game
+        # the game can list its moves, as numbers below 2 ** 16
+        game_globals = {"final_order": [], "bots": modules, "moves": []}
+
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            # chess games can look up the positions searched in earlier
+            # battles and dump the tables of their searchers to be merged
+            if BattleService.POSITION_CACHE:
+                temp_dir = stack.enter_context(self.__temp_directory())
+                searched_path = os.path.join(temp_dir, "searched.tt")
+                game_globals["position_cache"] = \
+                    BattleService.POSITION_CACHE
+                game_globals["searched_positions"] = searched_path
+
+            # Executing the game in safe mode
+            if BattleService.SANDBOX_POOL_SIZE:
+                pool = BattleService.get_sandbox_pool()
+                try:
+                    stats = pool.run(game.source, game_globals,
+                                     python_path=python_path)
+                except err.SandboxError as error:
+                    # the same error as from safe_exec
+                    raise SafeExecException(str(error))
+            else:
+                codejail.jail_code.configure(
+                    'python',
+                    BattleService.ENV_PATH,
+                    lang=python3)
                 # workaround because of using chess implementations
                 # that require third-party modules
-                self.__copy_chess_files(temp_dir)
-
-                # creating the namespace of the game
-                game_globals = {"final_order": [], "bots": modules}
-
-                # Executing the game in safe mode
-                safe_exec(game.source, game_globals, python_path=[temp_dir])
+                python_path.append(self.__store_chess_modules())
+                safe_exec(game.source, game_globals,
+                          python_path=python_path)
+                # only the time of a codejail battle can be measured
+                stats = {"wall_time": time.perf_counter() - start,
+                         "cpu_time": None, "peak_rss_mb": None}
+
+            if BattleService.POSITION_CACHE and \
+                    os.path.exists(searched_path):
+                PositionCache.merge_file(
+                    BattleService.POSITION_CACHE, searched_path)
+
+        # the game numbers the bots from the weakest, the battle numbers
+        # the fighters in the order they were stored
+        final_order = game_globals['final_order']
+        if final_order is not None:
+            final_order = [fighter_indexes[i] for i in final_order]
+
+        # the moves of the bots are timed by their modules
+        bot_ids = {module: bot.id for module, bot in zip(modules, bots)}
+        stats = dict(stats or {})
+        stats["moves"] = {bot_ids[module]: moves for module, moves
+                          in (stats.get("moves") or {}).items()
+                          if module in bot_ids}
+
+        # the result is written with the results of the battles which
+        # conclude about the same time, the battle waits for it
+        self.get_ingestion().put(ingest.Conclusion(
+            battle.id, final_order, ranked, game_globals.get("moves"),
+            datetime.datetime.utcnow(), stats)).result()
+        return final_order
 
-            final_order = game_globals['final_order']
+    def _get_entity_cls(self):
+        return entity.Battle
 
-            # conclude the battle
-            battle.state = BattleState.CONCLUDED
-            entity.session.add(battle)
+    def _raise_not_found(self, id):
+        raise err.BattleNotExistsError("Battle [%s] does not exist" % id)
 
-            # update the battle place of the fighter
-            if final_order is not None:
-                for i, fighter in enumerate(battle.fighters):
-                    fighter.battle_place = final_order.index(i)
-                    entity.session.add(fighter)
-
-            # update the bots rating
-            if ranked:
-                if final_order is None:
-                    for i in range(len(battle.fighters) / 2):
-                        stronger = battle.fighters[-i - 1]
-                        weaker = battle.fighters[i]
-                        rating_diff = stronger - weaker
-                        rating_diff = round(rating_diff / 50)
-                        stronger.bot.rating -= rating_diff
-                        weaker.bot.rating += rating_diff
-                else:
-                    self.__update_bots_elo(battle.fighters, final_order)
-
-            # save all changes
-            entity.session.commit()
-
-            return final_order
+    @classmethod
+    def get_module_store(cls):
+        """
+        Returns the store of the modules used by the battles
+        """
+        with cls._start_lock:
+            if cls._module_store is None:
+                cls._module_store = ModuleStore(
+                    cls.MODULE_STORE, python=cls.ENV_PATH)
+            return cls._module_store
 
-        # start the battle in another thread
-        args = (bots, game, battle)
-        # _thread.start_new_thread(execute_battle, args)
-        execute_battle(bots, game, battle)
+    @classmethod
+    def get_move_log(cls):
+        """
+        Returns the log of the moves of the battles
+        """
+        with cls._start_lock:
+            if cls._move_log is None or cls._move_log.path != cls.MOVE_LOG:
+                cls._move_log = MoveLog(cls.MOVE_LOG)
+            return cls._move_log
 
-    def __create_fighter_files(self, bots, temp_dir):
+    def get_moves(self, battle_id):
+        """
+        Returns the moves the game of the battle listed, or an empty list if
+        it listed none
         """
-        Copying the bot sources to the temporary folder so that
-        the Game can use them as modules
+        row = self.session.query(
+            entity.Battle.log_offset, entity.Battle.log_size).\
+            filter(entity.Battle.id == battle_id).first()
+        if row is None:
+            self._raise_not_found(battle_id)
+        if row.log_offset is None:
+            return []
+        return self.get_move_log().read(battle_id, row.log_offset,
+                                        row.log_size)
+
+    def __store_fighter_modules(self, bots):
         """
+        Puts the bot sources in the module store so that the Game can
+        use them as modules
+        Returns the module names and the directories of the modules.
+        """
+        store = self.get_module_store()
         bot_modules = []
+        python_path = []
         for bot in bots:
             module_name = bot.author.name + bot.name
             bot_modules.append(module_name)
-            file_name = os.path.join(temp_dir, module_name + ".py")
-            with open(file_name, "w") as module_file:
-                module_file.write(bot.source)
-        return bot_modules
+            python_path.append(store.add({module_name: bot.source}))
+        return bot_modules, python_path
 
-    def __copy_chess_files(self, temp_dir):
+    def __store_chess_modules(self):
         """
         Workaraund for chess to enable unsave exec for debuging
+        Returns the directory of the chess modules in the module store.
         """
-        tools_path = '/home/denis/university/python/BattleGround/'\
-            'battleground/tools.py'
-        sunfish_path = '/home/denis/university/python/BattleGround/'\
-            'battleground/sunfish.py'
-        shutil.copy(tools_path, temp_dir)
-        shutil.copy(sunfish_path, temp_dir)
+        sources = {}
+        for module in BattleService.CHESS_MODULES:
+            path = os.path.join(BattleService.CHESS_PATH, module)
+            with open(path, encoding='utf-8') as module_file:
+                sources[os.path.splitext(module)[0]] = module_file.read()
+        return self.get_module_store().add(sources)
 
     @contextlib.contextmanager
     def __temp_directory(self):
@@ -500,107 +1085,769 @@ class BattleService(Service):
             # so don't ignore errors.
             shutil.rmtree(temp_dir)
 
-    def __update_bots_elo(self, fighters, final_order):
+    def rate_battles(self, battle_ids, commit=True):
         """
-        Calculates the updated ELO points and updates the bots
+        Rates concluded battles in the order of battle_ids, e.g. the
+        battles of a tournament round which were played unranked
+        The ratings are computed in one pass, see battleground.rating,
+        and stored in one bulk update. A draw moves points from the
+        stronger fighters to the weaker ones.
         Based on the algorithm / code presented here
         http://elo-norsak.rhcloud.com/index.php
         """
-        FAIR_FACTOR = self.__calculate_fair_factor(fighters)
-        K = 32 / (len(fighters) - 1)
-
-        for i, fighter in enumerate(fighters):
-            current_place = final_order.index(i) + 1
-            current_elo = fighter.bot.rating
-            elo_change = 0
-
-            for j, opponent in enumerate(fighters):
-                if i != j:
-                    opponent_place = final_order.index(j) + 1
-                    opponent_elo = opponent.bot.rating
-
-                    # work out S
-                    if current_place < opponent_place:
-                        S = 1.0
-                    elif current_place == opponent_place:
-                        S = 0.5
-                    else:
-                        S = 0.0
-
-                    # work out EA
-                    diff = (opponent_elo - current_elo)
-                    EA = 1 / (1.0 + math.pow(10.0, diff / 400.0))
-
-                    # calculate ELO change vs this one opponent,
-                    # add it to our change bucket
-                    elo_change += K * (S - EA)
-
-            # add accumulated change to initial ELO for final ELO
-            fighter.bot.rating += round(elo_change * FAIR_FACTOR)
-            entity.session.add(fighter.bot)
-
-    def __calculate_fair_factor(self, fighters):
-        """
-        The FAIR_FACTOR is used to lower the prices and losses in ranked
-        battles and stimulate the playing agains random opponent.
-        The FAIR_FACTOR is bigger if the ratio between all battles
-        played by bots and battles between the specified fighters is lower
-        If the bots play frequently agains one another the FAIR_FACTOR
-        will be lower and the bounty will decrease.
-        """
-        bot_to_battle_ids = self.__get_bots_to_battle_ids_hash(fighters)
-        result = 0
-        for bot_id1, battle_ids1 in bot_to_battle_ids.items():
-            if len(battle_ids1) < 3:
-                result += 1
+        order = {battle_id: i for i, battle_id in enumerate(battle_ids)}
+        fighters = self.session.query(
+            entity.Fighter.battle_id, entity.Fighter.bot_id,
+            entity.Fighter.battle_place).\
+            join(entity.Battle, entity.Fighter.battle).\
+            filter(entity.Battle.id.in_(order),
+                   entity.Battle.state == BattleState.CONCLUDED).\
+            order_by(entity.Fighter.battle_id, entity.Fighter.id)
+        battles = sorted(
+            ((battle_id, list(battle_fighters))
+             for battle_id, battle_fighters in itertools.groupby(
+                 fighters, key=lambda fighter: fighter.battle_id)),
+            key=lambda battle: order[battle[0]])
+        bots = {bot.id: bot for bot in self.session.query(
+            entity.Bot.id, entity.Bot.rating, entity.Bot.game_id,
+            entity.Bot.ready_state).filter(entity.Bot.id.in_(
+                {fighter.bot_id for _, battle_fighters in battles
+                 for fighter in battle_fighters}))}
+        counts, shared = self.__get_battle_counts(list(bots))
+
+        rated_battles = []
+        rated_ids = []
+        for battle_id, battle_fighters in battles:
+            bot_ids = [fighter.bot_id for fighter in battle_fighters]
+            # the battles of removed bots are not rated
+            if any(bot_id not in bots for bot_id in bot_ids):
                 continue
-            fair_factor = 0
-            for bot_id2, battle_ids2 in bot_to_battle_ids.items():
-                if bot_id1 != bot_id2:
-                    if len(battle_ids2) < 3:
-                        fair_factor += 1
-                        continue
-                    def func(battle_id):
-                        return battle_id not in battle_ids2
-                    unique = len(list(filter(func, battle_ids1))) + 1
-                    fair_factor += unique / len(battle_ids1)
-            result += (fair_factor / (len(fighters) - 1))
-        return result / len(fighters);
-
-    def __get_bots_to_battle_ids_hash(self, fighters):
-        def func(bot):
-            return [fighter.battle.id for fighter in bot.fighters]
-        return {fighter.bot.id: func(fighter.bot) for fighter in fighters}
-
-
-class MatchMakingService:
+            places = [fighter.battle_place for fighter in battle_fighters]
+            if all(place == -1 for place in places):
+                final_order, fair_factor = None, None
+            else:
+                final_order = sorted(range(len(places)),
+                                     key=places.__getitem__)
+                # the FAIR_FACTOR lowers the prices and losses of bots
+                # which play one another often
+                fair_factor = rating.fair_factor(
+                    {bot_id: counts[bot_id] for bot_id in bot_ids},
+                    shared, len(bot_ids))
+            rated_battles.append((bot_ids, final_order, fair_factor))
+            rated_ids.append(battle_id)
+
+        ratings = rating.replay(
+            {bot_id: bot.rating for bot_id, bot in bots.items()},
+            rated_battles)
+        if rated_ids:
+            self.session.query(entity.Battle).\
+                filter(entity.Battle.id.in_(rated_ids)).\
+                update({entity.Battle.ranked: True},
+                       synchronize_session=False)
+        self.session.bulk_update_mappings(entity.Bot, [
+            {"id": bot_id, "rating": bot_rating}
+            for bot_id, bot_rating in ratings.items()])
+
+        matchmaking_service = self.context.get_service(MatchMakingService)
+        leaderboard_service = self.context.get_service(LeaderboardService)
+        for bot_id, bot in bots.items():
+            matchmaking_service.bot_changed(
+                bot_id, bot.game_id, ratings[bot_id], bot.ready_state)
+            leaderboard_service.bot_changed(
+                bot_id, bot.game_id, ratings[bot_id])
+        if commit:
+            self.context.commit()
+
+    def __get_battle_counts(self, bot_ids):
+        """
+        Returns the concluded battles of every bot and the battles of every
+        pair of the bots with one another, by (bot_id1, bot_id2) pairs
+        """
+        query = self.session.query
+        battles = {bot_id: count or 0 for bot_id, count in
+                   query(entity.Bot.id, entity.Bot.battles).
+                   filter(entity.Bot.id.in_(bot_ids))}
+        head_to_head = entity.HeadToHead
+        shared = {(bot_id1, bot_id2): count for bot_id1, bot_id2, count in
+                  query(head_to_head.bot_id1, head_to_head.bot_id2,
+                        head_to_head.battles).
+                  filter(head_to_head.bot_id1.in_(bot_ids),
+                         head_to_head.bot_id2.in_(bot_ids))}
+        return battles, shared
+
+    def __count_battles(self, battle_bots):
+        """
+        Adds concluded battles, given by the ids of their bots, to the
+        battles of the bots and of every pair of them
+        The counters are incremented by the database, so the battles which
+        conclude at the same time are all counted.
+        """
+        battles = collections.Counter()
+        shared = collections.Counter()
+        for bot_ids in battle_bots:
+            bot_ids = sorted(set(bot_ids))
+            battles.update(bot_ids)
+            shared.update(itertools.combinations(bot_ids, 2))
+        if not battles:
+            return
+
+        bots = entity.Bot.__table__
+        self.session.execute(
+            bots.update().
+            where(bots.c.id == bindparam("bot_id")).
+            values(battles=func.coalesce(bots.c.battles, 0) +
+                   bindparam("count")),
+            [{"bot_id": bot_id, "count": count}
+             for bot_id, count in battles.items()])
+        head_to_head = entity.HeadToHead.__table__
+        _, existing = self.__get_battle_counts(list(battles))
+        if existing.keys() & shared.keys():
+            self.session.execute(
+                head_to_head.update().
+                where(and_(head_to_head.c.bot_id1 == bindparam("id1"),
+                           head_to_head.c.bot_id2 == bindparam("id2"))).
+                values(battles=head_to_head.c.battles + bindparam("count")),
+                [{"id1": bot_id1, "id2": bot_id2, "count": count}
+                 for (bot_id1, bot_id2), count in shared.items()
+                 if (bot_id1, bot_id2) in existing])
+        self.session.bulk_insert_mappings(entity.HeadToHead, [
+            {"bot_id1": bot_id1, "bot_id2": bot_id2, "battles": count}
+            for (bot_id1, bot_id2), count in shared.items()
+            if (bot_id1, bot_id2) not in existing])
+
+    def count_battles(self):
+        """
+        Counts the concluded battles of all bots and pairs of bots again
+        from their fighters, e.g. for battles from before the counters
+        """
+        battles = collections.Counter()
+        shared = collections.Counter()
+        fighters = self.session.query(
+            entity.Fighter.battle_id, entity.Fighter.bot_id).\
+            join(entity.Battle).\
+            filter(entity.Battle.state == BattleState.CONCLUDED).\
+            order_by(entity.Fighter.battle_id).yield_per(1000)
+        for _, battle_fighters in itertools.groupby(
+                fighters, key=lambda fighter: fighter[0]):
+            bot_ids = sorted({bot_id for _, bot_id in battle_fighters})
+            battles.update(bot_ids)
+            shared.update(itertools.combinations(bot_ids, 2))
+
+        bot_ids = [bot_id for bot_id, in
+                   self.session.query(entity.Bot.id)]
+        self.session.query(entity.HeadToHead).delete()
+        self.session.bulk_insert_mappings(entity.HeadToHead, [
+            {"bot_id1": bot_id1, "bot_id2": bot_id2, "battles": count}
+            for (bot_id1, bot_id2), count in shared.items()])
+        self.session.bulk_update_mappings(entity.Bot, [
+            {"id": bot_id, "battles": battles[bot_id]}
+            for bot_id in bot_ids])
+        self.context.commit()
+
+
+class TournamentKind:
+    ROUND_ROBIN = "ROUND_ROBIN"
+    DOUBLE_ROUND_ROBIN = "DOUBLE_ROUND_ROBIN"
+    SWISS = "SWISS"
+
+
+class TournamentState:
+    CREATED = "CREATED"
+    RUNNING = "RUNNING"
+    FINISHED = "FINISHED"
+
+
+class TournamentService(Service):
+    """
+    TournamentService runs tournaments of one on one battles
+    Every round is stored before its battles start and the tournament
+    remembers its finished rounds, so a tournament stopped in the middle
+    continues from its last round when it is run again.
+    """
+
+    # Points for a win and a draw, a bye in a Swiss round counts as a win
+    WIN_POINTS = 1.0
+    DRAW_POINTS = 0.5
+    # Times a failed battle is played again before its round fails
+    BATTLE_RETRIES = 1
+
+    def create_tournament(self, name, game_name, bots,
+                          kind=TournamentKind.ROUND_ROBIN, rounds=None,
+                          ranked=False):
+        """
+        Creates a tournament between the bots playing the game
+        The bots are seeded by their rating. The number of rounds is only
+        used by Swiss tournaments, by default it is enough to find a single
+        winner.
+        """
+        user = self.get_logged_user()
+        name = name.strip()
+        try:
+            self.get_by_name(name)
+            error = "Tournament with name [%s] already exists" % name
+            raise err.TournamentExistsError(error)
+        except err.TournamentNotExistsError:
+            pass
+        game = self.context.get_service(GameService).get_by_name(game_name)
+        for bot in bots:
+            if bot.game_id != game.id:
+                error = "Bot [%s] does not play [%s]" % (bot.name, game.name)
+                raise err.IncompatibleBotsError(error)
+        if kind == TournamentKind.SWISS:
+            rounds = rounds or pairing.swiss_rounds(len(bots))
+        else:
+            double = kind == TournamentKind.DOUBLE_ROUND_ROBIN
+            rounds = pairing.round_robin_rounds(len(bots), double)
+        tournament = entity.Tournament(
+            name=name,
+            kind=kind,
+            state=TournamentState.CREATED,
+            ranked=ranked,
+            rounds=rounds,
+            current_round=0,
+            game=game,
+            author=user)
+        bots = sorted(bots, key=lambda bot: bot.rating, reverse=True)
+        for seed, bot in enumerate(bots, 1):
+            self.session.add(entity.TournamentEntry(
+                tournament=tournament, bot=bot, seed=seed,
+                points=0.0, played=0, byes=0))
+        self.update_entity(tournament)
+        return tournament
+
+    def run_tournament(self, name):
+        """
+        Plays the remaining rounds of the tournament, up to a round which
+        fails, see run_round
+        Returns the final standings.
+        """
+        tournament = self.get_by_name(name)
+        while tournament.state != TournamentState.FINISHED:
+            self.run_round(name)
+        return self.get_standings(name)
+
+    def run_round(self, name):
+        """
+        Plays the next round of the tournament, its battles in parallel
+        The standings are updated as the battles finish. A failed battle is
+        played again up to BATTLE_RETRIES times, then TournamentRoundError
+        is raised and the round is not finished.
+        Returns the standings after the round.
+        """
+        tournament = self.get_by_name(name)
+        if tournament.state == TournamentState.FINISHED:
+            return self.get_standings(name)
+        round = tournament.current_round + 1
+        tournament.state = TournamentState.RUNNING
+        battles = self.__get_round_battles(tournament, round)
+        if not battles:
+            battles = self.__create_round(tournament, round)
+        # the points are counted again, so the battles which finished
+        # before the tournament was stopped are not counted twice
+        self.__count_points(tournament)
+
+        # the battles of a ranked tournament are rated together with the
+        # round, at once, so a stopped round is not rated twice
+        battle_ids = [battle.id for battle in battles]
+        battle_service = self.context.get_service(BattleService)
+        entries = {entry.bot_id: entry for entry in tournament.entries}
+        # the battles which failed before are played again too
+        pending = [battle.id for battle in battles
+                   if battle.state != BattleState.CONCLUDED]
+        for _ in range(TournamentService.BATTLE_RETRIES + 1):
+            if not pending:
+                break
+            # the bots play on the sides of their pairing
+            futures = [battle_service.start_battle(battle_id,
+                                                   keep_order=True)
+                       for battle_id in pending]
+            pending = []
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    pending.append(future.battle_id)
+                    continue
+                for bot_id, points in self.__battle_points(future.battle_id):
+                    entries[bot_id].points += points
+                    entries[bot_id].played += 1
+                # committed even in a unit of work, the other battles
+                # wait for the database while it is locked by changes
+                self.session.commit()
+        if pending:
+            # the round stays the current one, so running the tournament
+            # again plays the failed battles once more
+            self.update_entity(tournament)
+            error = "Battles %s of round %d of tournament [%s] failed" % (
+                sorted(pending), round, name)
+            raise err.TournamentRoundError(error)
+
+        if tournament.ranked:
+            battle_service.rate_battles(battle_ids, commit=False)
+        tournament.current_round = round
+        if round >= tournament.rounds:
+            tournament.state = TournamentState.FINISHED
+        self.update_entity(tournament)
+        return self.get_standings(name)
+
+    def get_standings(self, name):
+        """
+        Returns the entries of the tournament from the first to the last
+        """
+        tournament = self.get_by_name(name)
+        return sorted(tournament.entries,
+                      key=lambda entry: (-entry.points, entry.seed))
+
+    def __get_round_battles(self, tournament, round):
+        return self.session.query(entity.Battle).\
+            filter_by(tournament_id=tournament.id, round=round).\
+            order_by(entity.Battle.id).all()
+
+    def __create_round(self, tournament, round):
+        """
+        Stores the battles of the round in prepared state, all at once
+        """
+        entries = {entry.id: entry for entry in tournament.entries}
+        if tournament.kind == TournamentKind.SWISS:
+            standings = [entry.id for entry in sorted(
+                entries.values(),
+                key=lambda entry: (-entry.points, entry.seed))]
+            byes = [entry.id for entry in entries.values() if entry.byes]
+            pairs, bye = pairing.swiss(
+                standings, self.__played_pairs(tournament), byes)
+            if bye is not None:
+                entries[bye].byes += 1
+                entries[bye].points += TournamentService.WIN_POINTS
+        else:
+            seeds = [entry.id for entry in tournament.entries]
+            pairs, bye = pairing.round_robin(seeds, round - 1)
+
+        # the bots are loaded at once, the entries find them by their ids
+        bots = {bot.id: bot for bot in self.session.query(entity.Bot).filter(
+            entity.Bot.id.in_([entry.bot_id for entry in entries.values()]))}
+        self.context.get_service(BattleService).create_battles(
+            [[bots[entries[entry_id].bot_id] for entry_id in pair]
+             for pair in pairs],
+            tournament.id, round, commit=False)
+        # committed even in a unit of work, the battle threads load them
+        self.session.commit()
+        return self.__get_round_battles(tournament, round)
+
+    def __played_pairs(self, tournament):
+        """
+        The pairs of entries which met in the tournament, as frozensets
+        """
+        entry_ids = {entry.bot_id: entry.id for entry in tournament.entries}
+        fighters = self.session.query(
+            entity.Fighter.battle_id, entity.Fighter.bot_id).\
+            join(entity.Battle, entity.Fighter.battle).\
+            filter(entity.Battle.tournament_id == tournament.id).\
+            order_by(entity.Fighter.battle_id)
+        return {frozenset(entry_ids[bot_id] for _, bot_id in group)
+                for _, group in itertools.groupby(
+                    fighters, key=lambda fighter: fighter.battle_id)}
+
+    def __battle_points(self, battle_id):
+        """
+        The bot ids of a concluded battle with the points they won
+        """
+        fighters = self.session.query(
+            entity.Fighter.bot_id, entity.Fighter.battle_place).\
+            filter_by(battle_id=battle_id)
+        return [(bot_id, self.__place_points(place))
+                for bot_id, place in fighters]
+
+    def __place_points(self, place):
+        # the fighters of a draw keep their initial place
+        if place == 0:
+            return TournamentService.WIN_POINTS
+        if place == -1:
+            return TournamentService.DRAW_POINTS
+        return 0.0
+
+    def __count_points(self, tournament):
+        """
+        Counts the points of the entries from the concluded battles
+        """
+        entries = {entry.bot_id: entry for entry in tournament.entries}
+        for entry in entries.values():
+            entry.points = entry.byes * TournamentService.WIN_POINTS
+            entry.played = 0
+        fighters = self.session.query(
+            entity.Fighter.bot_id, entity.Fighter.battle_place).\
+            join(entity.Battle, entity.Fighter.battle).\
+            filter(entity.Battle.tournament_id == tournament.id,
+                   entity.Battle.state == BattleState.CONCLUDED)
+        for bot_id, place in fighters:
+            entries[bot_id].points += self.__place_points(place)
+            entries[bot_id].played += 1
+        # committed even in a unit of work, before the battles start
+        self.session.commit()
+
+    def _get_entity_cls(self):
+        return entity.Tournament
+
+    def _raise_not_found(self, name):
+        error = "Tournament with name [%s] does not exist" % name
+        raise err.TournamentNotExistsError(error)
+
+
+class MatchMakingService(Service):
     """
     Basic operations to enable clallenging and finding battles
+    The bots in READY state are kept in a MatchmakingIndex, loaded on first
+    use and updated as the bots change. Bots waiting for a battle are
+    paired with opponents by a pairing loop.
     """
 
+    MAX_RATING_DIFF = 300
+    # Seconds between the passes of the pairing loop
+    PAIRING_INTERVAL = 1.0
+
+    # the index and the queue are shared by the services of all contexts
+    index = None
+    waiting = collections.OrderedDict()
+    _lock = threading.Lock()
+    _pairing_thread = None
+    _stop_pairing = threading.Event()
+
+    def get_index(self):
+        """
+        Returns the index of the READY bots, loading it on first use
+        """
+        with self._lock:
+            if self.index is None:
+                index = MatchmakingIndex()
+                bots = self.session.query(
+                    entity.Bot.id, entity.Bot.game_id, entity.Bot.rating).\
+                    filter_by(ready_state=BotReadyState.READY)
+                for bot_id, game_id, bot_rating in bots:
+                    index.update(bot_id, game_id, bot_rating)
+                MatchMakingService.index = index
+            return self.index
+
+    def bot_changed(self, bot_id, game_id, rating, ready_state):
+        """
+        Updates the bot in the index, if it is loaded already, once the
+        change is committed
+        """
+        self.context.after_commit(
+            self.__update_bot, bot_id, game_id, rating, ready_state)
+
+    def bot_removed(self, bot_id):
+        self.context.after_commit(self.__remove_bot, bot_id)
+
+    def __update_bot(self, bot_id, game_id, rating, ready_state):
+        if self.index is not None:
+            ready = ready_state == BotReadyState.READY
+            self.index.update(bot_id, game_id, rating, ready)
+
+    def __remove_bot(self, bot_id):
+        if self.index is not None:
+            self.index.remove(bot_id)
+        with self._lock:
+            self.waiting.pop(bot_id, None)
+
     def challenge(self, opponent_name, opponent_bot_name, bot_name):
         """
         Challenge a single opponent into a battle
         """
-        bot_service = ServiceFactory.get_bot_service()
-        battle_service = ServiceFactory.get_battle_service()
+        bot_service = self.context.get_service(BotService)
+        battle_service = self.context.get_service(BattleService)
 
         opponent_bot = bot_service.get_bot_for_user(
             opponent_name,
             opponent_bot_name)
-        if (opponent_bot.ready_state is not BotReadyState.READY) and\
-           (opponent_bot.ready_state is not BotReadyState.CHALLENGE):
-            error = "Bot [%s] cannot be challenged."
+        if opponent_bot.ready_state not in (BotReadyState.READY,
+                                            BotReadyState.CHALLENGE):
+            error = "Bot [%s] cannot be challenged." % opponent_bot_name
             raise err.NotReadyBotError(error)
 
-        user_bot = bot_service.by_name(bot_name)
-        battle_service.battle_bots(user_bot, opponent_bot, ranked=True)
-
+        user_bot = bot_service.get_by_name(bot_name)
         if user_bot.rating - opponent_bot.rating > 150:
             raise err.InvalidBotError("Pick a stronger opponent")
 
-    def find_opponent(self, bot_name, max_rating_diff=300):
+        self.get_index().played(user_bot.id, opponent_bot.id)
+        return battle_service.battle_bots(
+            user_bot, opponent_bot, ranked=True)
+
+    def find_opponent(self, bot_name, max_rating_diff=MAX_RATING_DIFF):
+        """
+        Returns the READY bot with the nearest rating to the bot of the
+        logged user, which is at most max_rating_diff away and has not
+        played the bot recently, or None if there is no such bot
+        """
+        bot = self.context.get_service(BotService).get_by_name(bot_name)
+        opponent_id = self.get_index().nearest(
+            bot.game_id, bot.rating, max_rating_diff, bot_id=bot.id)
+        if opponent_id is None:
+            return None
+        return self.session.query(entity.Bot).get(opponent_id)
+
+    def enqueue(self, bot_name, max_rating_diff=MAX_RATING_DIFF):
+        """
+        Puts the bot of the logged user in the queue of bots waiting for
+        a ranked battle, which the pairing loop starts once it finds an
+        opponent
+        """
+        bot = self.context.get_service(BotService).get_by_name(bot_name)
+        with self._lock:
+            self.waiting[bot.id] = max_rating_diff
+
+    def pair_waiting(self):
+        """
+        Pairs the waiting bots, the longest waiting first, with the nearest
+        opponents and starts their battles
+        Returns the futures of the battles.
+        """
+        index = self.get_index()
+        battle_service = self.context.get_service(BattleService)
+        with self._lock:
+            waiting = list(self.waiting.items())
+        futures = []
+        paired = set()
+        for bot_id, max_rating_diff in waiting:
+            if bot_id in paired:
+                continue
+            bot = self.session.query(entity.Bot).get(bot_id)
+            opponent_id = index.nearest(
+                bot.game_id, bot.rating, max_rating_diff,
+                bot_id=bot_id, exclude=paired)
+            if opponent_id is None:
+                continue
+            opponent = self.session.query(entity.Bot).get(opponent_id)
+            try:
+                futures.append(battle_service.battle_bots(
+                    bot, opponent, ranked=True))
+            except err.BattleQueueFullError:
+                # the bots wait for the next pass
+                break
+            index.played(bot_id, opponent_id)
+            paired.update((bot_id, opponent_id))
+            with self._lock:
+                self.waiting.pop(bot_id, None)
+                self.waiting.pop(opponent_id, None)
+        return futures
+
+    def start_pairing(self, interval=PAIRING_INTERVAL):
+        """
+        Starts the pairing loop in a thread, calling pair_waiting every
+        interval seconds
+        """
+        def pairing_loop():
+            while not self._stop_pairing.wait(interval):
+                try:
+                    # every pass is a unit of work of its own
+                    with Context.scope() as context:
+                        context.get_service(MatchMakingService).\
+                            pair_waiting()
+                except Exception:
+                    traceback.print_exc()
+
+        if self._pairing_thread is None:
+            self._stop_pairing.clear()
+            MatchMakingService._pairing_thread = threading.Thread(
+                target=pairing_loop, name="pairing-loop", daemon=True)
+            self._pairing_thread.start()
+
+    def stop_pairing(self):
+        if self._pairing_thread is not None:
+            self._stop_pairing.set()
+            self._pairing_thread.join()
+            MatchMakingService._pairing_thread = None
+
+
+class LeaderboardService(Service):
+    """
+    The rankings of the bots of every game
+    The ratings are kept in a Leaderboard, loaded on first use without the
+    bot sources and updated as the ratings change, so the queries don't
+    touch the database.
+    """
+
+    # the leaderboard and the names of the bots are shared by the services
+    # of all contexts
+    board = None
+    names = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drops the leaderboard, e.g. after the ratings were changed in the
+        database directly, it is loaded again on next use
+        """
+        with cls._lock:
+            cls.board = None
+            cls.names = {}
+
+    def get_board(self):
+        """
+        Returns the leaderboard of all bots, loading it on first use
+        """
+        with self._lock:
+            if self.board is None:
+                board = Leaderboard()
+                names = {}
+                bots = self.session.query(
+                    entity.Bot.id, entity.Bot.game_id, entity.Bot.rating,
+                    entity.Bot.name, entity.User.name).\
+                    join(entity.User, entity.Bot.author)
+                for bot_id, game_id, bot_rating, name, author in bots:
+                    board.update(bot_id, game_id, bot_rating)
+                    names[bot_id] = (name, author)
+                LeaderboardService.board = board
+                LeaderboardService.names = names
+            return self.board
+
+    def bot_changed(self, bot_id, game_id, rating, name=None, author=None):
+        """
+        Updates the rating of the bot, if the leaderboard is loaded already,
+        once the change is committed
+        """
+        self.context.after_commit(
+            self.__update_bot, bot_id, game_id, rating, name, author)
+
+    def bot_removed(self, bot_id):
+        self.context.after_commit(self.__remove_bot, bot_id)
+
+    def __update_bot(self, bot_id, game_id, rating, name, author):
+        with self._lock:
+            if self.board is None:
+                return
+            if name is not None:
+                self.names[bot_id] = (name, author)
+            self.board.update(bot_id, game_id, rating)
+
+    def __remove_bot(self, bot_id):
+        with self._lock:
+            if self.board is not None:
+                self.board.remove(bot_id)
+                self.names.pop(bot_id, None)
+
+    def get_top(self, game_name, count=10):
+        """
+        Returns the count bots of the game with the highest rating, as
+        (rank, bot name, author name, rating)
+        """
+        game_id = self.context.get_service(GameService).get_game_id(game_name)
+        return self.__named(self.get_board().top(game_id, count))
+
+    def get_page(self, game_name, page, size=PAGE_SIZE):
+        """
+        Returns a page of the leaderboard of the game, counting from 0,
+        like get_top
+        """
+        game_id = self.context.get_service(GameService).get_game_id(game_name)
+        return self.__named(self.get_board().page(game_id, page, size))
+
+    def get_rank(self, bot_name):
+        """
+        Returns the rank of the bot of the logged user, like get_top
         """
+        bot_id = self.session.query(entity.Bot.id).filter_by(
+            name=bot_name, author=self.get_logged_user()).scalar()
+        ranking = None
+        if bot_id is not None:
+            ranking = self.get_board().rank(bot_id)
+        if ranking is None:
+            raise err.BotNotExistsError("Bot [%s] not registered" % bot_name)
+        return self.__named([ranking])[0]
+
+    def __named(self, rankings):
+        result = []
+        with self._lock:
+            for ranking in rankings:
+                name, author = self.names.get(ranking.bot_id, (None, None))
+                result.append((ranking.rank, name, author, ranking.rating))
+        return result
+
 
+class StatsService(Service):
+    """
+    The resources used by the battles and the times of the moves of the
+    bots, to find the slow bots and to size the pool of sandbox workers
+    The times are in seconds, the memory in megabytes and the histograms
+    count the moves in the buckets of MOVE_BUCKETS_MS, with one more bucket
+    for the slower moves.
+    """
+
+    MOVE_BUCKETS_MS = MOVE_BUCKETS_MS
+
+    def get_battle_stats(self, battle_id):
+        """
+        Returns the BattleStats of the battle and the MoveStats of its bots
+        The BattleStats is None for the battles which were not measured.
+        """
+        if self.session.query(entity.Battle.id).filter_by(
+                id=battle_id).scalar() is None:
+            raise err.BattleNotExistsError(
+                "Battle [%s] does not exist" % battle_id)
+        battle_stats = self.session.query(entity.BattleStats).get(battle_id)
+        move_stats = self.session.query(entity.MoveStats).\
+            filter_by(battle_id=battle_id).\
+            order_by(entity.MoveStats.bot_id).all()
+        return battle_stats, move_stats
+
+    def get_bot_moves(self, user_name, bot_name):
+        """
+        Returns the number of moves of a bot in all its battles, the mean
+        and the longest time of a move and the histogram of the times
+        """
+        bot = self.context.get_service(BotService).get_bot_for_user(
+            user_name, bot_name)
+        moves, total_time, max_time = 0, 0.0, 0.0
+        histogram = [0] * (len(MOVE_BUCKETS_MS) + 1)
+        for row in self.session.query(
+                entity.MoveStats.moves, entity.MoveStats.total_time,
+                entity.MoveStats.max_time, entity.MoveStats.histogram).\
+                filter(entity.MoveStats.bot_id == bot.id):
+            moves += row.moves
+            total_time += row.total_time
+            max_time = max(max_time, row.max_time)
+            for i, count in enumerate(row.histogram.split(",")):
+                histogram[i] += int(count)
+        mean_time = total_time / moves if moves else 0.0
+        return moves, mean_time, max_time, histogram
+
+    def get_slow_bots(self, game_name, count=10):
+        """
+        Returns the count bots of the game with the longest mean time of a
+        move, as (bot name, author name, moves, mean time, longest time)
+        """
+        game_id = self.context.get_service(GameService).get_game_id(game_name)
+        moves = func.sum(entity.MoveStats.moves)
+        mean_time = func.sum(entity.MoveStats.total_time) / moves
+        rows = self.session.query(
+            entity.Bot.name, entity.User.name, moves, mean_time,
+            func.max(entity.MoveStats.max_time)).\
+            join(entity.MoveStats, entity.MoveStats.bot_id == entity.Bot.id).\
+            join(entity.User, entity.Bot.author).\
+            filter(entity.Bot.game_id == game_id).\
+            group_by(entity.Bot.id, entity.Bot.name, entity.User.name).\
+            having(moves > 0).\
+            order_by(mean_time.desc()).limit(count)
+        return [tuple(row) for row in rows]
+
+    def get_usage(self, game_name=None):
+        """
+        Returns the resources used by the measured battles, of a game or of
+        all games, as (battles, mean time, longest time, mean CPU time,
+        largest peak memory)
+        The battles run by codejail have only their time measured, they are
+        left out of the mean CPU time and the largest peak memory.
+        The mean time of a battle and the battles to run per second give
+        the number of workers to keep busy.
         """
-        pass
+        stats = entity.BattleStats
+        query = self.session.query(
+            func.count(stats.battle_id), func.avg(stats.wall_time),
+            func.max(stats.wall_time), func.avg(stats.cpu_time),
+            func.max(stats.peak_rss_mb))
+        if game_name is not None:
+            game_id = self.context.get_service(GameService).\
+                get_game_id(game_name)
+            # the fighters of a battle all play its game
+            battle_ids = self.session.query(entity.Fighter.battle_id).\
+                join(entity.Bot, entity.Fighter.bot).\
+                filter(entity.Bot.game_id == game_id)
+            query = query.filter(stats.battle_id.in_(battle_ids.subquery()))
+        return tuple(query.one())
@@ -2,14 +2,19 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import random
 import re
 import sys
 import time
 from itertools import count
 from collections import OrderedDict, namedtuple
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The table size is the maximum number of elements in the LRUCache tables,
+# used when the search verifies the transposition table keys.
+TABLE_SIZE = 10**7
+
+# The memory budget of the TranspositionTable, in MB.
+TABLE_MB = 32
 
 # Mate value must be greater than 8*queen + 2*(rook+knight+bishop)
 # King value is set to twice this value such that if the opponent is
@@ -128,11 +133,69 @@ pst = {
 }
 
 
+###############################################################################
+# Zobrist hashing
+###############################################################################
+
+# Every position carries a 64 bit key, the xor of a random key for each piece
+# on its square, the castling rights, the en passant and king passant squares
+# and the side to move. The squares are those seen by white, so rotating the
+# board only flips the side to move key. The seed is fixed so that all the
+# processes sharing a table compute the same keys.
+_random = random.Random(1200)
+ZOBRIST_PIECES = dict((p, [_random.getrandbits(64) for _ in range(120)])
+                      for p in 'PNBRQKpnbrqk')
+ZOBRIST_PASSANT = dict((name, [_random.getrandbits(64) for _ in range(120)])
+                       for name in ('ep', 'kp'))
+ZOBRIST_RIGHTS = [[_random.getrandbits(64) for _ in range(2)]
+                  for color in range(2)]
+ZOBRIST_BLACK = _random.getrandbits(64)
+
+
+def _zobrist_view(black):
+    """ The keys indexed by the squares as seen from the side to move """
+    def square(i):
+        return 119-i if black else i
+    keys = dict((p, [ZOBRIST_PIECES[p.swapcase() if black else p][square(i)]
+                     for i in range(120)]) for p in 'PNBRQKpnbrqk')
+    keys['.'] = [0] * 120
+    for name, passant in ZOBRIST_PASSANT.items():
+        keys[name] = [passant[square(i)] if i else 0 for i in range(120)]
+    # The castling rights of the side to move and its opponent,
+    # indexed by wc[0] + 2*wc[1] + 4*bc[0] + 8*bc[1]
+    keys['castling'] = []
+    for rights in range(16):
+        key = 0
+        for bit in range(4):
+            if rights >> bit & 1:
+                key ^= ZOBRIST_RIGHTS[black ^ (bit >> 1)][bit & 1]
+        keys['castling'].append(key)
+    return keys
+
+ZOBRIST_VIEW = (_zobrist_view(False), _zobrist_view(True))
+
+
+def castling_index(wc, bc):
+    return wc[0] + 2*wc[1] + 4*bc[0] + 8*bc[1]
+
+
+def zobrist(board, wc, bc, ep, kp):
+    """ Computes the zobrist key of a position from scratch """
+    black = board.startswith('\n')
+    keys = ZOBRIST_VIEW[black]
+    h = ZOBRIST_BLACK if black else 0
+    for i, p in enumerate(board):
+        if p.isalpha():
+            h ^= keys[p][i]
+    h ^= keys['castling'][castling_index(wc, bc)]
+    return h ^ keys['ep'][ep] ^ keys['kp'][kp]
+
+
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+class Position(namedtuple('Position', 'board score wc bc ep kp hash')):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -140,8 +203,15 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    hash - the zobrist key, computed from the other fields if not given
     """
 
+    def __new__(cls, board, score, wc, bc, ep, kp, hash=None):
+        if hash is None:
+            hash = zobrist(board, wc, bc, ep, kp)
+        return super(Position, cls).__new__(
+            cls, board, score, wc, bc, ep, kp, hash)
+
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
         # as defined in the 'directions' map. The rays are broken e.g. by
@@ -180,27 +250,34 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            self.hash ^ ZOBRIST_BLACK)
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
+        keys = ZOBRIST_VIEW[self.board.startswith('\n')]
+        h = self.hash ^ keys['ep'][self.ep] ^ keys['kp'][self.kp]
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0)
+            self.bc, self.wc, 0, 0, h ^ ZOBRIST_BLACK)
 
     def move(self, move):
         i, j = move
         p, q = self.board[i], self.board[j]
+        keys = ZOBRIST_VIEW[self.board.startswith('\n')]
 
-        def put(board, i, p):
-            return board[:i] + p + board[i+1:]
+        def put(board, h, i, p):
+            h ^= keys[board[i]][i] ^ keys[p][i]
+            return board[:i] + p + board[i+1:], h
         # Copy variables and reset ep and kp
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        h = self.hash ^ keys['castling'][castling_index(wc, bc)]
+        h ^= keys['ep'][self.ep] ^ keys['kp'][self.kp]
         score = self.score + self.value(move)
         # Actual move
-        board = put(board, j, board[i])
-        board = put(board, i, '.')
+        board, h = put(board, h, j, board[i])
+        board, h = put(board, h, i, '.')
         # Castling rights, we move the rook or capture the opponent's
         if i == A1:
             wc = (False, wc[1])
@@ -215,18 +292,20 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
             wc = (False, False)
             if abs(j-i) == 2:
                 kp = (i+j)//2
-                board = put(board, A1 if j < i else H1, '.')
-                board = put(board, kp, 'R')
+                board, h = put(board, h, A1 if j < i else H1, '.')
+                board, h = put(board, h, kp, 'R')
         # Pawn promotion, double move and en passant capture
         if p == 'P':
             if A8 <= j <= H8:
-                board = put(board, j, 'Q')
+                board, h = put(board, h, j, 'Q')
             if j - i == 2*N:
                 ep = i + N
             if j - i in (N+W, N+E) and q == '.':
-                board = put(board, j+S, '.')
+                board, h = put(board, h, j+S, '.')
+        h ^= keys['castling'][castling_index(wc, bc)]
+        h ^= keys['ep'][ep] ^ keys['kp'][kp]
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate()
+        return Position(board, score, wc, bc, ep, kp, h).rotate()
 
     def value(self, move):
         i, j = move
@@ -283,13 +362,164 @@ class LRUCache:
                 self.od.popitem(last=False)
         self.od[key] = value
 
+    def store(self, key, value, depth=0):
+        self[key] = value
+
+    def new_search(self):
+        pass
+
+
+class TranspositionTable:
+    '''A preallocated table of searched positions with a fixed memory budget
+
+    Scores are keyed by (hash, depth, root) and best moves by the hash of the
+    position, like in the Searcher, so one table serves as both tp_score and
+    tp_move. The table is split in buckets of two entries. The first entry of
+    a bucket is only replaced by an entry searched at least as deep or when it
+    is left from an older search, the second one is always replaced.
+
+    Every entry takes two 64 bit words, the key xor-ed with the data and the
+    data itself, which packs the lower and upper bound, the depth, the best
+    move and the age of the search. Writes from processes sharing the buffer
+    may interleave, but then the key check fails and the entry is ignored.
+    '''
+    ENTRY_SIZE = 16
+
+    def __init__(self, size_mb=TABLE_MB, buffer=None):
+        # The buffer, when given, should be capacity(size_mb) entries long
+        if buffer is None:
+            buffer = bytearray(self.capacity(size_mb) * self.ENTRY_SIZE)
+        self.data = memoryview(buffer).cast('Q')
+        self.size = len(self.data) // 2
+        self.mask = self.size // 2 - 1
+        self.age = 0
+
+    @classmethod
+    def capacity(cls, size_mb):
+        ''' The largest power of two number of entries that fits in size_mb '''
+        entries = int(size_mb * 2**20) // cls.ENTRY_SIZE
+        return 1 << max(entries.bit_length() - 1, 1)
+
+    def new_search(self):
+        self.age = (self.age + 1) & 0xf
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, tuple):
+            h, depth, root = key
+            # Mixing an odd constant keeps the keys of a position distinct
+            key = h ^ ((depth << 1 | root) * 0x9e3779b97f4a7c15)
+        return key & 0xffffffffffffffff
+
+    def get(self, key, default=None):
+        k = self._key(key)
+        data = self.data
+        i = (k & self.mask) << 2
+        for slot in (i, i + 2):
+            packed = data[slot + 1]
+            if data[slot] ^ packed == k:
+                break
+        else:
+            return default
+        if isinstance(key, tuple):
+            return Entry((packed & 0x3ffff) - MATE_UPPER,
+                         (packed >> 18 & 0x3ffff) - MATE_UPPER)
+        move = packed >> 46 & 0x3fff
+        return divmod(move, 120) if move else None
+
+    def store(self, key, value, depth=0):
+        k = self._key(key)
+        if isinstance(key, tuple):
+            lower, upper, move = value.lower, value.upper, 0
+        else:
+            lower = upper = -MATE_UPPER
+            move = value[0] * 120 + value[1] if value else 0
+        packed = (lower + MATE_UPPER | (upper + MATE_UPPER) << 18 |
+                  min(depth, 0x3ff) << 36 | move << 46)
+        self._put(k, packed)
+
+    def _put(self, k, packed):
+        packed = packed & 0x0fffffffffffffff | self.age << 60
+        depth = packed >> 36 & 0x3ff
+        data = self.data
+        slot = (k & self.mask) << 2
+        first = data[slot + 1]
+        if data[slot] ^ first != k and depth < (first >> 36 & 0x3ff) and \
+                first >> 60 == self.age:
+            slot += 2
+        data[slot] = k ^ packed
+        data[slot + 1] = packed
+
+    def items(self):
+        ''' Yields the key and the packed data of every stored entry '''
+        data = self.data
+        for slot in range(0, len(data), 2):
+            packed = data[slot + 1]
+            if packed:
+                yield data[slot] ^ packed, packed
+
+    def merge(self, other):
+        ''' Stores the entries of another table, deeper entries win '''
+        for k, packed in other.items():
+            self._put(k, packed)
+
+    def __setitem__(self, key, value):
+        self.store(key, value, key[1] if isinstance(key, tuple) else 0)
+
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = LRUCache(TABLE_SIZE)
-        self.tp_move = LRUCache(TABLE_SIZE)
+    def __init__(self, verify=False, table_mb=TABLE_MB, cache=None,
+                 table=None):
+        # Both tables are keyed by the zobrist key of the position and share
+        # one TranspositionTable of table_mb MB, or the given table when the
+        # search shares it with other processes. When verify is set they are
+        # LRUCache tables instead, which store the position along with every
+        # entry so that colliding keys are detected (and counted).
+        # The cache is a read only table, e.g. a PositionCache of earlier
+        # searches, looked up when a position is missing from the tables.
+        if verify:
+            self.tp_score = LRUCache(TABLE_SIZE)
+            self.tp_move = LRUCache(TABLE_SIZE)
+        else:
+            self.tp_score = self.tp_move = table or \
+                TranspositionTable(table_mb)
+        self.verify = verify
+        self.cache = cache
+        self.collisions = 0
         self.nodes = 0
 
+    def _probe(self, table, key, pos, default, check=None):
+        value = table.get(key)
+        if value is not None and self.verify:
+            stored, value = value
+            if stored != pos:
+                self.collisions += 1
+                value = None
+        if value is None and self.cache is not None:
+            value = self.cache.get(key)
+            # The cache is filled by other searches, which we don't trust
+            if value is not None and check is not None and not check(value):
+                value = None
+        return default if value is None else value
+
+    def _store(self, table, key, pos, value, depth):
+        table.store(key, (pos, value) if self.verify else value, depth)
+
+    def probe_score(self, pos, depth, root, default=None):
+        key = (pos.hash, depth, root)
+        return self._probe(self.tp_score, key, pos, default)
+
+    def store_score(self, pos, depth, root, entry):
+        key = (pos.hash, depth, root)
+        self._store(self.tp_score, key, pos, entry, depth)
+
+    def probe_move(self, pos):
+        return self._probe(self.tp_move, pos.hash, pos, None,
+                           check=lambda move: move in pos.gen_moves())
+
+    def store_move(self, pos, move, depth=0):
+        self._store(self.tp_move, pos.hash, pos, move, depth)
+
     def quiescence(self, pos, gamma):
         self.nodes += 1
         if pos.score <= -MATE_LOWER:
@@ -315,8 +545,8 @@ class Searcher:
         # We use the table value if it was done with at least as deep a search
         # as ours, and the gamma value is compatible.
         t = Entry(-MATE_UPPER, MATE_UPPER)
-        entry = self.tp_score.get((pos, depth, root), t)
-        t = not root or self.tp_move.get(pos) is not None
+        entry = self.probe_score(pos, depth, root, t)
+        t = not root or self.probe_move(pos) is not None
         if entry.lower >= gamma and t:
             return entry.lower
         if entry.upper < gamma:
@@ -331,7 +561,7 @@ class Searcher:
         in_check = is_dead(pos.nullmove())
         if not any_moves:
             score = -MATE_UPPER if in_check else 0
-            self.tp_score[(pos, depth, root)] = Entry(score, score)
+            self.store_score(pos, depth, root, Entry(score, score))
             return score
 
         # This is where extensions might be inserted.
@@ -349,7 +579,7 @@ class Searcher:
             # table will fix things for us.
             # Note, we don't have to check for legality,
             # since we've already done it before.
-            killer = self.tp_move.get(pos)
+            killer = self.probe_move(pos)
             if killer:
                 t = -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
                 yield killer, t
@@ -368,25 +598,27 @@ class Searcher:
                 break
 
         if best >= gamma:
-            self.tp_move[pos] = bmove
-            self.tp_score[(pos, depth, root)] = Entry(best, entry.upper)
+            self.store_move(pos, bmove, depth)
+            self.store_score(pos, depth, root, Entry(best, entry.upper))
 
         if best < gamma:
-            self.tp_score[(pos, depth, root)] = Entry(entry.lower, best)
+            self.store_score(pos, depth, root, Entry(entry.lower, best))
 
         return best
 
     # secs over maxn is a breaking change. Can we do this?
     # I guess I could send a pull request to deep pink
     # Why include secs at all?
-    def _search(self, pos):
+    def _search(self, pos, start_depth=1):
         """ Iterative deepening MTD-bi search """
         self.nodes = 0
+        self.tp_score.new_search()
+        self.tp_move.new_search()
 
         # In finished games, we could potentially go far
         # enough to cause a recursion
         # limit exception. Hence we bound the ply.
-        for depth in range(1, 1000):
+        for depth in range(start_depth, 1000):
             self.depth = depth
             # The inner loop is a binary search on the score of the position.
             # Inv: lower <= score <= upper
@@ -406,23 +638,81 @@ class Searcher:
             # kicked out of the table,
             # So we make another call that must always fail
             # high and thus produce a move.
-            score = self.bound(pos, lower, depth)
+            self.score = score = self.bound(pos, lower, depth)
             # assert score >= lower
-            # assert score == self.tp_score.get((pos, depth, True)).lower
+            # assert score == self.probe_score(pos, depth, True).lower
             # Yield so the user may inspect the search
             yield
 
-    def search(self, pos, secs):
+    def _timed_search(self, pos, secs, start_depth=1):
         start = time.time()
-        for _ in self._search(pos):
+        for _ in self._search(pos, start_depth):
             if self.depth < 2:
                 continue
             if time.time() - start > secs:
                 break
+        self.nps = self.nodes / max(time.time() - start, 1e-6)
         # If the game hasn't finished we can retrieve our
         # move from the transposition table.
-        second = self.tp_score.get((pos, self.depth, True)).lower
-        return self.tp_move.get(pos), second
+        # (unless another process sharing it has replaced the entry)
+        t = Entry(self.score, MATE_UPPER)
+        second = self.probe_score(pos, self.depth, True, t).lower
+        return self.probe_move(pos), second
+
+    def search(self, pos, secs, threads=1):
+        """ Searches for about secs seconds, in threads processes if > 1
+        Returns the best move and its score. self.nodes and self.nps are set
+        to the number of searched nodes (of all processes) and nodes/second.
+        """
+        if threads > 1:
+            return self._parallel_search(pos, secs, threads)
+        return self._timed_search(pos, secs)
+
+    def _parallel_search(self, pos, secs, threads):
+        """ Lazy SMP search
+        The processes search the same position, every other one starting a
+        ply deeper, and share the transposition table in shared memory. The
+        deepest completed search gives the move.
+        """
+        import multiprocessing
+        from multiprocessing import shared_memory
+        if not isinstance(self.tp_score, TranspositionTable):
+            raise ValueError("Parallel search needs a TranspositionTable")
+        start = time.time()
+        table = self.tp_score
+        size = table.size * table.ENTRY_SIZE
+        shared = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            shared.buf[:size] = table.data.cast('B')
+            args = [(shared.name, size, table.age, pos, secs, 1 + k % 2)
+                    for k in range(threads)]
+            with multiprocessing.Pool(threads) as pool:
+                results = pool.starmap(_search_worker, args)
+            table.data.cast('B')[:] = shared.buf[:size]
+        finally:
+            shared.close()
+            shared.unlink()
+        self.depth, move, score, _ = max(results, key=lambda r: r[0])
+        self.nodes = sum(nodes for _, _, _, nodes in results)
+        self.nps = self.nodes / max(time.time() - start, 1e-6)
+        return move, score
+
+
+def _search_worker(name, size, age, pos, secs, start_depth):
+    """ Runs a search of Searcher._parallel_search in a worker process """
+    from multiprocessing import shared_memory
+    shared = shared_memory.SharedMemory(name)
+    buffer = shared.buf[:size]
+    table = TranspositionTable(buffer=buffer)
+    table.age = age
+    try:
+        searcher = Searcher(table=table)
+        move, score = searcher._timed_search(pos, secs, start_depth)
+        return searcher.depth, move, score, searcher.nodes
+    finally:
+        table.data.release()
+        buffer.release()
+        shared.close()
 
 
 ###############################################################################
@@ -1,6 +1,12 @@
 import itertools
 import re
-import sunfish
+try:
+    import sunfish
+    from bitboard import BitboardPosition
+except ImportError:
+    # imported as part of the battleground package
+    from battleground import sunfish
+    from battleground.bitboard import BitboardPosition
 
 ###############################################################################
 # This module contains functions used by test.py and xboard.py.
@@ -33,6 +39,7 @@ def gen_legal_moves(pos):
 
 def mrender(pos, m):
     # Sunfish always assumes promotion to queen
+    p = ''
     if sunfish.A8 <= m[1] <= sunfish.H8 and pos.board[m[0]] == 'P':
         p = 'q'
     m = m if get_color(pos) == WHITE else (119-m[0], 119-m[1])
@@ -44,6 +51,24 @@ def mparse(color, move):
     return m if color == WHITE else (119-m[0], 119-m[1])
 
 
+def mencode(color, m):
+    ''' The move as a number below 4096 for the move log of a battle,
+        the from and the to squares counted from a1 '''
+    m = m if color == WHITE else (119-m[0], 119-m[1])
+    squares = []
+    for i in m:
+        rank, fil = divmod(i - sunfish.A1, 10)
+        squares.append(-rank*8 + fil)
+    return squares[0]*64 + squares[1]
+
+
+def mdecode(color, code):
+    ''' The move of the number from mencode '''
+    m = tuple(sunfish.A1 + fil - 10*rank
+              for rank, fil in map(lambda sq: divmod(sq, 8), divmod(code, 64)))
+    return m if color == WHITE else (119-m[0], 119-m[1])
+
+
 def parseSAN(pos, msan):
     ''' Assumes board is rotated to position of current player '''
     # Normal moves
@@ -81,8 +106,9 @@ def get_color(pos):
     return BLACK if pos.board.startswith('\n') else WHITE
 
 
-def parseFEN(fen):
-    """ Parses a string in Forsyth-Edwards Notation into a Position """
+def parseFEN(fen, bitboard=False):
+    """ Parses a string in Forsyth-Edwards Notation into a Position
+    If bitboard is True a bitboard.BitboardPosition is returned instead """
     board, color, castling, enpas, _hclock, _fclock = fen.split()
     board = re.sub(r'\d', (lambda m: '.'*int(m.group(0))), board)
     board = list(21*' ' + '  '.join(board.split('/')) + 21*' ')
@@ -99,6 +125,8 @@ def parseFEN(fen):
         return sunfish.pst[p.upper()][119 - i]
     score -= sum(func(i, p) for i, p in enumerate(board) if p.islower())
     pos = sunfish.Position(board, score, wc, bc, ep, 0)
+    if bitboard:
+        pos = BitboardPosition.from_position(pos)
     return pos if color == 'w' else pos.rotate()
 
 
@@ -144,7 +172,7 @@ def pv(searcher, pos, include_scores=True):
     if include_scores:
         res.append(str(pos.score))
     while True:
-        move = searcher.tp_move.get(pos)
+        move = searcher.probe_move(pos)
         if move is None:
             break
         res.append(mrender(pos, move))
@@ -1,2 +1,11 @@
-rm test1.db
+rm -f test1.db test1.db-shm test1.db-wal
 python3 test_services.py
+python3 test_chess.py
+python3 test_sandbox.py
+python3 test_scheduler.py
+python3 test_matchmaking.py
+python3 test_rating.py
+python3 test_migrate.py
+python3 test_leaderboard.py
+python3 test_movelog.py
+python3 test_ingest.py
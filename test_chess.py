@@ -0,0 +1,279 @@
+import unittest
+import concurrent.futures
+import os
+import random
+import tempfile
+from battleground import sunfish, tools
+from battleground.bitboard import BitboardPosition
+from battleground import epdbench, perft
+from battleground.poscache import PositionCache, PositionCacheError
+
+FEN_KIWIPETE = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R '\
+    'w KQkq - 0 1'
+
+
+class TestBitboardPosition(unittest.TestCase):
+
+    def test_fen_conversion(self):
+        for fen in (tools.FEN_INITIAL, FEN_KIWIPETE):
+            pos = tools.parseFEN(fen, bitboard=True)
+            self.assertIsInstance(pos, BitboardPosition)
+            self.assertEqual(tools.renderFEN(pos), fen)
+            self.assertEqual(pos.to_position(), tools.parseFEN(fen))
+
+    def test_same_moves_as_sunfish(self):
+        rnd = random.Random(0)
+        for fen in (tools.FEN_INITIAL, FEN_KIWIPETE):
+            pos = tools.parseFEN(fen)
+            bb_pos = tools.parseFEN(fen, bitboard=True)
+            for _ in range(60):
+                moves = sorted(pos.gen_moves())
+                self.assertEqual(moves, sorted(bb_pos.gen_moves()))
+                for move in moves:
+                    self.assertEqual(pos.value(move), bb_pos.value(move))
+                self.assertEqual(bb_pos.nullmove().to_position(),
+                                 pos.nullmove())
+                legal = [move for move, _ in tools.gen_legal_moves(pos)]
+                if not legal:
+                    break
+                move = rnd.choice(legal)
+                pos, bb_pos = pos.move(move), bb_pos.move(move)
+                self.assertEqual(bb_pos.to_position(), pos)
+
+    def test_search(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL, bitboard=True)
+        move, score = sunfish.Searcher().search(pos, secs=0.1)
+        self.assertIn(move, [m for m, _ in tools.gen_legal_moves(pos)])
+
+
+class TestZobrist(unittest.TestCase):
+
+    def test_incremental_keys(self):
+        rnd = random.Random(1)
+        pos = tools.parseFEN(FEN_KIWIPETE)
+        bb_pos = tools.parseFEN(FEN_KIWIPETE, bitboard=True)
+        for _ in range(60):
+            for p in (pos, pos.rotate(), pos.nullmove()):
+                key = sunfish.zobrist(p.board, p.wc, p.bc, p.ep, p.kp)
+                self.assertEqual(p.hash, key)
+            self.assertEqual(bb_pos.hash, pos.hash)
+            self.assertEqual(bb_pos.nullmove().hash, pos.nullmove().hash)
+            legal = [move for move, _ in tools.gen_legal_moves(pos)]
+            if not legal:
+                break
+            move = rnd.choice(legal)
+            pos, bb_pos = pos.move(move), bb_pos.move(move)
+
+    def test_side_to_move(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        self.assertNotEqual(pos.hash, pos.nullmove().hash)
+        self.assertEqual(pos.hash, pos.nullmove().nullmove().hash)
+
+    def test_verified_search(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher(verify=True)
+        move, score = searcher.search(pos, secs=0.1)
+        self.assertIn(move, [m for m, _ in tools.gen_legal_moves(pos)])
+        self.assertEqual(searcher.collisions, 0)
+
+
+class TestTranspositionTable(unittest.TestCase):
+
+    def test_memory_budget(self):
+        table = sunfish.TranspositionTable(size_mb=1)
+        self.assertEqual(table.size, 2**16)
+        self.assertEqual(table.data.nbytes, 2**20)
+
+    def test_store_and_get(self):
+        table = sunfish.TranspositionTable(size_mb=1)
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        self.assertIsNone(table.get(pos.hash))
+        table[(pos.hash, 3, True)] = sunfish.Entry(-20, 35)
+        table.store(pos.hash, (85, 65), depth=3)
+        self.assertEqual(table.get((pos.hash, 3, True)), (-20, 35))
+        self.assertIsNone(table.get((pos.hash, 3, False)))
+        self.assertIsNone(table.get((pos.hash, 2, True)))
+        self.assertEqual(table.get(pos.hash), (85, 65))
+
+    def test_replacement(self):
+        table = sunfish.TranspositionTable(size_mb=0.001)
+        keys = [k * (table.mask + 1) + 5 for k in range(1, 4)]
+        table.store(keys[0], (85, 65), depth=5)
+        table.store(keys[1], (86, 66), depth=1)
+        table.store(keys[2], (87, 67), depth=2)
+        # the deep entry stays, the shallow ones replace each other
+        self.assertEqual(table.get(keys[0]), (85, 65))
+        self.assertIsNone(table.get(keys[1]))
+        self.assertEqual(table.get(keys[2]), (87, 67))
+        # until a new search starts
+        table.new_search()
+        table.store(keys[1], (86, 66), depth=1)
+        self.assertIsNone(table.get(keys[0]))
+        self.assertEqual(table.get(keys[1]), (86, 66))
+
+
+class TestParallelSearch(unittest.TestCase):
+
+    def test_lazy_smp(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher(table_mb=1)
+        move, score = searcher.search(pos, secs=0.1, threads=2)
+        self.assertIn(move, [m for m, _ in tools.gen_legal_moves(pos)])
+        self.assertGreaterEqual(searcher.depth, 2)
+        self.assertGreater(searcher.nodes, 0)
+        self.assertGreater(searcher.nps, 0)
+        # the shared table is copied back into the searcher
+        self.assertIsNotNone(searcher.probe_move(pos))
+
+    def test_needs_transposition_table(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        with self.assertRaises(ValueError):
+            sunfish.Searcher(verify=True).search(pos, secs=0.1, threads=2)
+
+
+class TestPerft(unittest.TestCase):
+
+    def test_perft_positions(self):
+        for bitboard in (False, True):
+            for name, fen, counts in perft.PERFT_POSITIONS:
+                pos = tools.parseFEN(fen, bitboard=bitboard)
+                for depth, expected in enumerate(counts[:2], 1):
+                    self.assertEqual(perft.perft(pos, depth), expected, name)
+
+    def test_divide(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        counts = dict(perft.divide(pos, 2))
+        self.assertEqual(len(counts), 20)
+        self.assertEqual(counts['e2e4'], 20)
+        self.assertEqual(sum(counts.values()), 400)
+
+    def test_bulk_perft(self):
+        rnd = random.Random(2)
+        for bitboard in (False, True):
+            for name, fen, counts in perft.PERFT_POSITIONS:
+                pos = tools.parseFEN(fen, bitboard=bitboard)
+                for depth, expected in enumerate(counts[:2], 1):
+                    self.assertEqual(
+                        perft.bulk_perft(pos, depth), expected, name)
+                # the leaf counts agree with making the moves
+                for _ in range(20):
+                    legal = [move for move, _ in tools.gen_legal_moves(pos)]
+                    self.assertEqual(perft.count_legal_moves(pos), len(legal))
+                    if not legal:
+                        break
+                    pos = pos.move(rnd.choice(legal))
+
+    def test_bulk_perft_processes(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        self.assertEqual(perft.bulk_perft(pos, 3, processes=2), 8902)
+
+
+def merge_moves(path, worker, moves=50):
+    # merges a table with the moves of a worker into the cache at path
+    table = sunfish.TranspositionTable(size_mb=1)
+    for i in range(moves):
+        table.store(worker * 1000 + i + 1, (sunfish.A1, sunfish.A8))
+    table_path = '%s.%d' % (path, worker)
+    PositionCache.dump(table, table_path)
+    PositionCache.merge_file(path, table_path)
+    return worker
+
+
+class TestPositionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'positions.tt')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_not_a_cache(self):
+        with open(self.path, 'w') as cache_file:
+            cache_file.write('positions')
+        with self.assertRaises(PositionCacheError):
+            PositionCache(self.path)
+
+    def test_concurrent_merges(self):
+        workers = range(8)
+        with concurrent.futures.ProcessPoolExecutor(4) as executor:
+            # the first merges race to create the cache
+            self.assertEqual(list(executor.map(
+                merge_moves, [self.path] * len(workers), workers)),
+                list(workers))
+            with PositionCache(self.path) as reader:
+                size = os.path.getsize(self.path)
+                list(executor.map(merge_moves, [self.path] * len(workers),
+                                  [worker + 10 for worker in workers]))
+                # the mapped cache is never truncated under the reader
+                self.assertEqual(os.path.getsize(self.path), size)
+                for worker in list(workers) + [10, 17]:
+                    self.assertEqual(reader.get(worker * 1000 + 1),
+                                     (sunfish.A1, sunfish.A8))
+                # a new cache replaces the file, the reader keeps the old
+                PositionCache.create(self.path, size_mb=1).close()
+                self.assertEqual(reader.get(1), (sunfish.A1, sunfish.A8))
+        self.assertEqual([name for name in os.listdir(self.temp_dir.name)
+                          if name.startswith('.new-')], [])
+
+    def test_untrusted_entries(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        table = sunfish.TranspositionTable(size_mb=1)
+        # a move off the board, bounds above mate and an illegal move
+        table.store(1, (0, sunfish.A8))
+        table._put(2, 0x3ffff)
+        table.store(pos.hash, (sunfish.A1, sunfish.A8))
+        table_path = os.path.join(self.temp_dir.name, 'forged.tt')
+        PositionCache.dump(table, table_path)
+        PositionCache.merge_file(self.path, table_path)
+
+        with PositionCache(self.path) as cache:
+            self.assertEqual([k for k, _ in cache.items()], [pos.hash])
+            # the rook can't pass its pawn, the searcher doesn't play it
+            searcher = sunfish.Searcher(table_mb=1, cache=cache)
+            self.assertIsNone(searcher.probe_move(pos))
+
+    def test_merge_and_reuse(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher(table_mb=1)
+        move, _ = searcher.search(pos, secs=0.1)
+        searched_path = os.path.join(self.temp_dir.name, 'searched.tt')
+        PositionCache.dump(searcher.tp_score, searched_path)
+        PositionCache.merge_file(self.path, searched_path)
+
+        with PositionCache(self.path) as cache:
+            self.assertEqual(cache.get(pos.hash), move)
+            warm = sunfish.Searcher(table_mb=1, cache=cache)
+            for _ in warm._search(pos):
+                if warm.depth == searcher.depth:
+                    break
+            self.assertLess(warm.nodes, searcher.nodes)
+            self.assertEqual(warm.probe_move(pos), move)
+
+
+class TestEpdBench(unittest.TestCase):
+
+    EPD = (
+        '6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - bm Ra8#; id "back rank";\n'
+        'r1b1k1nr/ppp2ppp/2n5/2b1p3/2B1P2q/2N5/PPPP1QPP/R1B1K1NR b KQkq - '
+        'bm Qxf2+; am Qh5; id "black";\n')
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'suite.epd')
+            with open(path, 'w') as epd_file:
+                epd_file.write(self.EPD)
+            with open(os.devnull, 'w') as out:
+                report = epdbench.run(path, depth=2, out=out)
+        self.assertEqual(report['summary']['solved'], 2)
+        self.assertEqual(report['summary']['positions'], 2)
+        first, second = report['results']
+        self.assertEqual(first['id'], 'back rank')
+        self.assertEqual(first['move'], 'a1a8')
+        self.assertEqual(second['move'], 'h4f2')
+        self.assertEqual(second['depth'], 2)
+        self.assertIsNotNone(second['time_to_solution'])
+
+
+if __name__ == '__main__':
+    unittest.main()
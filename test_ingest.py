@@ -0,0 +1,60 @@
+import unittest
+import concurrent.futures
+from battleground.ingest import IngestionPipeline
+
+
+class TestIngestionPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            self.pipeline.shutdown()
+
+    def flush(self, records):
+        if any(record < 0 for record in records):
+            raise ValueError("negative record")
+        self.batches.append(records)
+
+    def start(self, batch_size, flush_interval):
+        self.pipeline = IngestionPipeline(
+            self.flush, batch_size=batch_size, flush_interval=flush_interval)
+        return self.pipeline
+
+    def test_batches(self):
+        pipeline = self.start(batch_size=4, flush_interval=1)
+        futures = [pipeline.put(record) for record in range(8)]
+        concurrent.futures.wait(futures, timeout=5)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.batches, [[0, 1, 2, 3], [4, 5, 6, 7]])
+
+    def test_flush_interval(self):
+        pipeline = self.start(batch_size=100, flush_interval=0.01)
+        pipeline.put(1).result(timeout=5)
+        pipeline.put(2).result(timeout=5)
+        self.assertEqual(self.batches, [[1], [2]])
+
+    def test_failing_record(self):
+        pipeline = self.start(batch_size=3, flush_interval=1)
+        futures = [pipeline.put(record) for record in (1, -1, 2)]
+        self.assertIsNone(futures[0].result(timeout=5))
+        with self.assertRaises(ValueError):
+            futures[1].result(timeout=5)
+        self.assertIsNone(futures[2].result(timeout=5))
+        # the batch is written again without the failing record
+        self.assertEqual(self.batches, [[1], [2]])
+
+    def test_shutdown(self):
+        pipeline = self.start(batch_size=100, flush_interval=10)
+        futures = [pipeline.put(record) for record in range(3)]
+        pipeline.shutdown()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        with self.assertRaises(RuntimeError):
+            pipeline.put(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
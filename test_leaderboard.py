@@ -0,0 +1,45 @@
+import unittest
+from battleground.leaderboard import Leaderboard, Ranking
+
+
+class TestLeaderboard(unittest.TestCase):
+
+    def setUp(self):
+        self.board = Leaderboard()
+        for bot_id, rating in ((1, 1200), (2, 1250), (3, 1200), (4, 1600)):
+            self.board.update(bot_id, 1, rating)
+        self.board.update(5, 2, 1300)
+
+    def test_top(self):
+        self.assertEqual(self.board.top(1, 2),
+                         [Ranking(1, 4, 1600), Ranking(2, 2, 1250)])
+        self.assertEqual(len(self.board.top(1, 10)), 4)
+        self.assertEqual(self.board.top(3, 10), [])
+
+    def test_rank(self):
+        self.assertEqual(self.board.rank(4), Ranking(1, 4, 1600))
+        # bots with the same rating share the rank
+        self.assertEqual(self.board.rank(1).rank, 3)
+        self.assertEqual(self.board.rank(3).rank, 3)
+        self.assertEqual(self.board.rank(5).rank, 1)
+        self.assertIsNone(self.board.rank(6))
+
+    def test_page(self):
+        self.assertEqual([ranking.bot_id for ranking in
+                          self.board.page(1, 1, size=2)], [1, 3])
+        self.assertEqual([ranking.rank for ranking in
+                          self.board.page(1, 1, size=2)], [3, 3])
+        self.assertEqual(self.board.page(1, 2, size=2), [])
+
+    def test_update(self):
+        self.board.update(1, 1, 1700)
+        self.assertEqual(self.board.rank(1).rank, 1)
+        self.assertEqual(self.board.rank(4).rank, 2)
+        self.board.remove(4)
+        self.assertNotIn(4, self.board)
+        self.assertEqual(self.board.count(1), 3)
+        self.assertEqual(self.board.rank(2).rank, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
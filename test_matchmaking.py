@@ -0,0 +1,47 @@
+import unittest
+from battleground.matchmaking import MatchmakingIndex
+
+
+class TestMatchmakingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MatchmakingIndex(recent_opponents=1)
+        for bot_id, rating in ((1, 1200), (2, 1250), (3, 1100), (4, 1600)):
+            self.index.update(bot_id, 1, rating)
+        self.index.update(5, 2, 1200)
+
+    def test_nearest(self):
+        self.assertEqual(self.index.nearest(1, 1200, 300, bot_id=1), 2)
+        self.assertEqual(self.index.nearest(1, 1110, 300), 3)
+        self.assertEqual(self.index.nearest(1, 1600, 300, bot_id=4), None)
+        self.assertEqual(self.index.nearest(1, 1600, 400, bot_id=4), 2)
+        self.assertEqual(self.index.nearest(2, 1200, 300, bot_id=5), None)
+        self.assertEqual(self.index.nearest(3, 1200, 300), None)
+
+    def test_exclude(self):
+        self.assertEqual(
+            self.index.nearest(1, 1200, 300, bot_id=1, exclude=[2]), 3)
+        self.assertEqual(
+            self.index.nearest(1, 1200, 300, bot_id=1, exclude=[2, 3]), None)
+
+    def test_recent_opponents(self):
+        self.index.played(1, 2)
+        self.assertEqual(self.index.nearest(1, 1200, 300, bot_id=1), 3)
+        self.assertEqual(self.index.nearest(1, 1250, 300, bot_id=2), 3)
+        # only the last opponent is remembered
+        self.index.played(1, 3)
+        self.assertEqual(self.index.nearest(1, 1200, 300, bot_id=1), 2)
+
+    def test_update(self):
+        self.index.update(2, 1, 1000)
+        self.assertEqual(self.index.nearest(1, 1200, 150, bot_id=1), 3)
+        self.index.update(3, 1, 1100, ready=False)
+        self.assertNotIn(3, self.index)
+        self.assertEqual(self.index.nearest(1, 1200, 300, bot_id=1), 2)
+        self.index.remove(2)
+        self.assertEqual(self.index.nearest(1, 1200, 300, bot_id=1), None)
+        self.assertEqual(len(self.index), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
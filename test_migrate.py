@@ -0,0 +1,113 @@
+import unittest
+import os
+import tempfile
+import warnings
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+import battleground.entity as entity
+from battleground import config
+from battleground import replay
+from battleground.migrate import upgrade
+from battleground.service import BotService
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.temp_dir.name, "old.db")
+        self.engine = create_engine("sqlite:///" + path)
+        # the bots table before the battle counters and the indexes
+        self.engine.execute(
+            "CREATE TABLE bots (id INTEGER PRIMARY KEY, version INTEGER, "
+            "name VARCHAR, rating INTEGER, source TEXT, game_id INTEGER, "
+            "ready_state VARCHAR, author_id INTEGER)")
+        self.engine.execute(
+            "INSERT INTO bots (name, rating, author_id) VALUES ('bot', 1, 1)")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_upgrade(self):
+        added = upgrade(self.engine, entity.Base.metadata)
+        self.assertIn("bots.battles", added)
+        self.assertIn("ix_bots_author_id_name", added)
+        inspector = inspect(self.engine)
+        self.assertIn("battles", [column["name"] for column in
+                                  inspector.get_columns("bots")])
+        self.assertIn("head_to_head", inspector.get_table_names())
+        self.assertEqual(
+            self.engine.execute("SELECT name, battles FROM bots").fetchall(),
+            [("bot", None)])
+        self.assertEqual(upgrade(self.engine, entity.Base.metadata), [])
+
+    def test_replay(self):
+        # battles and fighters from before the ranked battles and the move
+        # log, the first bot won both battles
+        self.engine.execute(
+            "INSERT INTO bots (name, rating, author_id) "
+            "VALUES ('other', 1, 1)")
+        self.engine.execute(
+            "CREATE TABLE battles (id INTEGER PRIMARY KEY, state VARCHAR)")
+        self.engine.execute(
+            "CREATE TABLE fighters (id INTEGER PRIMARY KEY, "
+            "bot_version INTEGER, battle_place INTEGER, bot_id INTEGER, "
+            "battle_id INTEGER)")
+        for battle_id in (1, 2):
+            self.engine.execute(
+                "INSERT INTO battles (id, state) VALUES (?, 'CONCLUDED')",
+                battle_id)
+            self.engine.execute(
+                "INSERT INTO fighters (battle_place, bot_id, battle_id) "
+                "VALUES (0, 1, ?), (1, 2, ?)", battle_id, battle_id)
+        self.assertIn("battles.ranked", upgrade(self.engine,
+                                                entity.Base.metadata))
+        # a ranked battle after the migration, the second bot won
+        self.engine.execute(
+            "INSERT INTO battles (id, state, ranked, concluded_at) "
+            "VALUES (3, 'CONCLUDED', 1, '2020-01-01 00:00:00')")
+        self.engine.execute(
+            "INSERT INTO fighters (battle_place, bot_id, battle_id) "
+            "VALUES (1, 1, 3), (0, 2, 3)")
+
+        session = sessionmaker(bind=self.engine)()
+        try:
+            # the battles from before the migration were not rated
+            self.assertEqual(replay.replay(session), 1)
+            first, second = [bot_rating for bot_rating, in session.query(
+                entity.Bot.rating).order_by(entity.Bot.id)]
+        finally:
+            session.close()
+        self.assertLess(first, second)
+        self.assertEqual(first + second, 2 * BotService.STARTING_BOT_RATING)
+
+    def test_duplicates(self):
+        self.engine.execute(
+            "INSERT INTO bots (name, rating, author_id) VALUES ('bot', 2, 1)")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            added = upgrade(self.engine, entity.Base.metadata)
+        self.assertNotIn("ix_bots_author_id_name", added)
+        self.assertIn("ix_bots_game_id_rating", added)
+        self.assertEqual(len(caught), 1)
+
+
+class TestEngine(unittest.TestCase):
+
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            engine = entity.create_db_engine(
+                "sqlite:///" + os.path.join(temp_dir, "new.db"))
+            try:
+                self.assertEqual(
+                    engine.execute("PRAGMA journal_mode").scalar(), "wal")
+                self.assertEqual(
+                    engine.execute("PRAGMA busy_timeout").scalar(),
+                    config.SQLITE_BUSY_TIMEOUT)
+            finally:
+                engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import random
+import tempfile
+import unittest
+from battleground import movelog, tools
+from battleground.movelog import MoveLog, MoveLogError
+
+
+class TestMoveLog(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log = MoveLog(os.path.join(self.temp_dir.name, 'moves.log'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_pack(self):
+        moves = [0, 796, 4095, 65535]
+        self.assertEqual(movelog.unpack(movelog.pack(moves)), moves)
+        self.assertEqual(movelog.unpack(movelog.pack([])), [])
+        # a long game of repeated moves takes less than its 2 bytes a move
+        self.assertLess(len(movelog.pack([796, 3452] * 200)), 800)
+        with self.assertRaises(MoveLogError):
+            movelog.pack([65536])
+
+    def test_append_and_read(self):
+        rnd = random.Random(0)
+        battles = {battle_id: [rnd.randrange(4096) for _ in range(
+            rnd.randrange(200))] for battle_id in range(1, 30)}
+        records = {battle_id: self.log.append(battle_id, moves)
+                   for battle_id, moves in battles.items()}
+        for battle_id in rnd.sample(list(battles), len(battles)):
+            offset, size = records[battle_id]
+            self.assertEqual(self.log.read(battle_id, offset, size),
+                             battles[battle_id])
+        self.assertEqual(
+            [(battle_id, offset, size)
+             for battle_id, offset, size in self.log.scan()],
+            [(battle_id,) + records[battle_id] for battle_id in battles])
+
+    def test_wrong_record(self):
+        self.log.append(1, [1, 2])
+        offset, size = self.log.append(2, [3, 4])
+        with self.assertRaises(MoveLogError):
+            self.log.read(1, offset, size)
+        with self.assertRaises(MoveLogError):
+            self.log.read(2, offset, size + 1)
+
+    def test_chess_moves(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        for color in (tools.WHITE, tools.BLACK):
+            for move in pos.gen_moves():
+                code = tools.mencode(color, move)
+                self.assertLess(code, 4096)
+                self.assertEqual(tools.mdecode(color, code), move)
+        self.assertEqual(tools.mencode(tools.WHITE, tools.mparse(
+            tools.WHITE, 'e2e4')), 12 * 64 + 28)
+
+
+if __name__ == '__main__':
+    unittest.main()
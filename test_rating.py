@@ -0,0 +1,103 @@
+import unittest
+import math
+import random
+from battleground import rating
+
+
+def reference_changes(ratings, final_order, fair_factor=1.0):
+    """
+    The rating changes computed one pair of fighters at a time
+    """
+    count = len(ratings)
+    places = rating.places(final_order)
+    changes = []
+    for i in range(count):
+        change = 0
+        for j in range(count):
+            if i == j:
+                continue
+            if places[i] < places[j]:
+                score = 1.0
+            elif places[i] == places[j]:
+                score = 0.5
+            else:
+                score = 0.0
+            expected = 1 / (1.0 + math.pow(
+                10.0, (ratings[j] - ratings[i]) / 400.0))
+            change += rating.K_FACTOR / (count - 1) * (score - expected)
+        changes.append(round(change * fair_factor))
+    return changes
+
+
+class TestRating(unittest.TestCase):
+
+    def test_places(self):
+        self.assertEqual(list(rating.places([2, 0, 1])), [2, 3, 1])
+
+    def test_elo_changes(self):
+        generator = random.Random(7)
+        for _ in range(200):
+            count = generator.randint(2, 6)
+            ratings = [generator.randint(800, 2400) for _ in range(count)]
+            final_order = list(range(count))
+            generator.shuffle(final_order)
+            fair_factor = generator.choice([0.25, 0.5, 1.0])
+            self.assertEqual(
+                list(rating.elo_changes(ratings, rating.places(final_order),
+                                        fair_factor)),
+                reference_changes(ratings, final_order, fair_factor))
+
+    def test_elo_changes_stacked(self):
+        ratings = [[1200, 1400], [1500, 1500], [2000, 1000]]
+        places = [[1, 2], [2, 1], [2, 1]]
+        changes = rating.elo_changes(ratings, places, [1.0, 0.5, 1.0])
+        self.assertEqual(changes.shape, (3, 2))
+        for battle in range(3):
+            self.assertEqual(
+                list(changes[battle]),
+                list(rating.elo_changes(ratings[battle], places[battle],
+                                        [1.0, 0.5, 1.0][battle])))
+        self.assertEqual(list(changes[0]), [24, -24])
+
+    def test_draw_changes(self):
+        self.assertEqual(list(rating.draw_changes([1000, 1500])), [10, -10])
+        self.assertEqual(list(rating.draw_changes([1200, 1000, 1100])),
+                         [-4, 4, 0])
+
+    def test_fair_factor(self):
+        # new bots and bots which never met get the full factor
+        self.assertEqual(rating.fair_factor({1: 0, 2: 10}, {}), 1)
+        self.assertEqual(rating.fair_factor({1: 10, 2: 10}, {}), 1.1)
+        # bots which only played one another get the lowest
+        self.assertEqual(rating.fair_factor({1: 10, 2: 10}, {(1, 2): 10}),
+                         0.1)
+
+    def test_replay(self):
+        generator = random.Random(11)
+        ratings = {bot_id: generator.randint(1000, 1600)
+                   for bot_id in range(20)}
+        battles = []
+        for _ in range(300):
+            bot_ids = generator.sample(range(20), generator.randint(2, 4))
+            if generator.random() < 0.1:
+                final_order = None
+            else:
+                final_order = list(range(len(bot_ids)))
+                generator.shuffle(final_order)
+            battles.append((bot_ids, final_order, generator.random()))
+
+        expected = dict(ratings)
+        for bot_ids, final_order, fair_factor in battles:
+            battle_ratings = [expected[bot_id] for bot_id in bot_ids]
+            if final_order is None:
+                changes = rating.draw_changes(battle_ratings)
+            else:
+                changes = reference_changes(
+                    battle_ratings, final_order, fair_factor)
+            for bot_id, change in zip(bot_ids, changes):
+                expected[bot_id] += int(change)
+        self.assertEqual(rating.replay(ratings, battles), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
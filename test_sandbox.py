@@ -0,0 +1,179 @@
+import unittest
+import os
+import sys
+import tempfile
+import battleground.error as err
+from battleground.sandbox import SandboxPool
+from battleground.sandbox_worker import MOVE_BUCKETS_MS, checked_moves
+from battleground.modulestore import ModuleStore
+
+CHESS_PATH = os.path.join(os.path.dirname(__file__), 'battleground')
+
+GAME = """
+import sunfish
+players = [__import__(bot).Bot() for bot in bots]
+final_order = sorted(range(len(players)), key=lambda i: players[i].get_move())
+mate = sunfish.MATE_LOWER
+"""
+
+
+class TestSandboxPool(unittest.TestCase):
+
+    def setUp(self):
+        modules = [os.path.join(CHESS_PATH, module)
+                   for module in ('sunfish.py', 'tools.py', 'bitboard.py')]
+        self.pool = SandboxPool(sys.executable, modules, size=1,
+                                max_battles=2, timeout=10)
+        self.pool.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        for name, move in (('first', 2), ('second', 1)):
+            path = os.path.join(self.temp_dir.name, name + '.py')
+            with open(path, 'w') as module_file:
+                module_file.write("class Bot:\n    def get_move(self):\n"
+                                  "        return %d\n" % move)
+
+    def tearDown(self):
+        self.pool.close()
+        self.temp_dir.cleanup()
+
+    def run_game(self, source=GAME):
+        game_globals = {'final_order': [], 'bots': ['first', 'second']}
+        self.stats = self.pool.run(source, game_globals,
+                                   python_path=[self.temp_dir.name])
+        return game_globals
+
+    def test_stats(self):
+        self.run_game()
+        self.assertGreater(self.stats['wall_time'], 0)
+        self.assertGreaterEqual(self.stats['cpu_time'], 0)
+        self.assertGreater(self.stats['peak_rss_mb'], 0)
+        for bot in ('first', 'second'):
+            moves = self.stats['moves'][bot]
+            self.assertEqual(moves['moves'], 1)
+            self.assertEqual(sum(moves['histogram']), 1)
+
+    def test_run(self):
+        game_globals = self.run_game()
+        self.assertEqual(game_globals['final_order'], [1, 0])
+        self.assertGreater(game_globals['mate'], 0)
+        self.assertNotIn('players', game_globals)
+
+    def test_bots_are_reloaded(self):
+        self.run_game()
+        path = os.path.join(self.temp_dir.name, 'first.py')
+        with open(path, 'w') as module_file:
+            module_file.write("class Bot:\n    def get_move(self):\n"
+                              "        return 0\n")
+        self.assertEqual(self.run_game()['final_order'], [0, 1])
+
+    def test_error(self):
+        with self.assertRaises(err.SandboxError):
+            self.run_game("raise ValueError('bad game')")
+        # the worker survives errors of the game
+        self.assertEqual(self.run_game()['final_order'], [1, 0])
+
+    def test_recycle(self):
+        self.run_game()
+        first = self.pool._idle[0].process.pid
+        self.run_game()
+        second = self.pool._idle[0].process.pid
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.pool._idle[0].battles, 0)
+
+    def test_timeout(self):
+        self.pool.timeout = 0.5
+        with self.assertRaises(err.SandboxError):
+            self.run_game("while True: pass")
+        self.pool.timeout = 10
+        self.assertEqual(self.run_game()['final_order'], [1, 0])
+
+    def test_battles_are_isolated(self):
+        with self.assertRaises(err.SandboxError):
+            self.run_game("import sunfish, builtins\n"
+                          "sunfish.MATE_LOWER = -1\n"
+                          "builtins.sorted = None\n"
+                          "raise ValueError('tampered')")
+        # the next battle on the same worker starts from clean modules
+        game_globals = self.run_game()
+        self.assertEqual(game_globals['final_order'], [1, 0])
+        self.assertGreater(game_globals['mate'], 0)
+
+    def test_limits(self):
+        pool = SandboxPool(sys.executable, size=1, timeout=10,
+                           limits={'CPU': 1, 'AS': 512 * 2 ** 20})
+        try:
+            with self.assertRaises(err.SandboxError):
+                pool.run("data = bytearray(1024 * 2 ** 20)", {})
+            with self.assertRaises(err.SandboxError):
+                pool.run("while True: pass", {})
+            stats = pool.run("x = 1", {})
+            self.assertLess(stats['cpu_time'], 1)
+        finally:
+            pool.close()
+
+    def test_checked_moves(self):
+        histogram = [1] + [0] * len(MOVE_BUCKETS_MS)
+        moves = {'first': {'moves': 1, 'total_time': 0.5, 'max_time': 0.5,
+                           'histogram': histogram},
+                 'second': {'moves': 1, 'total_time': 5, 'max_time': 5,
+                            'histogram': histogram},
+                 'other': {'moves': 1, 'total_time': 0.5, 'max_time': 0.5,
+                           'histogram': histogram}}
+        # the times longer than the battle and the unknown bots are dropped
+        self.assertEqual(list(checked_moves(moves, ['first', 'second'], 1)),
+                         ['first'])
+        self.assertEqual(checked_moves({'first': 'forged'}, ['first'], 1),
+                         {})
+
+    def test_health_check(self):
+        self.pool._idle[0].process.kill()
+        self.assertEqual(self.pool.check(), 1)
+        self.assertTrue(self.pool._idle[0].is_alive())
+        self.assertEqual(self.run_game()['final_order'], [1, 0])
+
+
+class TestModuleStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = ModuleStore(os.path.join(self.temp_dir.name, 'store'))
+
+    def tearDown(self):
+        for directory, _, _ in os.walk(self.temp_dir.name):
+            os.chmod(directory, 0o755)
+        self.temp_dir.cleanup()
+
+    def test_add(self):
+        path = self.store.add({'bot': 'MOVE = 1\n'})
+        self.assertTrue(os.path.isfile(os.path.join(path, 'bot.py')))
+        self.assertTrue(os.listdir(os.path.join(path, '__pycache__')))
+        for name in (path, os.path.join(path, 'bot.py')):
+            self.assertFalse(os.stat(name).st_mode & 0o222)
+            self.assertFalse(os.stat(name).st_mode & 0o007)
+        self.assertEqual(os.stat(self.store.root).st_mode & 0o777, 0o710)
+        # the same modules are stored once, changed ones again
+        self.assertEqual(self.store.add({'bot': 'MOVE = 1\n'}), path)
+        self.assertNotEqual(self.store.add({'bot': 'MOVE = 2\n'}), path)
+        self.assertNotEqual(self.store.add({'other': 'MOVE = 1\n'}), path)
+        self.assertEqual(len(os.listdir(self.store.root)), 3)
+
+    def test_battle(self):
+        pool = SandboxPool(sys.executable, size=1)
+        try:
+            self.store.add({'other': 'MOVE = 3\n'})
+            python_path = [self.store.add({'first': 'MOVE = 2\n'}),
+                           self.store.add({'second': 'MOVE = 1\n'})]
+            game_globals = {'bots': ['first', 'second', 'other']}
+            pool.run("import importlib.util\n"
+                     "moves = [__import__(bot).MOVE for bot in bots[:2]]\n"
+                     "other = importlib.util.find_spec(bots[2])",
+                     game_globals, python_path=python_path)
+            self.assertEqual(game_globals['moves'], [2, 1])
+            # the other modules of the store are not on the path
+            self.assertIsNone(game_globals['other'])
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
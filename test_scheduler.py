@@ -0,0 +1,84 @@
+import unittest
+import threading
+import battleground.error as err
+from battleground.scheduler import BattleScheduler
+
+
+class TestBattleScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = BattleScheduler(workers=1, queue_size=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.scheduler.shutdown()
+
+    def block(self):
+        # occupies the worker until the test releases it
+        started = threading.Event()
+
+        def blocked():
+            started.set()
+            self.release.wait()
+        future = self.scheduler.submit(blocked)
+        started.wait()
+        return future
+
+    def test_result(self):
+        future = self.scheduler.submit(sorted, [2, 1])
+        self.assertEqual(future.result(timeout=5), [1, 2])
+
+    def test_error(self):
+        future = self.scheduler.submit(divmod, 1, 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(timeout=5)
+
+    def test_backpressure(self):
+        self.block()
+        self.scheduler.submit(sorted, [])
+        self.assertEqual(self.scheduler.pending(), 1)
+        with self.assertRaises(err.BattleQueueFullError):
+            self.scheduler.submit(sorted, [], timeout=0.1)
+
+    def test_cancel(self):
+        running = self.block()
+        queued = self.scheduler.submit(sorted, [])
+        self.assertFalse(running.cancel())
+        self.assertTrue(queued.cancel())
+        self.release.set()
+        self.assertIsNone(running.result(timeout=5))
+        self.assertTrue(queued.cancelled())
+
+    def test_shutdown(self):
+        self.block()
+        future = self.scheduler.submit(sorted, [3, 1])
+        self.release.set()
+        self.scheduler.shutdown()
+        self.assertEqual(future.result(timeout=0), [1, 3])
+        with self.assertRaises(RuntimeError):
+            self.scheduler.submit(sorted, [])
+
+    def test_shutdown_full_queue(self):
+        self.block()
+        future = self.scheduler.submit(sorted, [3, 1])
+        # the queue is full, the shutdown doesn't wait for a place in it
+        self.scheduler.shutdown(wait=False)
+        self.release.set()
+        self.scheduler.shutdown()
+        self.assertEqual(future.result(timeout=0), [1, 3])
+
+    def test_shutdown_cancel_pending(self):
+        running = self.block()
+        queued = self.scheduler.submit(sorted, [])
+        self.assertEqual(
+            self.scheduler.shutdown(wait=False, cancel_pending=True),
+            [queued])
+        self.assertTrue(queued.cancelled())
+        self.release.set()
+        self.scheduler.shutdown()
+        self.assertIsNone(running.result(timeout=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,25 @@
 import unittest
+import csv
+import io
+import os
+import tempfile
+import threading
 from battleground.service import ServiceFactory, UserRights, BotReadyState
+from battleground.service import BattleState, TournamentKind, TournamentState
+from battleground.service import Context, GameService, UserService
+from battleground.service import BotService, LeaderboardService
+from battleground.service import BattleService, StatsService
 import battleground.error as err
+import battleground.entity as entity
+from battleground import replay
 from contextlib import contextmanager
 from codejail.exceptions import SafeExecException
 
+
+def setUpModule():
+    entity.init_db()
+
+
 @contextmanager
 def log_in_user(user_name, password):
     ServiceFactory.get_user_service().log_in(user_name, password)
@@ -21,6 +37,41 @@ class TestService:
         self.assertEqual(len(items), items_count)
 
 
+class GameFixture:
+    """
+    Adds USER with GAME and its BOTS before the tests of the class and
+    removes them after
+    """
+
+    USER = None
+    GAME = None
+    GAME_SOURCE = "final_order = [0, 1]"
+    BOTS = ()
+
+    @classmethod
+    def setUpClass(cls):
+        ServiceFactory.get_user_service().add_user(
+            cls.USER, "a", UserRights.ADMIN)
+        with log_in_user(cls.USER, "a"):
+            ServiceFactory.get_game_service().add_game(
+                cls.GAME, cls.GAME_SOURCE, "2")
+            for bot_name in cls.BOTS:
+                cls.add_bot(bot_name)
+
+    @classmethod
+    def tearDownClass(cls):
+        bot_service = ServiceFactory.get_bot_service()
+        with log_in_user(cls.USER, "a"):
+            for bot_name in cls.BOTS:
+                bot_service.remove_bot(bot_name)
+            ServiceFactory.get_game_service().remove_game(cls.GAME)
+            ServiceFactory.get_user_service().remove_user(cls.USER)
+
+    @classmethod
+    def add_bot(cls, bot_name):
+        ServiceFactory.get_bot_service().add_bot(bot_name, cls.GAME, "")
+
+
 class TestUserService(TestService, unittest.TestCase):
 
     def setUp(self):
@@ -186,6 +237,14 @@ class TestBotService(TestService, unittest.TestCase):
             bot = self.service.add_bot("bot_name5", "game1", "source")
         self.service.get_bot_for_user("bot_user1", "bot_name5")
 
+    def test_deferred_source(self):
+        with log_in_user("bot_user1", "a"):
+            self.service.add_bot("bot_name6", "game1", "long source")
+        self.service.session.expire_all()
+        bot = self.service.get_bot_for_user("bot_user1", "bot_name6")
+        self.assertNotIn("source", bot.__dict__)
+        self.assertEqual("long source", bot.source)
+
     def test_multiple_bot_with_same_name(self):
         with log_in_user("bot_user1", "a"):
             self.service.add_bot("bot_name4", "game1", "source")
@@ -251,7 +310,7 @@ class TestBattleService(unittest.TestCase):
     def test_battle_bots_not_ranked(self):
         with reloaded_bots() as bots:
             ratings = sorted([bot.rating for bot in bots])
-            self.service.battle_bots(*bots)
+            self.service.battle_bots(*bots).result()
 
         with reloaded_bots() as bots:
             self.assertEqual(bots[0].rating, ratings[0])
@@ -260,18 +319,515 @@ class TestBattleService(unittest.TestCase):
     def test_battle_ranked(self):
         with reloaded_bots() as bots:
             ratings = sorted([bot.rating for bot in bots])
-            self.service.battle_bots(*bots, ranked=True)
+            self.service.battle_bots(*bots, ranked=True).result()
 
         with reloaded_bots() as bots:
             self.assertGreater(bots[0].rating, ratings[0])
             self.assertLess(bots[1].rating, ratings[1])
 
+    def test_head_to_head(self):
+        with reloaded_bots() as bots:
+            bot_ids = sorted(bot.id for bot in bots)
+            self.service.battle_bots(*bots).result()
+
+        def counts():
+            entity.session.expire_all()
+            battles = [entity.session.query(entity.Bot).get(bot_id).battles
+                       for bot_id in bot_ids]
+            shared = entity.session.query(entity.HeadToHead).get(bot_ids)
+            return battles, shared.battles
+
+        battles, shared = counts()
+        self.assertGreater(shared, 0)
+        self.assertTrue(all(count >= shared for count in battles))
+        self.service.count_battles()
+        self.assertEqual(counts(), (battles, shared))
+
+    def test_create_and_conclude_battles(self):
+        with reloaded_bots() as bots:
+            bot_ids = [bot.id for bot in bots]
+            battle_ids = self.service.create_battles([bots, bots, bots])
+        self.assertEqual(len(set(battle_ids)), 3)
+        entity.session.expire_all()
+        battles_before = [entity.session.query(entity.Bot).get(bot_id).battles
+                          for bot_id in bot_ids]
+
+        self.service.conclude_battles(
+            {battle_ids[0]: [1, 0], battle_ids[1]: None,
+             battle_ids[2]: [0, 1]})
+        entity.session.expire_all()
+        places = [[(fighter.bot_id, fighter.battle_place)
+                   for fighter in self.service.get_by_id(battle_id).fighters]
+                  for battle_id in battle_ids]
+        self.assertEqual(places, [
+            [(bot_ids[0], 1), (bot_ids[1], 0)],
+            [(bot_ids[0], -1), (bot_ids[1], -1)],
+            [(bot_ids[0], 0), (bot_ids[1], 1)]])
+        for battle_id in battle_ids:
+            battle = self.service.get_by_id(battle_id)
+            self.assertEqual(battle.state, BattleState.CONCLUDED)
+            self.assertFalse(battle.ranked)
+        self.assertEqual(
+            [entity.session.query(entity.Bot).get(bot_id).battles
+             for bot_id in bot_ids],
+            [count + 3 for count in battles_before])
+
+    def test_moves(self):
+        with reloaded_bots() as bots:
+            battle_ids = self.service.create_battles([bots, bots])
+        move_log = BattleService.MOVE_LOG
+        with tempfile.TemporaryDirectory() as temp_dir:
+            BattleService.MOVE_LOG = os.path.join(temp_dir, "moves.log")
+            try:
+                # the moves of battles which are rolled back are not logged
+                with self.assertRaises(ValueError):
+                    with Context.scope() as context:
+                        context.get_service(BattleService).conclude_battles(
+                            {battle_ids[0]: [0, 1]}, commit=False,
+                            moves={battle_ids[0]: [796]})
+                        raise ValueError("rolled back")
+                self.assertFalse(os.path.exists(BattleService.MOVE_LOG))
+                self.service.conclude_battles(
+                    {battle_id: [0, 1] for battle_id in battle_ids},
+                    moves={battle_ids[0]: [796, 3452, 796]})
+                self.assertEqual(self.service.get_moves(battle_ids[0]),
+                                 [796, 3452, 796])
+                self.assertEqual(self.service.get_moves(battle_ids[1]), [])
+            finally:
+                BattleService.MOVE_LOG = move_log
+        with self.assertRaises(err.BattleNotExistsError):
+            self.service.get_moves(-1)
+
+    def test_shutdown_scheduler(self):
+        release = threading.Event()
+        battle_scheduler = BattleService.get_scheduler()
+        running = [battle_scheduler.submit(release.wait)
+                   for _ in range(BattleService.BATTLE_WORKERS)]
+        try:
+            with reloaded_bots() as bots:
+                future = self.service.battle_bots(*bots)
+            BattleService.shutdown_scheduler(wait=False, cancel_pending=True)
+        finally:
+            release.set()
+        self.assertTrue(future.cancelled())
+        self.assertTrue(all(job.result() for job in running))
+        entity.session.expire_all()
+        self.assertEqual(self.service.get_by_id(future.battle_id).state,
+                         BattleState.CANCELLED)
+        # the next battle starts a new scheduler
+        self.assertIsNot(BattleService.get_scheduler(), battle_scheduler)
+        with reloaded_bots() as bots:
+            self.service.battle_bots(*bots).result()
+
+    def test_replay(self):
+        with reloaded_bots() as bots:
+            for _ in range(2):
+                self.service.battle_bots(*bots, ranked=True).result()
+            bot_ids = [bot.id for bot in bots]
+        ratings = [entity.session.query(entity.Bot).get(bot_id).rating
+                   for bot_id in bot_ids]
+        entity.session.query(entity.Bot).update({entity.Bot.rating: 0})
+        entity.session.commit()
+
+        snapshots = io.StringIO()
+        self.assertGreaterEqual(
+            replay.replay(entity.session, snapshots, every=1), 2)
+        self.assertEqual(
+            [entity.session.query(entity.Bot).get(bot_id).rating
+             for bot_id in bot_ids], ratings)
+        rows = list(csv.reader(io.StringIO(snapshots.getvalue())))
+        self.assertEqual(rows[0], ["battles", "battle_id", "bot_id", "rating"])
+        self.assertGreaterEqual(len(rows), 5)
+
     def test_battle_bots_error(self):
         bot1 = self.bot_service.get_bot_for_user("battle_user1", "battle_bot1")
         bot2 = self.bot_service.get_bot_for_user("battle_user2", "battle_bot1")
         with self.assertRaises(SafeExecException):
-            self.service.battle_bots(bot1, bot2)
+            self.service.battle_bots(bot1, bot2).result()
+
+    def test_wait_battles(self):
+        with reloaded_bots() as bots:
+            futures = [self.service.battle_bots(*bots) for _ in range(3)]
+        done, not_done = self.service.wait_battles(futures)
+        self.assertEqual(len(done), 3)
+        for future in futures:
+            battle = self.service.get_by_id(future.battle_id)
+            self.assertEqual(battle.state, BattleState.CONCLUDED)
+
+
+class TestTournamentService(GameFixture, unittest.TestCase):
+
+    USER = "tournament_user"
+    GAME = "tournament_game"
+    BOTS = ["t_bot%d" % i for i in range(5)]
+
+    def setUp(self):
+        self.service = ServiceFactory.get_tournament_service()
+        self.bot_service = ServiceFactory.get_bot_service()
+
+    def get_bots(self):
+        return [self.bot_service.get_by_name(bot_name)
+                for bot_name in self.BOTS]
+
+    def create(self, name, kind, ranked=False):
+        with log_in_user("tournament_user", "a"):
+            return self.service.create_tournament(
+                name, "tournament_game", self.get_bots(), kind,
+                ranked=ranked)
+
+    def test_round_robin(self):
+        tournament = self.create("round robin", TournamentKind.ROUND_ROBIN)
+        self.assertEqual(tournament.rounds, 5)
+        standings = self.service.run_tournament("round robin")
+        self.assertEqual([entry.played for entry in standings], [4] * 5)
+        self.assertEqual(sum(entry.points for entry in standings), 10)
+        self.assertEqual(len(tournament.battles), 10)
+
+    def test_double_round_robin(self):
+        self.create("double", TournamentKind.DOUBLE_ROUND_ROBIN)
+        standings = self.service.run_tournament("double")
+        self.assertEqual([entry.played for entry in standings], [8] * 5)
+        # every bot plays first once against each opponent
+        self.assertEqual([entry.points for entry in standings], [4] * 5)
+
+    def test_swiss(self):
+        tournament = self.create("swiss", TournamentKind.SWISS)
+        self.assertEqual(tournament.rounds, 3)
+        standings = self.service.run_tournament("swiss")
+        self.assertEqual(sum(entry.byes for entry in standings), 3)
+        self.assertEqual(sum(entry.points for entry in standings), 9)
+        pairs = [frozenset(fighter.bot_id for fighter in battle.fighters)
+                 for battle in tournament.battles]
+        self.assertEqual(len(pairs), len(set(pairs)))
+
+    def test_resume(self):
+        tournament = self.create("resumed", TournamentKind.ROUND_ROBIN)
+        self.service.run_round("resumed")
+        self.assertEqual(tournament.current_round, 1)
+        self.assertEqual(tournament.state, TournamentState.RUNNING)
+        standings = self.service.run_tournament("resumed")
+        self.assertEqual(tournament.state, TournamentState.FINISHED)
+        self.assertEqual(sum(entry.points for entry in standings), 10)
+
+    def test_ranked(self):
+        with log_in_user("tournament_user", "a"):
+            ratings = {bot.id: bot.rating for bot in self.get_bots()}
+        self.create("ranked", TournamentKind.ROUND_ROBIN, ranked=True)
+        self.service.run_tournament("ranked")
+        with log_in_user("tournament_user", "a"):
+            bots = self.get_bots()
+        self.assertEqual(sum(bot.rating for bot in bots),
+                         sum(ratings.values()))
+        self.assertNotEqual({bot.id: bot.rating for bot in bots}, ratings)
+
+    def test_existing_tournament(self):
+        self.create("existing", TournamentKind.SWISS)
+        with log_in_user("tournament_user", "a"):
+            with self.assertRaises(err.TournamentExistsError):
+                self.service.create_tournament(
+                    "existing", "tournament_game", self.get_bots())
+
+
+class TestFailedTournament(GameFixture, unittest.TestCase):
+
+    USER = "failed_user"
+    GAME = "failed_game"
+    GAME_SOURCE = "raise ValueError('broken game')"
+    BOTS = ("failed_bot1", "failed_bot2")
+
+    def test_failed_round(self):
+        service = ServiceFactory.get_tournament_service()
+        with log_in_user(self.USER, "a"):
+            bots = [ServiceFactory.get_bot_service().get_by_name(bot_name)
+                    for bot_name in self.BOTS]
+            tournament = service.create_tournament(
+                "failed", self.GAME, bots, TournamentKind.ROUND_ROBIN)
+            with self.assertRaises(err.TournamentRoundError):
+                service.run_tournament("failed")
+            self.assertEqual(tournament.current_round, 0)
+            self.assertEqual(tournament.state, TournamentState.RUNNING)
+            self.assertEqual([battle.state for battle in tournament.battles],
+                             [BattleState.FAILED])
+
+            # the failed battle is played again with the round
+            ServiceFactory.get_game_service().update_game(
+                self.GAME, "final_order = [0, 1]")
+            standings = service.run_round("failed")
+        self.assertEqual(tournament.current_round, 1)
+        self.assertEqual([entry.played for entry in standings], [1, 1])
+        self.assertEqual(len(tournament.battles), 1)
+
+
+class TestTournamentSeating(GameFixture, unittest.TestCase):
+
+    USER = "seating_user"
+    GAME = "seating_game"
+    # the bot on the first side wins
+    GAME_SOURCE = "final_order = [0, 1]"
+    BOTS = ("strong_bot", "weak_bot")
+
+    def test_sides(self):
+        service = ServiceFactory.get_tournament_service()
+        bot_service = ServiceFactory.get_bot_service()
+        with log_in_user(self.USER, "a"):
+            bots = [bot_service.get_by_name(bot_name)
+                    for bot_name in self.BOTS]
+            bots[0].rating += 100
+            bot_service.update_entity(bots[0])
+            tournament = service.create_tournament(
+                "seating", self.GAME, bots,
+                TournamentKind.DOUBLE_ROUND_ROBIN)
+            standings = service.run_tournament("seating")
+        # every bot played once on each side and won there
+        self.assertEqual([entry.points for entry in standings], [1, 1])
+        for battle in tournament.battles:
+            fighters = sorted(battle.fighters, key=lambda fighter: fighter.id)
+            self.assertEqual([fighter.battle_place for fighter in fighters],
+                             [0, 1])
+        self.assertEqual(
+            sorted(min(battle.fighters, key=lambda fighter: fighter.id).bot_id
+                   for battle in tournament.battles),
+            sorted(bot.id for bot in bots))
+
+
+class TestMatchMakingService(GameFixture, unittest.TestCase):
+
+    USER = "match_user"
+    GAME = "match_game"
+    BOTS = ("match_bot1", "match_bot2", "match_bot3")
+
+    @classmethod
+    def add_bot(cls, bot_name):
+        super().add_bot(bot_name)
+        ServiceFactory.get_bot_service().update_ready_state(
+            bot_name, BotReadyState.READY)
+
+    def setUp(self):
+        self.service = ServiceFactory.get_matchmaking_service()
+        self.bot_service = ServiceFactory.get_bot_service()
+
+    def test_find_opponent(self):
+        with log_in_user("match_user", "a"):
+            opponent = self.service.find_opponent("match_bot1")
+            self.assertIn(opponent.name, ("match_bot2", "match_bot3"))
+            self.bot_service.update_ready_state(
+                "match_bot2", BotReadyState.NOT_READY)
+            self.bot_service.update_ready_state(
+                "match_bot3", BotReadyState.NOT_READY)
+            self.assertIsNone(self.service.find_opponent("match_bot1"))
+            self.bot_service.update_ready_state(
+                "match_bot2", BotReadyState.READY)
+            self.bot_service.update_ready_state(
+                "match_bot3", BotReadyState.READY)
+
+    def test_pair_waiting(self):
+        with log_in_user("match_user", "a"):
+            self.service.enqueue("match_bot1")
+            bot = self.bot_service.get_by_name("match_bot1")
+            futures = self.service.pair_waiting()
+            self.assertEqual(len(futures), 1)
+            futures[0].result()
+            self.assertEqual(len(self.service.waiting), 0)
+            # the new rating is in the index
+            index = self.service.get_index()
+            self.assertEqual(index.nearest(bot.game_id, bot.rating, 0),
+                             bot.id)
+
+
+class TestLeaderboardService(GameFixture, unittest.TestCase):
+
+    USER = "board_user"
+    GAME = "board_game"
+    BOTS = ["board_bot%d" % i for i in range(4)]
+
+    @classmethod
+    def add_bot(cls, bot_name):
+        super().add_bot(bot_name)
+        # the leaderboard is loaded with the first bot
+        if bot_name == cls.BOTS[0]:
+            ServiceFactory.get_leaderboard_service().get_board()
+
+    def setUp(self):
+        self.service = ServiceFactory.get_leaderboard_service()
+        self.bot_service = ServiceFactory.get_bot_service()
+        self.battle_service = ServiceFactory.get_battle_service()
+
+    def test_leaderboard(self):
+        with log_in_user("board_user", "a"):
+            self.assertEqual(len(self.service.get_top("board_game")), 4)
+            self.assertEqual(self.service.get_rank(self.BOTS[3])[0], 1)
+            first, second = [self.bot_service.get_by_name(bot_name)
+                             for bot_name in self.BOTS[2:]]
+            self.battle_service.battle_bots(
+                first, second, ranked=True).result()
+
+            # the ratings changed by the battle are on the leaderboard
+            top = self.service.get_top("board_game", 1)
+            rank = self.service.get_rank(self.BOTS[2])
+            self.assertEqual(top, [rank])
+            self.assertEqual(rank[1:3], (self.BOTS[2], "board_user"))
+            self.assertGreater(rank[3], BotService.STARTING_BOT_RATING)
+            self.assertEqual(self.service.get_rank(self.BOTS[3])[0], 4)
+            self.assertEqual(
+                [row[1] for row in self.service.get_page("board_game", 1, 3)],
+                [self.BOTS[3]])
+
+            LeaderboardService.invalidate()
+            self.assertEqual(self.service.get_top("board_game", 1), top)
+            with self.assertRaises(err.GameNotExistsError):
+                self.service.get_top("no_game")
+            with self.assertRaises(err.BotNotExistsError):
+                self.service.get_rank("no_bot")
+
+    def test_rollback(self):
+        with log_in_user(self.USER, "a"):
+            user_id = self.bot_service.get_logged_user().id
+            top = self.service.get_top(self.GAME)
+        with self.assertRaises(err.BotExistsError):
+            with Context.scope(user_id) as context:
+                bot_service = context.get_service(BotService)
+                bot_service.add_bot("rolled_back_bot", self.GAME, "")
+                bot_service.add_bot("rolled_back_bot", self.GAME, "")
+        # the leaderboard has the committed bots only
+        with log_in_user(self.USER, "a"):
+            self.assertEqual(self.service.get_top(self.GAME), top)
+
+
+class TestStatsService(GameFixture, unittest.TestCase):
+
+    USER = "stats_user"
+    GAME = "stats_game"
+    GAME_SOURCE = ("players = [__import__(bot) for bot in bots]\n"
+                   "for _ in range(3):\n"
+                   "    for player in players:\n"
+                   "        player.get_move()\n"
+                   "final_order = [0, 1]\n")
+    BOTS = ("fast_bot", "slow_bot")
+    # seconds the bots take for a move
+    DELAYS = {"fast_bot": 0, "slow_bot": 0.01}
+
+    @classmethod
+    def add_bot(cls, bot_name):
+        ServiceFactory.get_bot_service().add_bot(
+            bot_name, cls.GAME,
+            "import time\ndef get_move():\n    time.sleep(%s)\n" %
+            cls.DELAYS[bot_name])
+
+    def setUp(self):
+        self.service = ServiceFactory.get_stats_service()
+        self.bot_service = ServiceFactory.get_bot_service()
+        self.battle_service = ServiceFactory.get_battle_service()
+
+    def test_stats(self):
+        with log_in_user("stats_user", "a"):
+            bots = [self.bot_service.get_by_name(bot_name)
+                    for bot_name in ("fast_bot", "slow_bot")]
+            bot_ids = [bot.id for bot in bots]
+            future = self.battle_service.battle_bots(*bots)
+            future.result()
+
+        battle_stats, move_stats = self.service.get_battle_stats(
+            future.battle_id)
+        self.assertGreaterEqual(battle_stats.wall_time, 0.03)
+        self.assertGreater(battle_stats.peak_rss_mb, 0)
+        self.assertEqual([(stats.bot_id, stats.moves)
+                          for stats in move_stats],
+                         sorted((bot_id, 3) for bot_id in bot_ids))
+
+        moves, mean_time, max_time, histogram = self.service.get_bot_moves(
+            "stats_user", "slow_bot")
+        self.assertEqual((moves, sum(histogram)), (3, 3))
+        self.assertEqual(len(histogram), len(StatsService.MOVE_BUCKETS_MS) + 1)
+        self.assertGreaterEqual(max_time, mean_time)
+        self.assertGreaterEqual(mean_time, 0.01)
+
+        slow_bots = self.service.get_slow_bots("stats_game")
+        self.assertEqual([row[:3] for row in slow_bots],
+                         [("slow_bot", "stats_user", 3),
+                          ("fast_bot", "stats_user", 3)])
+        usage = self.service.get_usage("stats_game")
+        battles = usage[0]
+        self.assertGreaterEqual(battles, 1)
+        self.assertGreaterEqual(self.service.get_usage()[0], battles)
+
+        # a battle run by codejail only has its time
+        with log_in_user("stats_user", "a"):
+            battle_id, = self.battle_service.create_battles([bots])
+        self.battle_service.conclude_battles(
+            {battle_id: [0, 1]},
+            stats={battle_id: {"wall_time": 1.0, "cpu_time": None,
+                               "peak_rss_mb": None}})
+        self.assertIsNone(
+            self.service.get_battle_stats(battle_id)[0].cpu_time)
+        # it is left out of the mean CPU time and the peak memory
+        codejail_usage = self.service.get_usage("stats_game")
+        self.assertEqual(codejail_usage[0], battles + 1)
+        self.assertEqual(codejail_usage[3:], usage[3:])
+        with self.assertRaises(err.BattleNotExistsError):
+            self.service.get_battle_stats(-1)
+
+
+class TestContext(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        user_service = ServiceFactory.get_user_service()
+        cls.user_ids = [user_service.add_user(name, "a").id
+                        for name in ("context_user1", "context_user2")]
+
+    @classmethod
+    def tearDownClass(cls):
+        user_service = ServiceFactory.get_user_service()
+        user_service.add_user("context_admin", "a", UserRights.ADMIN)
+        with log_in_user("context_admin", "a"):
+            for name in ("context_user1", "context_user2", "context_admin"):
+                user_service.remove_user(name)
+
+    def game_exists(self, name):
+        session = entity.session_factory()
+        try:
+            return session.query(entity.Game).filter_by(
+                name=name).count() > 0
+        finally:
+            session.close()
+
+    def test_unit_of_work(self):
+        with Context.scope(self.user_ids[0]) as context:
+            game_service = context.get_service(GameService)
+            game_service.add_game("context_game", "final_order = [0]", "1")
+            game_service.update_game("context_game", "final_order = [0]")
+            # the changes are committed at the end only
+            self.assertFalse(self.game_exists("context_game"))
+        self.assertTrue(self.game_exists("context_game"))
+        with Context.scope(self.user_ids[0]) as context:
+            context.get_service(GameService).remove_game("context_game")
+        self.assertFalse(self.game_exists("context_game"))
+
+    def test_rollback(self):
+        with self.assertRaises(err.GameExistsError):
+            with Context.scope(self.user_ids[0]) as context:
+                game_service = context.get_service(GameService)
+                game_service.add_game("rolled_back", "", "1")
+                game_service.add_game("rolled_back", "", "1")
+        self.assertFalse(self.game_exists("rolled_back"))
+
+    def test_users(self):
+        with Context.scope(self.user_ids[0]) as first, \
+                Context.scope(self.user_ids[1]) as second:
+            self.assertEqual(
+                first.get_service(GameService).get_logged_user().name,
+                "context_user1")
+            self.assertEqual(
+                second.get_service(GameService).get_logged_user().name,
+                "context_user2")
+            self.assertFalse(ServiceFactory.get_user_service().is_logged())
+        with Context.scope() as context:
+            user_service = context.get_service(UserService)
+            self.assertFalse(user_service.is_logged())
+            user_service.log_in("context_user2", "a")
+            self.assertTrue(user_service.is_logged())
+        self.assertFalse(ServiceFactory.get_user_service().is_logged())
+
 
-      
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file